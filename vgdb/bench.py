@@ -0,0 +1,428 @@
+#! /usr/bin/env python3
+"""
+Benchmarks for vgdb pipeline stages
+
+Usage: python bench.py <benchmark> [options]
+"""
+import argparse
+import pathlib
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+from sqlalchemy import create_engine, text
+import xgboost as xgb
+
+from cache import ResponseCache
+from db import BULK_CHUNK_SIZE, LoadStats, create_bulk_load_engine, upsert_records
+from features import TEXT_CHUNK_SIZE, build_features, hashed_text_features, multi_hot, parse_labels
+from fixtures import fixture_clients, record_fixtures, store_page_html
+from steam_api import SteamClient, parse_store_json, parse_store_page
+from title_index import TitleIndex
+
+
+def synthetic_steam_records(n_games, seed=0):
+    """
+    steam_library shaped records for n_games fake games
+    """
+    rng = random.Random(seed)
+    tags = [f'Tag {i}' for i in range(400)]
+    return [
+        {
+            'steam_appid': 10 * (i + 1),
+            'title': f'Game {i}',
+            'owned': 'Yes',
+            'playtime': rng.randint(0, 10000),
+            'last_played': rng.randint(0, 1700000000),
+            'achievement_progress': round(rng.random() * 100, 1),
+            'completed_achievements': rng.randint(0, 50),
+            'total_achievements': 50,
+            'recent_reviews_percent': rng.randint(0, 100),
+            'recent_reviews_count': rng.randint(0, 1000),
+            'all_reviews_percent': rng.randint(0, 100),
+            'all_reviews_count': rng.randint(0, 100000),
+            'short_description': 'A game. ' * rng.randint(5, 40),
+            'tags': str(rng.sample(tags, 20))
+        }
+        for i in range(n_games)
+    ]
+
+
+def bench_store_extractors(appids):
+    """
+    Compare requests, bytes transferred and parse time per app for the store page
+    (html) and JSON endpoint (json) store data extractors
+
+    fetch_seconds of a handful of apps mostly fits in the rate limiters' initial burst,
+    so rate_limited_seconds is the wall time per app the extractor costs at the
+    SteamClient.DEFAULT_RATES limits once that burst is spent.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per appid/extractor, with requests per host
+    """
+    client = SteamClient(None, None, None, max_retries=0)
+    tag_names = client._get_tag_names()  # One-time lookup, not counted per app
+
+    rows = []
+    for appid in appids:
+        for extractor in ['html', 'json']:
+            counts_before = client.fetcher.request_counts.copy()
+            start = time.perf_counter()
+            if extractor == 'html':
+                responses = {'page': client.fetcher.get(client._store_page_url(appid), timeout=60)}
+            else:
+                responses = client._fetch_store_json_responses(appid)
+            fetch_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            if extractor == 'html':
+                parse_store_page(responses['page'].text)
+            else:
+                parse_store_json(appid, responses, tag_names)
+            parse_seconds = time.perf_counter() - start
+
+            requests = client.fetcher.request_counts - counts_before
+            rows.append({
+                'appid': appid,
+                'extractor': extractor,
+                'requests': sum(requests.values()),
+                **{f'requests_{host}': requests[host] for host in SteamClient.DEFAULT_RATES},
+                'bytes': sum(len(r.content) for r in responses.values()),
+                'fetch_seconds': fetch_seconds,
+                'rate_limited_seconds': client.store_data_seconds(1, extractor),
+                'parse_seconds': parse_seconds
+            })
+
+    return pd.DataFrame(rows)
+
+
+def bench_db_load(n_rows):
+    """
+    Rows/sec writing n_rows synthetic steam_library rows with update_db's default engine
+    (statement echo, default PRAGMAs, one executemany) vs the bulk load engine
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per mode
+    """
+    records = synthetic_steam_records(n_rows)
+    columns = ', '.join(f'{k} {"TEXT" if isinstance(v, str) else "FLOAT"}' for k, v in records[0].items() if k != 'steam_appid')
+
+    rows = []
+    for mode in ['default', 'bulk_load']:
+        with tempfile.TemporaryDirectory() as tmp:
+            database_url = f'sqlite:///{tmp}/bench.db'
+            bench_engine = create_bulk_load_engine(database_url) if mode == 'bulk_load' else create_engine(database_url, echo=True)
+            stats = LoadStats()
+
+            start = time.perf_counter()
+            with bench_engine.begin() as conn:
+                conn.execute(text(f"""CREATE TABLE steam_library (steam_appid INT NOT NULL UNIQUE, {columns});"""))
+                upsert_records(conn, 'steam_library', 'steam_appid', records, BULK_CHUNK_SIZE if mode == 'bulk_load' else None, stats)
+            seconds = time.perf_counter() - start
+            bench_engine.dispose()
+
+        rows.append({'mode': mode, 'rows': n_rows, 'seconds': seconds, 'rows_per_sec': n_rows / seconds})
+
+    return pd.DataFrame(rows)
+
+
+def _explode_binary_dense(df, explode_col):
+    """
+    The original vgr.explode_binary (dense columns set cell by cell), as a baseline
+    """
+    df_tags = df[[explode_col]].copy()
+    UNIQUE_TAGS = sorted(list(set([tag for row in df_tags[explode_col].tolist() if row for tag in row])), reverse=False)
+    df_tags[[f'{explode_col}_{tag}' for tag in UNIQUE_TAGS]] = 0
+
+    for row_idx, row in df_tags.iterrows():
+        if row[explode_col]:
+            for tag in row[explode_col]:
+                df_tags.at[row_idx, f'{explode_col}_{tag}'] = 1
+    df_tags = df_tags.drop([explode_col], axis=1)
+    return df_tags
+
+
+def bench_multi_hot(n_games):
+    """
+    Time and memory of multi-hot encoding n_games synthetic tag lists with the original
+    dense explode_binary vs features.multi_hot
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per encoder
+    """
+    df = pd.DataFrame({'tags': parse_labels(record['tags'] for record in synthetic_steam_records(n_games))})
+
+    start = time.perf_counter()
+    df_dense = _explode_binary_dense(df, 'tags')
+    dense_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    X, vocabulary = multi_hot(df['tags'].tolist())
+    sparse_seconds = time.perf_counter() - start
+
+    assert (X.toarray() == df_dense.values).all() and vocabulary == [c[len('tags_'):] for c in df_dense.columns]
+
+    return pd.DataFrame([
+        {'encoder': 'dense', 'games': n_games, 'labels': len(vocabulary), 'seconds': dense_seconds, 'bytes': int(df_dense.memory_usage(deep=True).sum())},
+        {'encoder': 'sparse', 'games': n_games, 'labels': len(vocabulary), 'seconds': sparse_seconds, 'bytes': X.data.nbytes + X.indices.nbytes + X.indptr.nbytes},
+    ])
+
+
+def synthetic_descriptions(n_games, seed=0):
+    """
+    n_games fake descriptions drawn from a 5000 word vocabulary
+    """
+    rng = random.Random(seed)
+    words = [f'word{i}' for i in range(5000)]
+    return [' '.join(rng.choices(words, k=rng.randint(20, 120))) for _ in range(n_games)]
+
+
+def bench_text_features(n_games, chunk_sizes=(100, TEXT_CHUNK_SIZE, 10000)):
+    """
+    Time per 10k games and peak traced memory of hashing n_games synthetic descriptions
+    with features.hashed_text_features, for a few chunk sizes
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per chunk size
+    """
+    texts = synthetic_descriptions(n_games)
+
+    rows = []
+    for chunk_size in chunk_sizes:
+        start = time.perf_counter()
+        X = hashed_text_features(texts, chunk_size=chunk_size)
+        seconds = time.perf_counter() - start
+
+        # Separate pass, tracing slows the hashing down several times
+        tracemalloc.start()
+        hashed_text_features(texts, chunk_size=chunk_size)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        rows.append({
+            'chunk_size': chunk_size,
+            'games': n_games,
+            'seconds': seconds,
+            'seconds_per_10k': seconds / n_games * 10000,
+            'nnz': X.nnz,
+            'matrix_bytes': X.data.nbytes + X.indices.nbytes + X.indptr.nbytes,
+            'peak_bytes': peak
+        })
+
+    return pd.DataFrame(rows)
+
+
+def max_rss():
+    """
+    The process' peak resident set size in bytes so far, native allocations (XGBoost,
+    SQLite, lxml) included
+    """
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024  # kB on Linux
+
+
+def _measure(fn):
+    """
+    Wall time of fn(), then its peak traced memory in a second call (tracing slows
+    Python code down too much to time the same call)
+
+    tracemalloc only sees allocations made through Python's allocator, so the
+    process' peak RSS is returned as well.
+
+    Returns
+    -------
+    float
+        Seconds
+    int
+        Peak bytes allocated by Python while fn ran
+    int
+        Peak RSS bytes of the process once fn ran (a high water mark, it only goes up
+        between stages)
+    """
+    start = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return seconds, peak, max_rss()
+
+
+def synthetic_games_data(n_games, seed=0):
+    """
+    games_data shaped DataFrame (indexed by igdb_id) for n_games fake games, half rated
+    """
+    rng = random.Random(seed)
+    records = synthetic_steam_records(n_games, seed)
+    descriptions = synthetic_descriptions(n_games, seed)
+    return pd.DataFrame({
+        'igdb_id': range(1, n_games + 1),
+        'title': [record['title'] for record in records],
+        'playtime_hours': [record['playtime'] / 60 for record in records],
+        'achievement_progress': [record['achievement_progress'] for record in records],
+        'reviews_percent': [float(record['all_reviews_percent']) for record in records],
+        'description': [record['short_description'] for record in records],
+        'storyline': descriptions,
+        'platforms': [str(rng.sample(['PC (Microsoft Windows)', 'PlayStation 4', 'PlayStation 5', 'Nintendo Switch'], 2)) for _ in records],
+        'tags': [record['tags'] for record in records],
+        'personal_rating': [rng.randint(1, 10) if rng.random() < 0.5 else None for _ in records]
+    }).set_index('igdb_id')
+
+
+def bench_suite(n_games, seed=0):
+    """
+    Throughput and peak memory of every pipeline stage on a synthetic account of
+    n_games Steam games (plus n_games / 4 wishlist games and PSN titles)
+
+    API stages replay responses recorded by fixtures.record_fixtures through an
+    offline ResponseCache, so they measure the clients' own work (cache reads, JSON
+    and HTML parsing, aggregation) without the network.
+
+    peak_mb is the peak Python (tracemalloc) memory of the stage. peak_rss_mb is the
+    process' peak RSS after the stage, which also counts native memory; a stage that
+    raises it over the previous stages' is the one that needed it.
+
+    Returns
+    -------
+    pd.DataFrame
+        stage, items, seconds, items_per_sec, peak_mb and peak_rss_mb, one row per stage
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = pathlib.Path(tmp)
+        start = time.time()
+        cache = ResponseCache(path=tmp / 'fixtures.sqlite', max_bytes=2 ** 40, offline=True)
+        account = record_fixtures(cache, n_games, seed)
+        steam_appids = [game['appid'] for game in account['library']] + [game['steam_appid'] for game in account['wishlist']]
+        ps_titles = [title['name'] for title in account['ps_titles']]
+        igdb_ids = [game['id'] for game in account['igdb_games']]
+        print(f'Fixtures: {len(steam_appids)} Steam apps, {len(ps_titles)} PSN titles [{time.time()-start:.2f} seconds]')
+
+        rng = random.Random(seed)
+        store_pages = [store_page_html(rng) for _ in range(n_games)]
+        title_index = TitleIndex(tmp / 'titles.sqlite')
+        title_index.build(account['igdb_games'])
+        df = synthetic_games_data(n_games, seed)
+        X, _ = build_features(df)
+        rated = df['personal_rating'].notnull().values
+        records = synthetic_steam_records(n_games, seed)
+
+        # Never played games are filled in without a request (see SteamClient._reuse_achievements)
+        achievement_requests = sum(not SteamClient._reuse_achievements(game) for game in fixture_clients(cache)[0]._get_library_games())
+
+        def steam_achievements():
+            client = fixture_clients(cache)[0]
+            client._enrich_with_achievements(client._get_library_games())
+
+        def db_load():
+            with tempfile.TemporaryDirectory() as db_tmp:
+                bench_engine = create_bulk_load_engine(f'sqlite:///{db_tmp}/bench.db')
+                columns = ', '.join(f'{k} {"TEXT" if isinstance(v, str) else "FLOAT"}' for k, v in records[0].items() if k != 'steam_appid')
+                with bench_engine.begin() as conn:
+                    conn.execute(text(f"""CREATE TABLE steam_library (steam_appid INT NOT NULL UNIQUE, {columns});"""))
+                    upsert_records(conn, 'steam_library', 'steam_appid', records, BULK_CHUNK_SIZE)
+                bench_engine.dispose()
+
+        stages = [
+            ('store_page_parse', n_games, lambda: [parse_store_page(page) for page in store_pages]),
+            ('steam_achievements', achievement_requests, steam_achievements),
+            ('steam_library', n_games, lambda: list(fixture_clients(cache)[0].iter_library())),
+            ('steam_wishlist', len(account['wishlist']), lambda: list(fixture_clients(cache)[0].iter_wishlist())),
+            ('ps_titles', len(ps_titles), lambda: list(fixture_clients(cache)[1].iter_played_titles())),
+            ('igdb_steam_mapping', len(steam_appids), lambda: fixture_clients(cache)[2].run('get_igdb_ids_by_steam_appids', steam_appids)),
+            ('igdb_title_mapping', len(ps_titles), lambda: [title_index.match(title) for title in ps_titles]),
+            ('igdb_games', len(igdb_ids), lambda: fixture_clients(cache)[2].run('get_games', igdb_ids)),
+            ('db_load', n_games, db_load),
+            ('featurize', n_games, lambda: build_features(df)),
+            ('train', int(rated.sum()), lambda: xgb.XGBRegressor(n_estimators=100).fit(X[rated], df['personal_rating'].values[rated])),
+        ]
+
+        rows = []
+        for stage, items, fn in stages:
+            seconds, peak, peak_rss = _measure(fn)
+            rows.append({'stage': stage, 'items': items, 'seconds': seconds, 'items_per_sec': items / seconds, 'peak_mb': peak / 2 ** 20, 'peak_rss_mb': peak_rss / 2 ** 20})
+            print(f'{stage}: {items} items [{seconds:.2f} seconds]')
+
+    return pd.DataFrame(rows)
+
+
+def compare_to_baseline(results, baseline, tolerance=0.2):
+    """
+    Flag stages more than tolerance slower (items/sec) or hungrier (peak memory) than
+    a saved bench_suite run
+
+    Returns
+    -------
+    pd.DataFrame
+        results with throughput_change, peak_change, peak_rss_change (ratios to the
+        baseline) and regression
+    """
+    columns = ['items_per_sec', 'peak_mb', 'peak_rss_mb']
+    merged = results.merge(baseline[['stage'] + [c for c in columns if c in baseline]], on='stage', how='left', suffixes=('', '_baseline'))
+    merged['throughput_change'] = merged['items_per_sec'] / merged['items_per_sec_baseline']
+    merged['peak_change'] = merged['peak_mb'] / merged['peak_mb_baseline']
+    # Baselines saved before peak_rss_mb was reported have nothing to compare it to
+    merged['peak_rss_change'] = merged['peak_rss_mb'] / merged['peak_rss_mb_baseline'] if 'peak_rss_mb' in baseline else float('nan')
+    merged['regression'] = (merged['throughput_change'] < 1 - tolerance) | (merged['peak_change'] > 1 + tolerance) | (merged['peak_rss_change'] > 1 + tolerance)
+
+    return merged.drop(columns=[f'{c}_baseline' for c in columns if c in baseline])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='vgdb benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    store_parser = subparsers.add_parser('store', help='Store page vs JSON store data extractor')
+    store_parser.add_argument('appids', nargs='+', type=int)
+
+    db_parser = subparsers.add_parser('db', help='Default vs bulk load database writes')
+    db_parser.add_argument('--rows', type=int, default=50000)
+
+    encode_parser = subparsers.add_parser('encode', help='Dense vs sparse multi-hot tag encoding')
+    encode_parser.add_argument('--games', type=int, default=2000)
+
+    text_parser = subparsers.add_parser('text', help='Hashed text features per 10k games')
+    text_parser.add_argument('--games', type=int, default=10000)
+
+    suite_parser = subparsers.add_parser('suite', help='Every pipeline stage replayed offline on a synthetic account')
+    suite_parser.add_argument('--games', type=int, default=10000, help='Steam library size')
+    suite_parser.add_argument('--seed', type=int, default=0)
+    suite_parser.add_argument('--output', help='Save the results to this csv, e.g. as a baseline')
+    suite_parser.add_argument('--baseline', help='Compare against results saved with --output, exit 1 on regressions')
+    suite_parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed throughput/peak memory change before a regression')
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'store':
+        df = bench_store_extractors(args.appids)
+        print(df.to_string(index=False))
+        print()
+        print(df.groupby('extractor')[[c for c in df.columns if c not in ['appid', 'extractor']]].mean().to_string())
+    elif args.benchmark == 'db':
+        print(bench_db_load(args.rows).to_string(index=False))
+    elif args.benchmark == 'encode':
+        print(bench_multi_hot(args.games).to_string(index=False))
+    elif args.benchmark == 'text':
+        print(bench_text_features(args.games).to_string(index=False))
+    elif args.benchmark == 'suite':
+        df = bench_suite(args.games, args.seed)
+        if args.output:
+            df.to_csv(args.output, index=False)
+        if args.baseline:
+            df = compare_to_baseline(df, pd.read_csv(args.baseline), args.tolerance)
+        print(df.to_string(index=False))
+        if args.baseline and df['regression'].any():
+            sys.exit(1)
@@ -0,0 +1,211 @@
+import atexit
+import hashlib
+import json
+import pathlib
+import sqlite3
+import threading
+import time
+
+CACHE_PATH = pathlib.Path.home() / ".vgdb" / "http_cache.sqlite"
+
+# Per endpoint time-to-live (seconds)
+TTL_PLAYTIME = 10 * 60  # Owned games, achievements, PSN titles/trophies
+TTL_WISHLIST = 60 * 60
+TTL_STORE_PAGE = 3 * 24 * 60 * 60
+TTL_IGDB = 3 * 7 * 24 * 60 * 60
+
+
+class CacheMiss(Exception):
+    """Raised in offline mode when a request isn't in the cache"""
+
+
+class CachedResponse():
+    """
+    Minimal stand-in for requests.Response replayed from the cache
+
+    Attributes
+    ----------
+    status_code : int
+    content : bytes
+    url : str
+    """
+
+    def __init__(self, status_code, content, url=None):
+        self.status_code = status_code
+        self.content = content
+        self.url = url
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class ResponseCache():
+    """
+    SQLite backed HTTP response cache shared by the API clients
+
+    Attributes
+    ----------
+    path : pathlib.Path
+        Location of the cache database (default ~/.vgdb/http_cache.sqlite)
+    max_bytes : int
+        Least recently used responses are evicted once the cache grows past this size
+    offline : bool
+        Replay only. Expired entries are still served and a miss raises CacheMiss
+        instead of going to the network.
+
+    Hits are read on per thread connections and their last_access updates are batched
+    (written with the next set, evict, every ACCESS_FLUSH_EVERY hits and at exit), so
+    cache reads don't serialize the clients' thread pools on a write and commit.
+    """
+
+    EVICT_EVERY = 500  # Writes between size checks
+    # Auth failures (keys don't include the token) and throttling, along with 5xx. Steam's
+    # 400/403 for private or stat-less games are real answers and are cached.
+    UNCACHED_STATUS = (401, 407, 429)
+    ACCESS_FLUSH_EVERY = 1000  # Hits between last_access writes
+
+    def __init__(self, path=CACHE_PATH, max_bytes=512 * 1024 * 1024, offline=False):
+        self.path = pathlib.Path(path)
+        self.max_bytes = max_bytes
+        self.offline = offline
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._accessed = {}  # key => last access not written yet
+        self._access_lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("""PRAGMA journal_mode = WAL;""")  # Readers don't block the writer
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                status_code INT,
+                content BLOB,
+                size INT,
+                expires FLOAT,
+                last_access FLOAT
+            );
+            """
+        )
+        self._conn.commit()
+        self._writes = 0
+        atexit.register(self.flush)
+
+        if not self.offline:
+            self.evict()
+
+    @staticmethod
+    def key(method, url, body=None):
+        """Cache key for a request. Hashed so API keys in urls aren't stored in clear text."""
+        return hashlib.sha256(f'{method.upper()} {url} {body or ""}'.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        Return the cached response for key, or None if missing/expired
+        """
+        now = time.time()
+        row = self._reader().execute(
+            """SELECT status_code, content, expires FROM responses WHERE key = ?;""",
+            (key,)
+        ).fetchone()
+        if row is None or (row[2] < now and not self.offline):
+            return None
+
+        with self._access_lock:
+            self._accessed[key] = now
+            flush = len(self._accessed) >= self.ACCESS_FLUSH_EVERY
+        if flush:
+            self.flush()
+
+        return CachedResponse(row[0], row[1])
+
+    def _reader(self):
+        """This thread's read connection"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, check_same_thread=False)
+        return conn
+
+    def _write_accessed(self):
+        """Write batched last_access updates. Call with _lock held, commit after."""
+        with self._access_lock:
+            accessed, self._accessed = self._accessed, {}
+        if accessed:
+            self._conn.executemany("""UPDATE responses SET last_access = ? WHERE key = ?;""", [(t, k) for k, t in accessed.items()])
+
+    def flush(self):
+        """Write batched last_access updates"""
+        with self._lock:
+            self._write_accessed()
+            self._conn.commit()
+
+    def set(self, key, response, ttl):
+        """
+        Store response for ttl seconds. Auth failures, throttling and server errors are
+        never cached.
+        """
+        if response.status_code in self.UNCACHED_STATUS or response.status_code >= 500:
+            return
+
+        now = time.time()
+        content = response.content
+        with self._lock:
+            self._conn.execute(
+                """INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?);""",
+                (key, response.status_code, content, len(content), now + ttl, now)
+            )
+            self._write_accessed()
+            self._conn.commit()
+            self._writes += 1
+            evict = self._writes % self.EVICT_EVERY == 0
+
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """
+        Drop expired entries, then least recently used entries until under max_bytes
+        """
+        with self._lock:
+            self._write_accessed()
+            self._conn.execute("""DELETE FROM responses WHERE expires < ?;""", (time.time(),))
+            total = self._conn.execute("""SELECT COALESCE(SUM(size), 0) FROM responses;""").fetchone()[0]
+            if total > self.max_bytes:
+                to_free = total - self.max_bytes
+                freed = 0
+                stale_keys = []
+                for key, size in self._conn.execute("""SELECT key, size FROM responses ORDER BY last_access;"""):
+                    if freed >= to_free:
+                        break
+                    stale_keys.append((key,))
+                    freed += size
+                self._conn.executemany("""DELETE FROM responses WHERE key = ?;""", stale_keys)
+            self._conn.commit()
+
+    def get_or_fetch(self, key, ttl, fetch):
+        """
+        Return the cached response for key, otherwise call fetch() and cache its response
+
+        Parameters
+        ----------
+        key : str
+            From ResponseCache.key
+        ttl : int
+            Seconds to keep the response
+        fetch : callable
+            Returns a response with status_code and content
+        """
+        response = self.get(key)
+        if response is not None:
+            return response
+        if self.offline:
+            raise CacheMiss(key)
+
+        response = fetch()
+        self.set(key, response, ttl)
+        return response
@@ -0,0 +1,647 @@
+import hashlib
+import json
+import numbers
+import re
+import threading
+import time
+
+import numpy as np
+from sqlalchemy import create_engine, event, text
+
+# Applied to every connection of a bulk load engine
+BULK_LOAD_PRAGMAS = [
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA cache_size = -262144',  # 256 MiB
+    'PRAGMA temp_store = MEMORY',
+]
+BULK_CHUNK_SIZE = 5000  # Rows per executemany in bulk load mode
+KEY_CHUNK_SIZE = 500  # Keys per IN (...) lookup, under SQLite's bound parameter limit
+NUMERIC_STRING = re.compile(r'^-?\d+(\.\d*)?([eE][-+]?\d+)?$')  # Numbers read back from TEXT columns
+
+
+def create_bulk_load_engine(database_url):
+    """
+    Engine for fast loads: no statement echo and load-time PRAGMAs on every connection
+    """
+    bulk_engine = create_engine(database_url, echo=False)
+
+    @event.listens_for(bulk_engine, 'connect')
+    def apply_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in BULK_LOAD_PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
+
+    return bulk_engine
+
+
+class LoadStats():
+    """
+    Rows written and time spent writing them, per table
+    """
+
+    def __init__(self):
+        self.tables = {}
+        self._lock = threading.Lock()
+
+    def record(self, table, rows, seconds):
+        with self._lock:
+            total_rows, total_seconds = self.tables.get(table, (0, 0.0))
+            self.tables[table] = (total_rows + rows, total_seconds + seconds)
+
+    def report(self):
+        """
+        Returns
+        -------
+        list of dicts
+            table, rows, seconds and rows_per_sec for every table written
+        """
+        return [
+            {'table': table, 'rows': rows, 'seconds': seconds, 'rows_per_sec': rows / seconds if seconds else None}
+            for table, (rows, seconds) in self.tables.items()
+        ]
+
+    def print_report(self):
+        for row in self.report():
+            rows_per_sec = f'{row["rows_per_sec"]:.0f}' if row['rows_per_sec'] else '-'
+            print(f'{row["table"]}: {row["rows"]} rows [{row["seconds"]:.2f} seconds, {rows_per_sec} rows/sec]')
+
+
+def _executemany(conn, statement, records, chunk_size=None, stats=None, table=None):
+    """
+    Execute statement for every record, chunk_size records per executemany
+    """
+    start = time.time()
+    chunk_size = chunk_size or len(records)
+    for i in range(0, len(records), chunk_size):
+        conn.execute(statement, records[i:i+chunk_size])
+    if stats is not None:
+        stats.record(table, len(records), time.time() - start)
+
+
+def table_exists(conn, table):
+    """Return True if table exists in the connected SQLite database"""
+    result = conn.execute(
+        text("""SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :table;"""),
+        {'table': table}
+    )
+    return result.first() is not None
+
+
+def ensure_unique_index(conn, table, key):
+    """
+    Create a unique index on key so upserts can target it
+
+    Tables created before the key was declared UNIQUE don't have one.
+    """
+    conn.execute(text(f"""CREATE UNIQUE INDEX IF NOT EXISTS ux_{table}_{key} ON {table} ({key});"""))
+
+
+def record_hash(record):
+    """
+    Content hash of a record
+
+    Numbers are compared as floats so values read back from SQLite hash the same
+    as the ints/floats/numpy scalars produced by the API clients. Numeric strings
+    count as numbers too, since TEXT columns (e.g. ps_played_titles' timestamps) read
+    back floats as '1609459200.0'.
+    """
+    normalized = {}
+    for k, v in record.items():
+        if isinstance(v, str) and NUMERIC_STRING.match(v):
+            v = float(v)
+        if isinstance(v, numbers.Number) and not isinstance(v, bool):
+            v = float(v)
+            v = None if v != v else v  # NaN => NULL
+        normalized[k] = v
+    return hashlib.sha1(json.dumps(normalized, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def changed_records(conn, table, key, records):
+    """
+    Filter records down to ones that are new or differ from the stored row
+
+    Parameters
+    ----------
+    conn : sqlalchemy.engine.Connection
+    table : str
+        Table to compare against
+    key : str
+        Natural key column of table
+    records : list of dicts
+        Fresh records, already converted to their stored representation
+
+    Returns
+    -------
+    list of dicts
+        Records that need to be upserted
+    """
+    if not records or not table_exists(conn, table):
+        return list(records)
+
+    # Only read back the stored rows of these records' keys, so comparing a small batch
+    # doesn't scan the whole table
+    columns = list(records[0].keys())
+    keys = [record[key] for record in records]
+    stored_hashes = {}
+    for i in range(0, len(keys), KEY_CHUNK_SIZE):
+        params = {f'k{j}': k for j, k in enumerate(keys[i:i+KEY_CHUNK_SIZE])}
+        rows = conn.execute(
+            text(f"""SELECT {', '.join(columns)} FROM {table} WHERE {key} IN ({', '.join(f':{p}' for p in params)});"""),
+            params
+        ).mappings()
+        stored_hashes.update({row[key]: record_hash(dict(row)) for row in rows})
+
+    return [record for record in records if stored_hashes.get(record[key]) != record_hash(record)]
+
+
+def upsert_records(conn, table, key, records, chunk_size=None, stats=None):
+    """
+    Insert records, updating the existing row when key already exists
+    """
+    if not records:
+        return
+
+    columns = list(records[0].keys())
+    updates = [c for c in columns if c != key]
+    statement = text(
+        f"""
+        INSERT INTO {table} ({', '.join(columns)})
+        VALUES ({', '.join(f':{c}' for c in columns)})
+        ON CONFLICT ({key}) DO UPDATE SET {', '.join(f'{c} = excluded.{c}' for c in updates)};
+        """
+    )
+    _executemany(conn, statement, records, chunk_size, stats, table)
+
+
+def insert_records(conn, table, records, chunk_size=None, stats=None):
+    """
+    Insert records
+    """
+    if not records:
+        return
+
+    columns = list(records[0].keys())
+    statement = text(f"""INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(f':{c}' for c in columns)});""")
+    _executemany(conn, statement, records, chunk_size, stats, table)
+
+
+def delete_missing(conn, table, key, keys):
+    """
+    Delete rows whose key is not in keys (e.g. games removed from a wishlist)
+    """
+    stored_keys = {row[0] for row in conn.execute(text(f"""SELECT {key} FROM {table};"""))}
+    missing = [{'key': k} for k in stored_keys - set(keys)]
+    if missing:
+        conn.execute(text(f"""DELETE FROM {table} WHERE {key} = :key;"""), missing)
+
+
+def create_label_tables(conn, vocab_table, junction_table, key, key_type):
+    """
+    Create a vocabulary table (id, name) and a junction table linking key to it
+
+    The junction is indexed by vocabulary id so filtering by label is an indexed join.
+    """
+    conn.execute(
+        text(
+            f"""
+            CREATE TABLE IF NOT EXISTS {vocab_table} (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL UNIQUE
+            );
+            """
+        )
+    )
+    conn.execute(
+        text(
+            f"""
+            CREATE TABLE IF NOT EXISTS {junction_table} (
+                {key} {key_type} NOT NULL,
+                {vocab_table}_id INT NOT NULL,
+                position INT,
+                PRIMARY KEY ({key}, {vocab_table}_id)
+            );
+            """
+        )
+    )
+    conn.execute(text(f"""CREATE INDEX IF NOT EXISTS ix_{junction_table}_{vocab_table}_id ON {junction_table} ({vocab_table}_id, {key});"""))
+
+
+def write_labels(conn, vocab_table, junction_table, key, labels, chunk_size=None, stats=None):
+    """
+    Replace the labels of every key in labels
+
+    Parameters
+    ----------
+    conn : sqlalchemy.engine.Connection
+    vocab_table : str
+        e.g. tag
+    junction_table : str
+        e.g. steam_app_tag
+    key : str
+        Key column of junction_table, e.g. steam_appid
+    labels : dict
+        key => list of label names (None for no labels), in order of importance
+    """
+    if not labels:
+        return
+
+    names = sorted({name for names in labels.values() if names for name in names})
+    if names:
+        conn.execute(text(f"""INSERT OR IGNORE INTO {vocab_table} (name) VALUES (:name);"""), [{'name': name} for name in names])
+    vocab_ids = {name: id for id, name in conn.execute(text(f"""SELECT id, name FROM {vocab_table};"""))}
+
+    rows = []
+    for k, names in labels.items():
+        seen = set()
+        for position, name in enumerate(names or []):
+            if name not in seen:
+                seen.add(name)
+                rows.append({'key': k, 'vocab_id': vocab_ids[name], 'position': position})
+
+    conn.execute(text(f"""DELETE FROM {junction_table} WHERE {key} = :key;"""), [{'key': k} for k in labels])
+    if rows:
+        _executemany(
+            conn,
+            text(f"""INSERT INTO {junction_table} ({key}, {vocab_table}_id, position) VALUES (:key, :vocab_id, :position);"""),
+            rows,
+            chunk_size,
+            stats,
+            junction_table
+        )
+
+
+def prune_labels(conn, junction_table, key, keys_query):
+    """
+    Delete junction rows whose key is no longer returned by keys_query
+    """
+    conn.execute(text(f"""DELETE FROM {junction_table} WHERE {key} NOT IN ({keys_query});"""))
+
+
+def get_vocabulary(conn, vocab_table):
+    """
+    Returns
+    -------
+    dict
+        Vocabulary id => name
+    """
+    return {id: name for id, name in conn.execute(text(f"""SELECT id, name FROM {vocab_table} ORDER BY id;"""))}
+
+
+def get_label_codes(conn, vocab_table, junction_table, key, label=None):
+    """
+    Labels of every key as integer coded arrays
+
+    Parameters
+    ----------
+    label : str, optional
+        Only return keys that have this label (indexed lookup)
+
+    Returns
+    -------
+    dict
+        key => np.array of vocabulary ids, in order of importance
+    """
+    query = f"""SELECT j.{key}, j.{vocab_table}_id FROM {junction_table} j"""
+    params = {}
+    if label is not None:
+        query += f""" WHERE j.{key} IN (
+            SELECT f.{key} FROM {junction_table} f JOIN {vocab_table} v ON v.id = f.{vocab_table}_id WHERE v.name = :label
+        )"""
+        params['label'] = label
+    query += f""" ORDER BY j.{key}, j.position;"""
+
+    codes = {}
+    for k, vocab_id in conn.execute(text(query), params):
+        codes.setdefault(k, []).append(vocab_id)
+
+    return {k: np.array(vocab_ids, dtype=np.int32) for k, vocab_ids in codes.items()}
+
+
+def get_games_data_label_codes(conn, df):
+    """
+    Integer coded label columns of games_data rows, read from the junction tables
+    instead of the stored list strings
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        games_data rows indexed by igdb_id
+
+    Returns
+    -------
+    dict
+        Column in GAMES_DATA_LABELS => (list of np.arrays of vocabulary ids, one per
+        df row, dict of vocabulary id => name)
+    """
+    no_labels = np.array([], dtype=np.int32)
+    label_codes = {}
+    for col, (vocab_table, junction_table, key) in GAMES_DATA_LABELS.items():
+        codes = get_label_codes(conn, vocab_table, junction_table, key)
+        keys = df.index if key == 'igdb_id' else df[key]
+        label_codes[col] = ([codes.get(k, no_labels) for k in keys], get_vocabulary(conn, vocab_table))
+
+    return label_codes
+
+
+# List columns of games_data: (vocabulary table, junction table, games_data key the junction is keyed by)
+GAMES_DATA_LABELS = {
+    'platforms': ('platform', 'igdb_game_platform', 'igdb_id'),
+    'tags': ('tag', 'steam_app_tag', 'steam_appid'),
+}
+
+# Columns of games_data, in the order GAMES_DATA_QUERY selects them
+GAMES_DATA_COLUMNS = [
+    'igdb_id', 'steam_appid', 'ps_np_title_id', 'title', 'playtime_hours', 'last_played', 'achievement_progress',
+    'reviews_percent', 'description', 'storyline', 'platforms', 'tags', 'personal_rating'
+]
+GAMES_DATA_QUERY = """
+    WITH steam AS (
+        SELECT * FROM steam_library
+        UNION ALL
+        SELECT * FROM steam_wishlist
+    ),
+    steam_games AS (
+        SELECT
+            m.igdb_id,
+            MIN(s.steam_appid) AS steam_appid,
+            MAX(s.title) AS title,
+            SUM(s.playtime) AS playtime,
+            MAX(s.last_played) AS last_played,
+            MAX(s.achievement_progress) AS achievement_progress,
+            MAX(s.all_reviews_percent) AS reviews_percent,
+            MAX(s.short_description) AS description,
+            MAX(s.tags) AS tags
+        FROM (SELECT DISTINCT igdb_id, steam_appid FROM id_mapping WHERE igdb_id IS NOT NULL AND steam_appid IS NOT NULL) m
+        JOIN steam s ON s.steam_appid = m.steam_appid
+        GROUP BY m.igdb_id
+    ),
+    ps_games AS (
+        SELECT
+            m.igdb_id,
+            MIN(p.ps_np_title_id) AS ps_np_title_id,
+            MAX(p.title) AS title,
+            SUM(p.playtime) AS playtime,
+            MAX(CAST(p.last_played AS REAL)) AS last_played,
+            MAX(p.trophy_weighted_progress) AS achievement_progress
+        FROM (SELECT DISTINCT igdb_id, ps_np_title_id FROM id_mapping WHERE igdb_id IS NOT NULL AND ps_np_title_id IS NOT NULL) m
+        JOIN ps_played_titles p ON p.ps_np_title_id = m.ps_np_title_id
+        GROUP BY m.igdb_id
+    ),
+    ids AS (
+        SELECT DISTINCT igdb_id FROM id_mapping WHERE igdb_id IS NOT NULL {ids_filter}
+    )
+    SELECT
+        ids.igdb_id AS igdb_id,
+        sg.steam_appid AS steam_appid,
+        pg.ps_np_title_id AS ps_np_title_id,
+        COALESCE(i.name, sg.title, pg.title) AS title,
+        (COALESCE(sg.playtime, 0) + COALESCE(pg.playtime, 0)) / 60.0 AS playtime_hours,
+        NULLIF(MAX(COALESCE(sg.last_played, 0), COALESCE(pg.last_played, 0)), 0) AS last_played,
+        COALESCE(sg.achievement_progress, pg.achievement_progress) AS achievement_progress,
+        COALESCE(sg.reviews_percent, i.rating) AS reviews_percent,
+        COALESCE(NULLIF(sg.description, ''), i.summary) AS description,
+        i.storyline AS storyline,
+        i.platforms AS platforms,
+        sg.tags AS tags,
+        r.personal_rating AS personal_rating
+    FROM ids
+    LEFT JOIN igdb_data i ON i.igdb_id = ids.igdb_id
+    LEFT JOIN steam_games sg ON sg.igdb_id = ids.igdb_id
+    LEFT JOIN ps_games pg ON pg.igdb_id = ids.igdb_id
+    LEFT JOIN personal_ratings r ON r.igdb_id = ids.igdb_id
+"""
+
+
+def create_games_data_tables(conn, rebuild=False):
+    """
+    Create games_data (materialized join of every source table, one row per igdb_id)
+    and personal_ratings (user maintained, never dropped)
+
+    Ratings used to be entered straight into games_data. When personal_ratings doesn't
+    exist yet, the igdb_id/personal_rating pairs of an existing games_data are copied
+    into it first, so a rebuild doesn't drop the only copy of the labels.
+    """
+    migrate_ratings = not table_exists(conn, 'personal_ratings') and table_exists(conn, 'games_data')
+    conn.execute(
+        text(
+            """
+            CREATE TABLE IF NOT EXISTS personal_ratings (
+                igdb_id INT NOT NULL UNIQUE,
+                personal_rating FLOAT
+            );
+            """
+        )
+    )
+    if migrate_ratings:
+        result = conn.execute(
+            text(
+                """
+                INSERT OR IGNORE INTO personal_ratings (igdb_id, personal_rating)
+                SELECT igdb_id, personal_rating FROM games_data WHERE igdb_id IS NOT NULL AND personal_rating IS NOT NULL;
+                """
+            )
+        )
+        print(f'Copied {result.rowcount} personal ratings from games_data into personal_ratings')
+    if rebuild:
+        conn.execute(text("""DROP TABLE IF EXISTS games_data;"""))
+    conn.execute(
+        text(
+            """
+            CREATE TABLE IF NOT EXISTS games_data (
+                igdb_id INT NOT NULL UNIQUE,
+                steam_appid INT,
+                ps_np_title_id TEXT,
+                title TEXT,
+                playtime_hours FLOAT,
+                last_played FLOAT,
+                achievement_progress FLOAT,
+                reviews_percent FLOAT,
+                description TEXT,
+                storyline TEXT,
+                platforms TEXT,
+                tags TEXT,
+                personal_rating FLOAT
+            );
+            """
+        )
+    )
+    conn.execute(text("""CREATE INDEX IF NOT EXISTS ix_games_data_steam_appid ON games_data (steam_appid);"""))
+    conn.execute(text("""CREATE INDEX IF NOT EXISTS ix_games_data_ps_np_title_id ON games_data (ps_np_title_id);"""))
+
+
+def games_data_outdated(conn):
+    """
+    Whether games_data exists but was created with a different set of columns, so it
+    needs a rebuild instead of a refresh of changed rows
+    """
+    if not table_exists(conn, 'games_data'):
+        return False
+    columns = [row[1] for row in conn.execute(text("""PRAGMA table_info(games_data);"""))]
+    return columns != GAMES_DATA_COLUMNS
+
+
+def refresh_games_data(conn, igdb_ids=None, stats=None):
+    """
+    Rebuild games_data rows from id_mapping, igdb_data, steam_library/steam_wishlist,
+    ps_played_titles and personal_ratings
+
+    Parameters
+    ----------
+    igdb_ids : iterable, optional
+        Only refresh these ids (plus dropping ids no longer in id_mapping). Everything
+        is refreshed when None.
+    """
+    create_games_data_tables(conn)
+    start = time.time()
+
+    if igdb_ids is None:
+        conn.execute(text("""DELETE FROM games_data;"""))
+        result = conn.execute(text(f"""INSERT INTO games_data {GAMES_DATA_QUERY.format(ids_filter='')};"""))
+        if stats is not None:
+            stats.record('games_data', result.rowcount, time.time() - start)
+        return
+
+    conn.execute(text("""DROP TABLE IF EXISTS temp.games_data_refresh;"""))
+    conn.execute(text("""CREATE TEMP TABLE games_data_refresh (igdb_id INT PRIMARY KEY);"""))
+    refresh_ids = [{'igdb_id': int(igdb_id)} for igdb_id in set(igdb_ids)]
+    if refresh_ids:
+        conn.execute(text("""INSERT INTO temp.games_data_refresh (igdb_id) VALUES (:igdb_id);"""), refresh_ids)
+
+    conn.execute(text("""DELETE FROM games_data WHERE igdb_id NOT IN (SELECT igdb_id FROM id_mapping WHERE igdb_id IS NOT NULL);"""))
+    conn.execute(text("""DELETE FROM games_data WHERE igdb_id IN (SELECT igdb_id FROM temp.games_data_refresh);"""))
+    result = conn.execute(
+        text(
+            f"""INSERT INTO games_data {GAMES_DATA_QUERY.format(ids_filter='AND igdb_id IN (SELECT igdb_id FROM temp.games_data_refresh)')};"""
+        )
+    )
+    conn.execute(text("""DROP TABLE temp.games_data_refresh;"""))
+    if stats is not None:
+        stats.record('games_data', result.rowcount, time.time() - start)
+
+
+def create_checkpoint_table(conn):
+    """
+    Create update_checkpoint, update_db progress that outlives a failed run
+
+    Rows are (stage, item) => status ('done' or 'failed') and a JSON value, e.g. a
+    resolved igdb_id, a fetched record or an error.
+    """
+    conn.execute(
+        text(
+            """
+            CREATE TABLE IF NOT EXISTS update_checkpoint (
+                stage TEXT NOT NULL,
+                item TEXT NOT NULL,
+                status TEXT NOT NULL,
+                value TEXT,
+                updated FLOAT,
+                PRIMARY KEY (stage, item)
+            );
+            """
+        )
+    )
+
+
+def save_checkpoints(conn, stage, items, status='done'):
+    """
+    Insert/replace checkpoints of stage
+
+    Parameters
+    ----------
+    conn : sqlalchemy.engine.Connection
+    stage : str
+    items : dict
+        item => JSON serializable value. Items are stored as strings.
+    status : str
+        'done' or 'failed'
+    """
+    if not items:
+        return
+
+    now = time.time()
+    conn.execute(
+        text(
+            """
+            INSERT INTO update_checkpoint (stage, item, status, value, updated) VALUES (:stage, :item, :status, :value, :updated)
+            ON CONFLICT (stage, item) DO UPDATE SET status = excluded.status, value = excluded.value, updated = excluded.updated;
+            """
+        ),
+        [{'stage': stage, 'item': str(item), 'status': status, 'value': json.dumps(value), 'updated': now} for item, value in items.items()]
+    )
+
+
+def load_checkpoints(conn, stage, status='done'):
+    """
+    Returns
+    -------
+    dict
+        item (str) => value of every checkpoint of stage with status
+    """
+    if not table_exists(conn, 'update_checkpoint'):
+        return {}
+
+    rows = conn.execute(
+        text("""SELECT item, value FROM update_checkpoint WHERE stage = :stage AND status = :status;"""),
+        {'stage': stage, 'status': status}
+    )
+    return {item: json.loads(value) for item, value in rows}
+
+
+def clear_checkpoints(conn, stage=None, keep_failed=False):
+    """
+    Forget checkpoints, e.g. after a run finished
+
+    Parameters
+    ----------
+    stage : str, optional
+        Only forget this stage's checkpoints
+    keep_failed : bool
+        Keep failed items, so a run that finished with item failures can still be
+        resumed to retry them
+    """
+    if not table_exists(conn, 'update_checkpoint'):
+        return
+    query = """DELETE FROM update_checkpoint WHERE 1"""
+    params = {}
+    if stage is not None:
+        query += """ AND stage = :stage"""
+        params['stage'] = stage
+    if keep_failed:
+        query += """ AND status != 'failed'"""
+    conn.execute(text(query + ';'), params)
+
+
+def create_predictions_table(conn):
+    """
+    Create predictions, personal_rating predicted by a model artifact for every unrated
+    games_data row
+
+    row_hash is the features.row_hashes hash of the row when it was scored, so rows are
+    only scored again when they change or the model does.
+    """
+    conn.execute(
+        text(
+            """
+            CREATE TABLE IF NOT EXISTS predictions (
+                igdb_id INT NOT NULL UNIQUE,
+                pred FLOAT,
+                model_version TEXT NOT NULL,
+                row_hash TEXT NOT NULL,
+                scored FLOAT
+            );
+            """
+        )
+    )
+
+
+def get_prediction_hashes(conn, model_version):
+    """
+    Returns
+    -------
+    dict
+        igdb_id => row_hash of every prediction made by model_version
+    """
+    rows = conn.execute(text("""SELECT igdb_id, row_hash FROM predictions WHERE model_version = :model_version;"""), {'model_version': model_version})
+    return {igdb_id: row_hash for igdb_id, row_hash in rows}
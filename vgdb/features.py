@@ -0,0 +1,354 @@
+import ast
+import hashlib
+from itertools import islice
+import json
+import pathlib
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sklearn.feature_extraction.text import HashingVectorizer
+
+FEATURE_CACHE_PATH = pathlib.Path.home() / ".vgdb" / "features"
+FEATURES_VERSION = 2  # Bump when build_features changes, so stale caches are rebuilt
+
+NUMERIC_FEATURES = ['playtime_hours', 'achievement_progress', 'reviews_percent']
+LABEL_FEATURES = ['platforms', 'tags']  # Stored list strings, multi-hot encoded
+TEXT_FEATURES = ['description', 'storyline']  # Free text, hashed word n-grams
+
+TEXT_N_FEATURES = 2 ** 14  # Hashed columns per text column
+TEXT_CHUNK_SIZE = 1000  # Texts hashed at once
+
+
+def clean_label(label):
+    """
+    Lowercase a platform/tag name and strip punctuation that varies between sources
+    """
+    return label.lower().replace('/', ' ').replace('(', '').replace(')', '').replace('\'', '').replace(',', '').replace('<', '').replace('>', '').replace(':', '').replace('[', '').replace(']', '')
+
+
+def parse_labels(values):
+    """
+    Stored list strings (e.g. "['Action', 'RPG']") to lists of cleaned, distinct labels
+
+    Parameters
+    ----------
+    values : iterable
+        Strings as stored in games_data. Nulls and anything that isn't a list become [].
+
+    Returns
+    -------
+    list of lists
+    """
+    labels = []
+    for value in values:
+        value = ast.literal_eval(value) if isinstance(value, str) else value
+        labels.append(sorted({clean_label(label) for label in value}) if isinstance(value, list) else [])
+
+    return labels
+
+
+def decode_labels(codes, vocabulary):
+    """
+    Integer coded labels (see db.get_games_data_label_codes) to lists of cleaned,
+    distinct labels, the same lists parse_labels returns for the stored list strings
+
+    Every vocabulary name is cleaned once instead of once per row it's on.
+
+    Parameters
+    ----------
+    codes : list of np.arrays
+        Vocabulary ids of every row
+    vocabulary : dict
+        Vocabulary id => name
+
+    Returns
+    -------
+    list of lists
+    """
+    names = {id: clean_label(name) for id, name in vocabulary.items()}
+    return [sorted({names[id] for id in row.tolist()}) for row in codes]
+
+
+def multi_hot(labels, vocabulary=None):
+    """
+    Multi-hot encode label lists into a sparse matrix in one vectorized pass
+
+    Parameters
+    ----------
+    labels : list of lists
+        Labels of every row
+    vocabulary : list, optional
+        Column order. Defaults to every label seen, sorted. Labels not in a given
+        vocabulary are dropped, so matrices encoded with the same vocabulary line up.
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        (len(labels), len(vocabulary)) float32, 1 where the row has the label
+    list
+        Vocabulary, the label of every column
+    """
+    exploded = pd.Series(labels, dtype=object).explode()
+    if vocabulary is None:
+        vocabulary = sorted(exploded.dropna().unique())
+
+    cols = pd.Categorical(exploded.values, categories=vocabulary).codes
+    rows = exploded.index.values[cols >= 0]
+    cols = cols[cols >= 0]
+
+    X = sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.float32), (rows, cols)),
+        shape=(len(labels), len(vocabulary))
+    )
+    X.data[:] = 1  # A label repeated within a row still counts once
+
+    return X, list(vocabulary)
+
+
+def hashed_text_features(texts, n_features=TEXT_N_FEATURES, chunk_size=TEXT_CHUNK_SIZE):
+    """
+    Hashed word unigram/bigram counts of texts, l2 normalized
+
+    Texts are hashed chunk_size at a time and there's no vocabulary, so memory only
+    grows with the output matrix, not with the number of distinct n-grams.
+
+    Parameters
+    ----------
+    texts : iterable of str
+        Anything that isn't a string (null) is hashed as an empty text
+    n_features : int
+        Columns. n-grams that hash to the same column are summed.
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        (len(texts), n_features) float32
+    """
+    vectorizer = HashingVectorizer(n_features=n_features, ngram_range=(1, 2), stop_words='english', alternate_sign=False, dtype=np.float32)
+    texts = iter(texts)
+    blocks = []
+    chunk = list(islice(texts, chunk_size))
+    while chunk:
+        blocks.append(vectorizer.transform([text if isinstance(text, str) else '' for text in chunk]))
+        chunk = list(islice(texts, chunk_size))
+
+    return sparse.vstack(blocks, format='csr') if blocks else sparse.csr_matrix((0, n_features), dtype=np.float32)
+
+
+def build_features(df, previous=None, vocabularies=None, previous_text=None, label_codes=None):
+    """
+    Feature matrix of games_data rows
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        games_data indexed by igdb_id
+    previous : dict, optional
+        igdb_id => {'platforms': [...], 'tags': [...]} already parsed labels to reuse
+        instead of parsing those rows' list columns again
+    vocabularies : dict, optional
+        Vocabulary of every LABEL_FEATURES column to encode with, e.g. a trained model's,
+        so columns line up with it. Labels outside them are dropped. Defaults to every
+        label seen.
+    previous_text : scipy.sparse.csr_matrix, optional
+        Already hashed TEXT_FEATURES columns of previous, one row per entry in the
+        order of previous. Every row's text is hashed when None.
+    label_codes : dict, optional
+        Integer coded LABEL_FEATURES columns from db.get_games_data_label_codes. Every
+        row's labels are decoded from these instead of parsed from df's list strings.
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        NUMERIC_FEATURES, then platforms_* and tags_* multi-hot columns, then
+        description_hash_* and storyline_hash_* columns, one row per df row
+    dict
+        Vocabulary of every LABEL_FEATURES column
+    """
+    previous = previous or {}
+    X_numeric = sparse.csr_matrix(df[NUMERIC_FEATURES].fillna(0).values.astype(np.float32))
+
+    blocks = [X_numeric]
+    vocabularies = dict(vocabularies or {})
+    reparse = [i for i, igdb_id in enumerate(df.index) if igdb_id not in previous]
+    for col in LABEL_FEATURES:
+        if label_codes is not None:
+            labels = decode_labels(*label_codes[col])
+        else:
+            parsed = dict(zip(reparse, parse_labels(df[col].values[reparse])))
+            labels = [parsed[i] if i in parsed else previous[igdb_id][col] for i, igdb_id in enumerate(df.index)]
+        X_labels, vocabularies[col] = multi_hot(labels, vocabularies.get(col))
+        blocks.append(X_labels)
+
+    if previous_text is None:
+        reparse = list(range(len(df)))
+    X_text = sparse.hstack([hashed_text_features(df[col].values[reparse]) for col in TEXT_FEATURES], format='csr')
+    if len(reparse) < len(df):
+        # Previously hashed rows fill in the rest, then rows are put back in df's order
+        previous_rows = {igdb_id: i for i, igdb_id in enumerate(previous)}
+        reparsed = set(reparse)
+        kept = [i for i in range(len(df)) if i not in reparsed]
+        X_text = sparse.vstack([X_text, previous_text[[previous_rows[df.index[i]] for i in kept]]], format='csr')
+        X_text = X_text[np.argsort(reparse + kept, kind='stable')]
+    blocks.append(X_text)
+
+    return sparse.hstack(blocks, format='csr'), vocabularies
+
+
+def feature_names(vocabularies):
+    """
+    Column names of build_features' matrix
+    """
+    return (
+        NUMERIC_FEATURES
+        + [f'{col}_{label}' for col in LABEL_FEATURES for label in vocabularies[col]]
+        + [f'{col}_hash_{i}' for col in TEXT_FEATURES for i in range(TEXT_N_FEATURES)]
+    )
+
+
+def row_hashes(df):
+    """
+    uint64 hash of every row's igdb_id and feature source columns
+
+    Columns are cast to float/object first so a row hashes the same whatever dtype
+    pandas inferred for the whole column.
+    """
+    columns = df[NUMERIC_FEATURES].astype(np.float64).join(df[LABEL_FEATURES + TEXT_FEATURES].astype(object))
+    return pd.util.hash_pandas_object(columns, index=True).values
+
+
+class FeatureCache():
+    """
+    On-disk cache of build_features' output, keyed by a fingerprint of games_data
+
+    The CSR arrays, igdb_id index and per-row hashes are stored as .npy files and
+    memory-mapped on load, next to a meta.json holding the fingerprint and
+    vocabularies. When the fingerprint doesn't match, rows whose hash is unchanged
+    reuse their cached labels and hashed text, and only new/changed rows are parsed
+    and hashed again.
+
+    Attributes
+    ----------
+    path : pathlib.Path
+        Cache directory (default ~/.vgdb/features)
+    """
+
+    ARRAYS = ['data', 'indices', 'indptr', 'index', 'row_hashes']
+
+    def __init__(self, path=FEATURE_CACHE_PATH):
+        self.path = pathlib.Path(path)
+
+    def load(self):
+        """
+        Returns
+        -------
+        dict
+            fingerprint, vocabularies, X (memory-mapped csr_matrix), index and
+            row_hashes, None if there's no (readable) cache
+        """
+        try:
+            with open(self.path / 'meta.json') as f:
+                meta = json.load(f)
+            arrays = {name: np.load(self.path / f'{name}.npy', mmap_mode='r') for name in self.ARRAYS}
+        except (OSError, ValueError):
+            return None
+        if meta.get('version') != FEATURES_VERSION:
+            return None
+
+        X = sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=tuple(meta['shape']), copy=False)
+        return {
+            'fingerprint': meta['fingerprint'],
+            'vocabularies': meta['vocabularies'],
+            'X': X,
+            'index': arrays['index'],
+            'row_hashes': arrays['row_hashes']
+        }
+
+    def save(self, fingerprint, X, vocabularies, index, hashes):
+        """
+        Replace the cache. Written to a temporary directory first so a reader never
+        sees a half written cache.
+        """
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        shutil.rmtree(tmp, ignore_errors=True)
+        tmp.mkdir(parents=True)
+
+        arrays = {'data': X.data, 'indices': X.indices, 'indptr': X.indptr, 'index': np.asarray(index), 'row_hashes': hashes}
+        for name, array in arrays.items():
+            np.save(tmp / f'{name}.npy', array)
+        with open(tmp / 'meta.json', 'w') as f:
+            json.dump({'version': FEATURES_VERSION, 'fingerprint': fingerprint, 'shape': list(X.shape), 'vocabularies': vocabularies}, f)
+
+        shutil.rmtree(self.path, ignore_errors=True)
+        tmp.rename(self.path)
+
+    @staticmethod
+    def cached_rows(cached, igdb_ids):
+        """
+        Labels and hashed text of igdb_ids from a loaded cache's matrix
+
+        Returns
+        -------
+        dict
+            igdb_id => {'platforms': [...], 'tags': [...]}
+        scipy.sparse.csr_matrix
+            TEXT_FEATURES columns, one row per igdb_id in the order of the dict
+        """
+        rows = [(i, igdb_id) for i, igdb_id in enumerate(cached['index'].tolist()) if igdb_id in igdb_ids]
+        labels = {igdb_id: {} for _, igdb_id in rows}
+        offset = len(NUMERIC_FEATURES)
+        for col in LABEL_FEATURES:
+            vocabulary = cached['vocabularies'][col]
+            X = cached['X'][:, offset:offset+len(vocabulary)].tocsr()
+            for i, igdb_id in rows:
+                labels[igdb_id][col] = [vocabulary[j] for j in X.indices[X.indptr[i]:X.indptr[i+1]]]
+            offset += len(vocabulary)
+
+        return labels, cached['X'][[i for i, _ in rows], offset:]
+
+
+def cached_features(df, cache=None, label_codes=None):
+    """
+    build_features(df), loaded from cache when games_data hasn't changed since it was
+    last built and incrementally rebuilt (only new/changed rows parsed and hashed) when
+    it has
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        games_data indexed by igdb_id
+    cache : FeatureCache, optional
+        Defaults to FeatureCache()
+    label_codes : dict, optional
+        See build_features
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+    dict
+        Vocabularies, see build_features
+    """
+    cache = cache or FeatureCache()
+    start = time.time()
+    hashes = row_hashes(df)
+    fingerprint = hashlib.sha1(hashes.tobytes()).hexdigest()
+
+    cached = cache.load()
+    if cached is not None and cached['fingerprint'] == fingerprint:
+        print(f'Features: {cached["X"].shape[0]} rows from cache [{time.time()-start:.2f} seconds]')
+        return cached['X'], cached['vocabularies']
+
+    previous, previous_text = {}, None
+    if cached is not None:
+        current = dict(zip(df.index.tolist(), hashes.tolist()))
+        unchanged = {igdb_id for igdb_id, h in zip(cached['index'].tolist(), cached['row_hashes'].tolist()) if current.get(igdb_id) == h}
+        previous, previous_text = FeatureCache.cached_rows(cached, unchanged)
+
+    X, vocabularies = build_features(df, previous, previous_text=previous_text, label_codes=label_codes)
+    cache.save(fingerprint, X, vocabularies, df.index.values, hashes)
+    print(f'Features: {X.shape[0]} rows, {X.shape[0] - len(previous)} featurized [{time.time()-start:.2f} seconds]')
+
+    return X, vocabularies
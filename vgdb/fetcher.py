@@ -0,0 +1,164 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import random
+import threading
+import time
+from urllib.parse import urlparse, urlunparse
+
+import requests
+
+from cache import CacheMiss
+from ratelimit import TokenBucket
+
+
+def rewrite_url(url, base_url=None):
+    """
+    Point url at base_url, e.g. a mock_server.MockServer, keeping the original host as
+    the first path segment
+
+    https://store.steampowered.com/app/10 with base_url http://127.0.0.1:8000 becomes
+    http://127.0.0.1:8000/store.steampowered.com/app/10. url is returned as is when
+    base_url is None.
+    """
+    if base_url is None:
+        return url
+    parsed = urlparse(url)
+    base = urlparse(base_url)
+    return urlunparse((base.scheme, base.netloc, f'{base.path.rstrip("/")}/{parsed.netloc}{parsed.path}', parsed.params, parsed.query, parsed.fragment))
+
+
+def retry_delay(attempt, backoff, max_backoff, retry_after=None):
+    """
+    Seconds to wait before retry attempt + 1: Retry-After when the server sent one,
+    otherwise exponential backoff with full jitter
+    """
+    if retry_after and retry_after.isdigit():
+        return min(float(retry_after), max_backoff)
+    return random.uniform(0, min(backoff * 2 ** attempt, max_backoff))
+
+
+class Fetcher():
+    """
+    Bounded thread pool for HTTP GETs with per-host rate limits and retries
+
+    Throttling (429) and server errors (5xx) are retried with exponential backoff and
+    full jitter, honoring Retry-After when the server sends one.
+
+    Attributes
+    ----------
+    max_workers : int
+        Max concurrent requests
+    rates : dict
+        host => max requests/sec. Hosts not listed aren't rate limited.
+    max_retries : int
+        Retries after the first attempt
+    backoff : float
+        Base backoff in seconds, doubled every retry
+    max_backoff : float
+        Cap on a single backoff sleep
+    cache : cache.ResponseCache, optional
+        Response cache shared between runs
+    base_url : str, optional
+        Send requests here instead (see rewrite_url). Rate limits and cache keys still
+        go by the original url.
+    request_counts : collections.Counter
+        host => requests sent over the network, retries included (cache hits aren't)
+    """
+
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, max_workers=8, rates=None, max_retries=5, backoff=1.0, max_backoff=60.0, cache=None, base_url=None):
+        self.max_workers = max_workers
+        self.rates = rates or {}
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.cache = cache
+        self.base_url = base_url
+
+        self.session = requests.Session()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._limiters = {}
+        self._limiters_lock = threading.Lock()
+        self.request_counts = Counter()
+        self._counts_lock = threading.Lock()
+
+    def submit(self, url, ttl=None, **kwargs):
+        """
+        Async GET url
+
+        Parameters
+        ----------
+        url : str
+        ttl : int, optional
+            Seconds to keep the response in the cache
+        **kwargs
+            Passed to requests.Session.get
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Resolves to the final response after retries. Raises the last network error
+            if every attempt failed to connect.
+        """
+        return self._executor.submit(self.get, url, ttl, **kwargs)
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Run fn (which may make several self.get calls) on the pool
+
+        Returns
+        -------
+        concurrent.futures.Future
+        """
+        return self._executor.submit(fn, *args, **kwargs)
+
+    def get(self, url, ttl=None, **kwargs):
+        """
+        GET url with rate limiting, retries and caching
+        """
+        if self.cache is not None:
+            key = self.cache.key('GET', url)
+            response = self.cache.get(key)
+            if response is not None:
+                return response
+            if self.cache.offline:
+                raise CacheMiss(url)
+
+        host = urlparse(url).netloc
+        limiter = self._limiter(host)
+        for attempt in range(self.max_retries + 1):
+            if limiter is not None:
+                limiter.acquire()
+            with self._counts_lock:
+                self.request_counts[host] += 1
+            try:
+                response = self.session.get(rewrite_url(url, self.base_url), **kwargs)
+            except requests.RequestException:
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self._delay(attempt))
+                continue
+
+            if response.status_code not in self.RETRY_STATUS or attempt == self.max_retries:
+                break
+            time.sleep(self._delay(attempt, response))
+
+        if self.cache is not None and ttl is not None:
+            self.cache.set(key, response, ttl)
+
+        return response
+
+    def _limiter(self, host):
+        """Shared TokenBucket for host, or None if host isn't rate limited"""
+        if host not in self.rates:
+            return None
+        with self._limiters_lock:
+            if host not in self._limiters:
+                self._limiters[host] = TokenBucket(self.rates[host])
+            return self._limiters[host]
+
+    def _delay(self, attempt, response=None):
+        """Seconds to wait before retrying"""
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        return retry_delay(attempt, self.backoff, self.max_backoff, retry_after)
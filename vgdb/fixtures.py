@@ -0,0 +1,263 @@
+"""
+Synthetic Steam, Playstation and IGDB responses recorded into a ResponseCache
+
+The responses are stored under the exact requests the clients make, so clients built
+on an offline cache (see fixture_clients) replay a library of any size without
+touching the network, e.g. for benchmarks. mock_server serves the same synthetic
+accounts over HTTP.
+"""
+import json
+import random
+
+from cache import CachedResponse, TTL_IGDB, TTL_PLAYTIME, TTL_STORE_PAGE, TTL_WISHLIST
+from igdb_async import AsyncIGDBClient
+from ps_api import PlaystationClient
+from steam_api import SteamClient
+
+# Fake credentials the fixture requests are recorded with
+FIXTURE_STEAM_ACCOUNT = ('fixture', '76561190000000000', 'fixture')
+FIXTURE_PS_NPSSO = 'fixture'
+FIXTURE_IGDB_ACCOUNT = ('fixture', 'fixture')
+
+WISHLIST_PAGE_SIZE = 100  # Games per Steam wishlist page
+
+TAGS = [f'Tag {i}' for i in range(400)]
+GENRES = [f'Genre {i}' for i in range(25)]
+PLATFORMS = ['PC (Microsoft Windows)', 'PlayStation 4', 'PlayStation 5', 'Nintendo Switch', 'Xbox One', 'Linux', 'Mac']
+WORDS = [f'word{i}' for i in range(5000)]
+
+
+def fixture_clients(cache=None, base_url=None):
+    """
+    Steam, Playstation and async IGDB clients with the fixture credentials, optionally
+    pointed at a mock_server.MockServer
+
+    Returns
+    -------
+    steam_api.SteamClient
+    ps_api.PlaystationClient
+    igdb_async.AsyncIGDBClient
+    """
+    return (
+        SteamClient(*FIXTURE_STEAM_ACCOUNT, cache=cache, base_url=base_url),
+        PlaystationClient(FIXTURE_PS_NPSSO, cache=cache, base_url=base_url),
+        AsyncIGDBClient(*FIXTURE_IGDB_ACCOUNT, cache=cache, base_url=base_url)
+    )
+
+
+def store_page_html(rng):
+    """
+    Minimal Steam store page with what parse_store_page reads
+    """
+    recent, all_reviews = rng.randint(0, 100), rng.randint(0, 100)
+    tags = ''.join(f'<a class="app_tag" href="#">\n\t\t{tag}\t\t</a>' for tag in rng.sample(TAGS, 20))
+    return f"""<html><body>
+        <div class="game_description_snippet">\r\n\t{' '.join(rng.choices(WORDS, k=rng.randint(20, 60)))}\t</div>
+        <span class="nonresponsive_hidden responsive_reviewdesc">- {recent}% of the {rng.randint(10, 5000):,} user reviews in the last 30 days are positive.</span>
+        <span class="nonresponsive_hidden responsive_reviewdesc">- {all_reviews}% of the {rng.randint(100, 500000):,} user reviews for this game are positive.</span>
+        <div class="glance_tags popular_tags">{tags}</div>
+    </body></html>"""
+
+
+def synthetic_account(n_games, seed=0):
+    """
+    A synthetic account: a Steam library of n_games, a wishlist of n_games / 4 other
+    games, n_games / 4 played PSN titles and IGDB data for all of them
+
+    Returns
+    -------
+    dict
+        library : list of dicts
+            GetOwnedGames games
+        achievements : dict
+            steam_appid => GetPlayerAchievements achievements
+        wishlist : list of dicts
+            steam_appid and name of every wishlist game, in wishlist order
+        store_pages : dict
+            steam_appid => store page html, for library and wishlist games
+        ps_titles : list of dicts
+            PSN gamelist titles
+        trophy_titles : dict
+            titleId => trophyTitles entry
+        igdb_games : list of dicts
+            IGDB games (every GAME_FIELDS field, alternative_names and
+            total_rating_count), library and wishlist games first, then PSN titles
+        external_games : list of dicts
+            IGDB Steam external_games (id, game, uid) linking every Steam game
+    """
+    rng = random.Random(seed)
+
+    library = [
+        {
+            'appid': 10 * (i + 1),
+            'name': f'Steam Game {i}',
+            'playtime_forever': rng.choice([0, rng.randint(1, 10000)]),
+            'rtime_last_played': rng.randint(1400000000, 1700000000)
+        }
+        for i in range(n_games)
+    ]
+    achievements = {
+        game['appid']: [{'apiname': f'ach{j}', 'achieved': rng.randint(0, 1)} for j in range(rng.randint(1, 60))]
+        for game in library
+    }
+    wishlist = [{'steam_appid': 10 * (n_games + i + 1), 'name': f'Steam Game {n_games + i}'} for i in range(n_games // 4)]
+    steam_appids = [game['appid'] for game in library] + [game['steam_appid'] for game in wishlist]
+    store_pages = {appid: store_page_html(rng) for appid in steam_appids}
+
+    ps_titles = [
+        {
+            'titleId': f'PPSA{i:05d}_00',
+            'name': f'PS Game {i}',
+            'category': rng.choice(['ps4_game', 'ps5_native_game']),
+            'playDuration': f'PT{rng.randint(0, 200)}H{rng.randint(0, 59)}M{rng.randint(0, 59)}S',
+            'firstPlayedDateTime': '2021-01-01T00:00:00.000Z',
+            'lastPlayedDateTime': f'2023-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T12:00:00.000Z',
+            'concept': {'genres': rng.sample(GENRES, 2)}
+        }
+        for i in range(n_games // 4)
+    ]
+
+    def trophies(count):
+        return {grade: rng.randint(0, count) for grade in ['bronze', 'silver', 'gold', 'platinum']}
+
+    trophy_titles = {
+        title['titleId']: {'npCommunicationId': f'NPWR{title["titleId"][4:9]}_00', 'progress': rng.randint(0, 100), 'earnedTrophies': trophies(5), 'definedTrophies': trophies(40)}
+        for title in ps_titles
+    }
+
+    names = [f'Steam Game {i}' for i in range(len(steam_appids))] + [title['name'] for title in ps_titles]
+    igdb_games = []
+    for igdb_id, name in enumerate(names, 1):
+        igdb_games.append({
+            'id': igdb_id,
+            'name': name,
+            'alternative_names': [],
+            'first_release_date': rng.randint(900000000, 1700000000),
+            'platforms': [{'id': j, 'name': platform} for j, platform in enumerate(rng.sample(PLATFORMS, rng.randint(1, 3)))],
+            'genres': [{'id': j, 'name': genre} for j, genre in enumerate(rng.sample(GENRES, 2))],
+            'themes': [{'id': 1, 'name': 'Fantasy'}],
+            'keywords': [{'id': j, 'name': word} for j, word in enumerate(rng.sample(WORDS, 5))],
+            'rating': rng.random() * 100,
+            'rating_count': rng.randint(0, 2000),
+            'aggregated_rating': rng.random() * 100,
+            'aggregated_rating_count': rng.randint(0, 100),
+            'total_rating_count': rng.randint(0, 2100),
+            'summary': ' '.join(rng.choices(WORDS, k=rng.randint(20, 120))),
+            'storyline': ' '.join(rng.choices(WORDS, k=rng.randint(0, 80)))
+        })
+    external_games = [{'id': i, 'game': igdb_id, 'uid': str(appid)} for i, (igdb_id, appid) in enumerate(zip(range(1, len(steam_appids) + 1), steam_appids))]
+
+    return {
+        'library': library,
+        'achievements': achievements,
+        'wishlist': wishlist,
+        'store_pages': store_pages,
+        'ps_titles': ps_titles,
+        'trophy_titles': trophy_titles,
+        'igdb_games': igdb_games,
+        'external_games': external_games
+    }
+
+
+def wishlist_page(games):
+    """
+    wishlistdata response body for account['wishlist'] entries
+    """
+    return {str(game['steam_appid']): {'name': game['name']} for game in games}
+
+
+def trophy_titles_response(account, np_title_ids):
+    """
+    trophyTitles response body for np_title_ids
+    """
+    return {
+        'titles': [
+            {'npTitleId': np_title_id, 'trophyTitles': [account['trophy_titles'][np_title_id]] if np_title_id in account['trophy_titles'] else []}
+            for np_title_id in np_title_ids
+        ]
+    }
+
+
+def _record(cache, key, body, ttl):
+    """
+    Store body (a str as is, anything else as JSON) as a 200 response under key
+    """
+    content = body if isinstance(body, str) else json.dumps(body)
+    cache.set(key, CachedResponse(200, content.encode('utf-8')), ttl)
+
+
+def _record_get(cache, url, body, ttl):
+    _record(cache, cache.key('GET', url), body, ttl)
+
+
+def record_steam(cache, client, account):
+    """
+    Record account's Steam library (achievements and store pages included) and wishlist
+    """
+    library = account['library']
+    _record_get(cache, client._library_url(), {'response': {'game_count': len(library), 'games': library}}, TTL_PLAYTIME)
+    for appid, achievements in account['achievements'].items():
+        _record_get(cache, client._achievements_url(appid), {'playerstats': {'success': True, 'achievements': achievements}}, TTL_PLAYTIME)
+
+    wishlist = account['wishlist']
+    pages = [wishlist[i:i+WISHLIST_PAGE_SIZE] for i in range(0, len(wishlist), WISHLIST_PAGE_SIZE)]
+    for page, games in enumerate(pages):
+        _record_get(cache, client._wishlist_url(page), wishlist_page(games), TTL_WISHLIST)
+    # The end, plus the pages requested speculatively past it
+    for page in range(len(pages), len(pages) + max(client.wishlist_window, 1)):
+        _record_get(cache, client._wishlist_url(page), [], TTL_WISHLIST)
+
+    for appid, page in account['store_pages'].items():
+        _record_get(cache, client._store_page_url(appid), page, TTL_STORE_PAGE)
+
+
+def record_ps(cache, client, account):
+    """
+    Record account's played PSN titles and their trophies
+    """
+    titles = account['ps_titles']
+    for offset in range(0, max(len(titles), 1), client.TITLES_PAGE_SIZE):
+        _record_get(cache, client._titles_url(offset), {'titles': titles[offset:offset+client.TITLES_PAGE_SIZE], 'totalItemCount': len(titles)}, TTL_PLAYTIME)
+
+    for batch in client._trophy_batches([{'ps_np_title_id': title['titleId']} for title in titles]):
+        _record_get(cache, client._trophies_url(batch), trophy_titles_response(account, [title['ps_np_title_id'] for title in batch]), TTL_PLAYTIME)
+
+
+def record_igdb(cache, client, account):
+    """
+    Record account's IGDB games and the external_games lookups mapping its Steam games
+    to them
+    """
+    # Cached per steam_appid, see IGDBClient._api_request_each
+    for external_game in account['external_games']:
+        _record(cache, client._each_key('external_games', client._steam_external_games_query, int(external_game['uid'])), [external_game], TTL_IGDB)
+
+    games = account['igdb_games']
+    for i in range(0, len(games), client.MAX_LIMIT):
+        chunk = games[i:i+client.MAX_LIMIT]
+        _record(cache, cache.key('POST', 'games', client._games_query([game['id'] for game in chunk])), chunk, TTL_IGDB)
+
+
+def record_fixtures(cache, n_games, seed=0):
+    """
+    Record synthetic_account(n_games, seed) into cache
+
+    Parameters
+    ----------
+    cache : cache.ResponseCache
+        Offline, so building the clients the requests are recorded with doesn't fetch
+        any access token
+
+    Returns
+    -------
+    dict
+        The recorded account, see synthetic_account
+    """
+    account = synthetic_account(n_games, seed)
+    steam_client, ps_client, igdb_client = fixture_clients(cache)
+
+    record_steam(cache, steam_client, account)
+    record_ps(cache, ps_client, account)
+    record_igdb(cache, igdb_client, account)
+
+    return account
@@ -6,15 +6,170 @@ from fuzzywuzzy import fuzz
 from igdb.wrapper import IGDBWrapper
 import requests
 
+from cache import CacheMiss, CachedResponse, TTL_IGDB
+from fetcher import rewrite_url
+
+GAME_FIELDS = 'id, aggregated_rating, aggregated_rating_count, first_release_date, genres.name, keywords.name, name, platforms.name, rating, rating_count, storyline, summary, themes.name'
+
 class IGDBClient():
-    """Client class to provide specific api functions to IGDB Wrapper"""
+    """
+    Client class to provide specific api functions to IGDB Wrapper
+
+    Attributes
+    ----------
+    cache : cache.ResponseCache, optional
+        Response cache shared between runs
+    ratelimiter : context manager, optional
+        Entered around every network request
+    title_index : title_index.TitleIndex, optional
+        Local index get_igdb_id_by_title tries before a live search
+    base_url : str, optional
+        Send every request (including the Twitch token request) here instead, e.g. to
+        a mock_server.MockServer (see fetcher.rewrite_url)
+    """
+
+    API_URL = 'https://api.igdb.com/v4'
+    MAX_LIMIT = 500  # Max results (and ids per where clause) IGDB returns per request
+
+    def __init__(self, client_id: str, client_secret: str, cache=None, ratelimiter=None, title_index=None, base_url=None):
+        self.cache = cache
+        self.ratelimiter = ratelimiter
+        self.title_index = title_index
+        self.base_url = base_url
 
-    def __init__(self, client_id: str, client_secret: str):
         # Init wrapper
-        access_token = self._get_access_token(client_id, client_secret)
-        self._igdb_wrapper = IGDBWrapper(client_id, access_token)
+        self.client_id = client_id
+        self.access_token = self._get_access_token(client_id, client_secret)
+        self._igdb_wrapper = IGDBWrapper(self.client_id, self.access_token)
+
+    def _api_request(self, endpoint: str, query: str, use_cache: bool = True) -> bytes:
+        """
+        IGDB API request, served from the response cache when possible (and use_cache)
+        """
+        def fetch():
+            if self.ratelimiter is None:
+                return CachedResponse(200, self._post(endpoint, query))
+            with self.ratelimiter:
+                return CachedResponse(200, self._post(endpoint, query))
+
+        if self.cache is None or not use_cache:
+            return fetch().content
+        return self.cache.get_or_fetch(self.cache.key('POST', endpoint, query), TTL_IGDB, fetch).content
+
+    def _post(self, endpoint: str, query: str) -> bytes:
+        """
+        Send a query to the API (through the IGDB wrapper unless base_url overrides it)
+        """
+        if self.base_url is None:
+            return self._igdb_wrapper.api_request(endpoint, query)
+
+        r = requests.post(
+            rewrite_url(f'{self.API_URL}/{endpoint}', self.base_url),
+            headers={'Client-ID': self.client_id, 'Authorization': f'Bearer {self.access_token}'},
+            data=query
+        )
+        r.raise_for_status()
+        return r.content
+
+    def _api_request_all(self, endpoint: str, query: str, use_cache: bool = True) -> list:
+        """
+        Page through every result of a query, MAX_LIMIT results per request
+        """
+        results = []
+        offset = 0
+        while True:
+            byte_array = self._api_request(endpoint, self._page_query(query, offset), use_cache)
+            page = json.loads(byte_array)
+            results += page
+            if len(page) < self.MAX_LIMIT:
+                break
+            offset += self.MAX_LIMIT
+
+        return results
+
+    def _page_query(self, query: str, offset: int) -> str:
+        return f'{query} limit {self.MAX_LIMIT}; offset {offset};'
+
+    def _api_request_each(self, endpoint: str, query, ids: list, id_of) -> list:
+        """
+        Every result of query(ids), cached per id as if each id had been requested alone
+
+        Which ids get requested together depends on how callers batch them (e.g. the
+        order streamed batches arrive in), so caching whole chunks would give every run
+        new cache keys. Uncached ids are requested sorted, MAX_LIMIT per request, and the
+        response is split per id before caching.
+
+        Parameters
+        ----------
+        query : callable
+            ids => query
+        id_of : callable
+            result => the id it belongs to
+        """
+        results, missing = self._cached_each(endpoint, query, ids)
+        missing = sorted(set(missing))
+        for i in range(0, len(missing), self.MAX_LIMIT):
+            chunk = missing[i:i+self.MAX_LIMIT]
+            results.update(self._cache_each(endpoint, query, chunk, self._api_request_all(endpoint, query(chunk), use_cache=False), id_of))
+
+        return [result for id_ in dict.fromkeys(ids) for result in results.get(id_, [])]
+
+    def _each_key(self, endpoint: str, query, id_) -> str:
+        return self.cache.key('POST', endpoint, self._page_query(query([id_]), 0))
+
+    def _cached_each(self, endpoint: str, query, ids: list) -> tuple:
+        """
+        Cached per id results (see _api_request_each)
+
+        Returns
+        -------
+        dict
+            id => results
+        list
+            ids that aren't cached
+        """
+        if self.cache is None:
+            return {}, list(ids)
+
+        cached, missing = {}, []
+        for id_ in ids:
+            key = self._each_key(endpoint, query, id_)
+            response = self.cache.get(key)
+            if response is not None:
+                cached[id_] = json.loads(response.content)
+            elif self.cache.offline:
+                raise CacheMiss(key)
+            else:
+                missing.append(id_)
+
+        return cached, missing
+
+    def _cache_each(self, endpoint: str, query, ids: list, results: list, id_of) -> dict:
+        """
+        Split the results of query(ids) per id and cache them (see _api_request_each)
+
+        Returns
+        -------
+        dict
+            id => results
+        """
+        results_by_id = {id_: [] for id_ in ids}
+        for result in results:
+            if id_of(result) in results_by_id:
+                results_by_id[id_of(result)].append(result)
+        if self.cache is not None:
+            for id_, id_results in results_by_id.items():
+                self.cache.set(self._each_key(endpoint, query, id_), CachedResponse(200, json.dumps(id_results).encode('utf-8')), TTL_IGDB)
+
+        return results_by_id
 
     def _get_access_token(self, client_id: str, client_secret: str) -> str:
+        token_url = f"https://id.twitch.tv/oauth2/token?client_id={client_id}&client_secret={client_secret}&grant_type=client_credentials"
+
+        # Tokens from a base_url server (e.g. a mock) are never written over the real one
+        if self.base_url is not None:
+            return json.loads(requests.post(rewrite_url(token_url, self.base_url)).text)['access_token']
+
         token_path = pathlib.Path.home() / ".vgdb/"
         token_path.mkdir(parents=True, exist_ok=True)
         token_filepath = token_path / "igdb_token.json"
@@ -24,11 +179,15 @@ class IGDBClient():
         if token_filepath.exists():
             with open(token_filepath, 'r') as f:
                 access_json = json.load(f)
-            if access_json['expires'] > current_unix_time:
+            if access_json['expires'] > current_unix_time or (self.cache and self.cache.offline):
                 return access_json['access_token'] 
 
+        # Replayed responses don't need a (network fetched) token
+        if self.cache and self.cache.offline:
+            return ''
+
         # Get IGDB access token
-        r = requests.post(f"https://id.twitch.tv/oauth2/token?client_id={client_id}&client_secret={client_secret}&grant_type=client_credentials")
+        r = requests.post(token_url)
         access_json = json.loads(r.text)        
         access_json['expires'] = current_unix_time + access_json['expires_in'] - 1
 
@@ -42,14 +201,45 @@ class IGDBClient():
         """
         Get game metadata from IGDB ID
         """
-        byte_array = self._igdb_wrapper.api_request(
+        byte_array = self._api_request(
             'games',
             #f'fields *; where id = {igdb_id};'
-            f'fields id, aggregated_rating, aggregated_rating_count, first_release_date, genres.name, keywords.name, name, platforms.name, rating, rating_count, storyline, summary, themes.name; where id = {igdb_id};'
+            f'fields {GAME_FIELDS}; where id = {igdb_id};'
         )
         games_response = json.loads(byte_array)
-        igdb_metadata = games_response[0]
 
+        return self._process_game(games_response[0])
+
+    def get_games(self, igdb_ids: list) -> list:
+        """
+        Get game metadata for many IGDB IDs, MAX_LIMIT ids per request
+
+        Returns
+        -------
+        list of dicts
+            Records in the same order as igdb_ids. IDs IGDB doesn't know are left out.
+        """
+        igdb_ids = [int(igdb_id) for igdb_id in igdb_ids]
+
+        games_by_id = {}
+        for i in range(0, len(igdb_ids), self.MAX_LIMIT):
+            byte_array = self._api_request(
+                'games',
+                self._games_query(igdb_ids[i:i+self.MAX_LIMIT])
+            )
+            for game in json.loads(byte_array):
+                game = self._process_game(game)
+                games_by_id[game['igdb_id']] = game
+
+        return [games_by_id[igdb_id] for igdb_id in igdb_ids if igdb_id in games_by_id]
+
+    def _games_query(self, igdb_ids: list) -> str:
+        return f'fields {GAME_FIELDS}; where id = ({",".join(str(igdb_id) for igdb_id in igdb_ids)}); limit {self.MAX_LIMIT};'
+
+    def _process_game(self, igdb_metadata: dict) -> dict:
+        """
+        Fill missing fields with nulls, flatten expanded fields, rename and reorder a games response
+        """
         # Add nulls to response if missing
         fields = [
             'id',
@@ -109,7 +299,7 @@ class IGDBClient():
 
         # Search game's linked websites searching for ones with steam_appid
         search_string = f'/{steam_appid}'
-        byte_array = self._igdb_wrapper.api_request(
+        byte_array = self._api_request(
             'websites',
             f'fields *; where url = *"{search_string}"* & category = 13;'
         )
@@ -118,38 +308,154 @@ class IGDBClient():
         # More than 1 game has the same steam id website. Take the one with the most reviews or first released
         if len(websites_response) > 1:
             search_igdb_ids = str(tuple([r['game'] for r in websites_response]))
-            byte_array = self._igdb_wrapper.api_request(
+            byte_array = self._api_request(
                 'games',
                 f'fields *; where id = {search_igdb_ids} & category != (5, 6, 7);'  # No mods, episodes, or seasons
             )
             games_response = json.loads(byte_array)
 
-            for game in games_response:
-                if 'total_rating_count' not in game:
-                    game['total_rating_count'] = 0
-                if 'first_release_date' not in game:
-                    game['first_release_date'] = int(time.time())
-                game['first_release_date'] *= -1
-
-            igdb_id = int(sorted(games_response, key=lambda x: (x['total_rating_count'], x['first_release_date']), reverse=True)[0]['id'])
+            igdb_id = int(sorted(games_response, key=self._rating_rank, reverse=True)[0]['id'])
 
         elif len(websites_response) == 1:
             igdb_id = int(websites_response[0]['game'])
 
         return igdb_id
 
+    def get_igdb_ids_by_steam_appids(self, steam_appids: list) -> dict:
+        """
+        Get IGDB IDs for many Steam IDs using IGDB's Steam external_games, MAX_LIMIT ids per request
+
+        Uses the same tie-break as get_igdb_id_by_steam_appid when several games share a Steam ID.
+
+        Returns
+        -------
+        dict
+            steam_appid => igdb_id for the Steam IDs that resolved
+        """
+        steam_appids = [int(steam_appid) for steam_appid in steam_appids]
+
+        # Every game linked to each steam_appid
+        external_games_response = self._api_request_each('external_games', self._steam_external_games_query, steam_appids, self._external_game_uid)
+        candidates = self._steam_candidates(external_games_response)
+
+        # More than 1 game has the same steam id. Take the one with the most reviews or first released
+        duplicate_game_ids = sorted({game_id for game_ids in candidates.values() if len(game_ids) > 1 for game_id in game_ids})
+        games_response = self._api_request_each('games', self._rank_query, duplicate_game_ids, self._game_id)
+
+        return self._pick_steam_candidates(candidates, games_response)
+
+    @staticmethod
+    def _steam_external_games_query(steam_appids: list) -> str:
+        uids = ','.join(f'"{steam_appid}"' for steam_appid in steam_appids)
+        return f'fields game, uid; where category = 1 & uid = ({uids});'  # category 1 => Steam
+
+    @staticmethod
+    def _external_game_uid(external_game: dict) -> int:
+        return int(external_game['uid'])
+
+    @staticmethod
+    def _game_id(game: dict) -> int:
+        return game['id']
+
+    @staticmethod
+    def _rank_query(igdb_ids: list) -> str:
+        return f'fields id, total_rating_count, first_release_date; where id = ({",".join(str(igdb_id) for igdb_id in igdb_ids)}) & category != (5, 6, 7);'  # No mods, episodes, or seasons
+
+    @staticmethod
+    def _steam_candidates(external_games_response: list) -> dict:
+        """
+        steam_appid => set of every igdb_id linked to it
+        """
+        candidates = {}
+        for external_game in external_games_response:
+            if 'game' in external_game:
+                candidates.setdefault(int(external_game['uid']), set()).add(int(external_game['game']))
+
+        return candidates
+
+    def _pick_steam_candidates(self, candidates: dict, games_response: list) -> dict:
+        """
+        steam_appid => igdb_id, ranking duplicates with _rating_rank
+        """
+        ranks = {game['id']: self._rating_rank(game) for game in games_response}
+
+        igdb_ids = {}
+        for steam_appid, game_ids in candidates.items():
+            if len(game_ids) == 1:
+                igdb_ids[steam_appid] = next(iter(game_ids))
+                continue
+            ranked = sorted([game_id for game_id in game_ids if game_id in ranks], key=ranks.get, reverse=True)
+            if ranked:
+                igdb_ids[steam_appid] = ranked[0]
+
+        return igdb_ids
+
+    @staticmethod
+    def _rating_rank(game: dict) -> tuple:
+        """
+        Sort key preferring the most reviews, then the first released
+        """
+        return (game.get('total_rating_count', 0), -game.get('first_release_date', int(time.time())))
+
     def get_igdb_id_by_title(self, title: str) -> int:
         """
         Get IGDB ID using title
+
+        Matched offline against title_index when it has a confident match, otherwise
+        with a live search.
         """
-        # fields id, aggregated_rating, aggregated_rating_count, category.*, first_release_date, genres.*, keywords.*, name, rating, rating_count, storyline, summary, tags.*, themes.*, total_rating, total_rating_count;
-        search_string = title.replace('®', '').replace('™', '')
-        byte_array = self._igdb_wrapper.api_request(
+        if self.title_index is not None:
+            igdb_id = self.title_index.match(title)
+            if igdb_id is not None:
+                return igdb_id
+
+        byte_array = self._api_request(
             'games',
-            f'fields id, name; search "{search_string}"; limit 500;'
+            self._title_search_query(title)
         )
         games_response = json.loads(byte_array)
 
+        return self._best_title_match(title, games_response)
+
+    def get_title_dump(self, platforms: list = None) -> list:
+        """
+        Names of every game (on platforms), for building a title_index.TitleIndex
+
+        Returns
+        -------
+        list of dicts
+            id, name, alternative_names and total_rating_count
+        """
+        games = []
+        last_id = 0
+        while True:
+            page = json.loads(self._api_request('games', self._title_dump_query(last_id, platforms)))
+            games += page
+            if len(page) < self.MAX_LIMIT:
+                break
+            last_id = page[-1]['id']
+
+        return games
+
+    @classmethod
+    def _title_dump_query(cls, last_id: int, platforms: list = None) -> str:
+        # Paged on id rather than offset so pages stay cheap deep into the dump
+        where = f'id > {last_id}'
+        if platforms:
+            where += f' & platforms = ({",".join(str(platform) for platform in platforms)})'
+        return f'fields id, name, alternative_names.name, total_rating_count; where {where}; sort id asc; limit {cls.MAX_LIMIT};'
+
+    @staticmethod
+    def _title_search_query(title: str) -> str:
+        # fields id, aggregated_rating, aggregated_rating_count, category.*, first_release_date, genres.*, keywords.*, name, rating, rating_count, storyline, summary, tags.*, themes.*, total_rating, total_rating_count;
+        search_string = title.replace('®', '').replace('™', '')
+        return f'fields id, name; search "{search_string}"; limit 500;'
+
+    @staticmethod
+    def _best_title_match(title: str, games_response: list) -> int:
+        """
+        Fuzzy match best result from a search to the input title
+        """
         igdb_id = None
         if len(games_response) > 1:
             # Fuzzy match best result from search to input title
@@ -0,0 +1,283 @@
+import asyncio
+import json
+import threading
+
+import aiohttp
+from tqdm import tqdm
+
+from cache import CacheMiss, CachedResponse, TTL_IGDB
+from fetcher import Fetcher, retry_delay, rewrite_url
+from igdb_api import IGDBClient
+from ratelimit import TokenBucket
+
+
+class AsyncIGDBClient(IGDBClient):
+    """
+    asyncio version of IGDBClient
+
+    Same methods as IGDBClient, but as coroutines that share a TokenBucket, so up to
+    max_in_flight requests overlap while requests/sec stays capped. Use run/run_all
+    to drive them from sync code. run/run_all can be called from several threads at
+    once; each gets its own event loop and session, and all of them share the TokenBucket
+    and the max_in_flight cap. Throttling (429), server errors (5xx) and connection
+    errors are retried like fetcher.Fetcher does.
+
+    Attributes
+    ----------
+    rate : float
+        Max requests/sec (IGDB allows 4)
+    max_in_flight : int
+        Max concurrent open requests across all threads (IGDB allows 8)
+    max_retries : int
+        Retries after the first attempt
+    backoff : float
+        Base backoff in seconds, doubled every retry
+    max_backoff : float
+        Cap on a single backoff sleep
+    """
+
+    def __init__(self, client_id: str, client_secret: str, cache=None, rate=4, max_in_flight=8, title_index=None, base_url=None, max_retries=5, backoff=1.0, max_backoff=60.0):
+        super().__init__(client_id, client_secret, cache=cache, title_index=title_index, base_url=base_url)
+        self.limiter = TokenBucket(rate)
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)  # Shared by every thread's event loop
+        self._local = threading.local()  # Session and in flight queue of this thread's event loop
+
+    def run(self, method: str, *args):
+        """
+        Run one client coroutine to completion from sync code
+
+        Example: client.run('get_games', igdb_ids)
+        """
+        return asyncio.run(self._with_session(getattr(self, method)(*args)))
+
+    def run_all(self, method: str, items: list, desc: str = None, on_result=None, return_exceptions: bool = False) -> list:
+        """
+        Submit method(item) for every item at once from sync code
+
+        Parameters
+        ----------
+        on_result : callable, optional
+            Called with (item, result) as soon as each item finishes, e.g. to checkpoint it
+        return_exceptions : bool
+            Return (and pass to on_result) an item's exception instead of raising it
+
+        Returns
+        -------
+        list
+            Results in the same order as items
+        """
+        async def call(item):
+            try:
+                result = await getattr(self, method)(item)
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                result = e
+            if on_result is not None:
+                on_result(item, result)
+            return result
+
+        async def gather():
+            tasks = [asyncio.ensure_future(call(item)) for item in items]
+            for task in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc=desc):
+                await task
+            return [task.result() for task in tasks]
+
+        return asyncio.run(self._with_session(gather()))
+
+    async def _with_session(self, coro):
+        async with aiohttp.ClientSession() as session:
+            self._local.session = session
+            self._local.in_flight = asyncio.Semaphore(self.max_in_flight)
+            try:
+                return await coro
+            finally:
+                self._local.session = None
+                self._local.in_flight = None
+
+    async def _api_request(self, endpoint: str, query: str, use_cache: bool = True) -> bytes:
+        """
+        IGDB API request, served from the response cache when possible (and use_cache)
+        """
+        use_cache = use_cache and self.cache is not None
+        if use_cache:
+            key = self.cache.key('POST', endpoint, query)
+            response = self.cache.get(key)
+            if response is not None:
+                return response.content
+            if self.cache.offline:
+                raise CacheMiss(key)
+
+        status, content = await self._post_with_retries(endpoint, query)
+
+        if use_cache:
+            self.cache.set(key, CachedResponse(status, content), TTL_IGDB)
+
+        return content
+
+    async def _post_with_retries(self, endpoint: str, query: str) -> tuple:
+        """
+        POST a query, retrying throttling, server and connection errors with backoff.
+        The in flight slot is released while backing off.
+
+        Returns
+        -------
+        int
+            Status code
+        bytes
+            Content
+        """
+        for attempt in range(self.max_retries + 1):
+            await self._acquire_in_flight()
+            try:
+                await self.limiter.acquire_async()
+                async with self._local.session.post(
+                    rewrite_url(f'{self.API_URL}/{endpoint}', self.base_url),
+                    headers={'Client-ID': self.client_id, 'Authorization': f'Bearer {self.access_token}'},
+                    data=query
+                ) as resp:
+                    if resp.status not in Fetcher.RETRY_STATUS or attempt == self.max_retries:
+                        resp.raise_for_status()
+                        return resp.status, await resp.read()
+                    delay = retry_delay(attempt, self.backoff, self.max_backoff, resp.headers.get('Retry-After'))
+            except aiohttp.ClientConnectionError:
+                if attempt == self.max_retries:
+                    raise
+                delay = retry_delay(attempt, self.backoff, self.max_backoff)
+            finally:
+                self._release_in_flight()
+            await asyncio.sleep(delay)
+
+    async def _acquire_in_flight(self):
+        """
+        Wait (without blocking the event loop) for one of the max_in_flight slots
+
+        Coroutines queue on this loop's asyncio.Semaphore first, so at most
+        max_in_flight of them per loop wait on the slots shared with other threads'
+        loops, in the default executor.
+        """
+        in_flight = self._local.in_flight
+        await in_flight.acquire()
+        if self._in_flight.acquire(blocking=False):
+            return
+
+        acquired = asyncio.get_running_loop().run_in_executor(None, self._in_flight.acquire)
+        try:
+            await asyncio.shield(acquired)
+        except asyncio.CancelledError:
+            # The executor still gets the slot, give it back once it does
+            acquired.add_done_callback(lambda _: self._in_flight.release())
+            in_flight.release()
+            raise
+
+    def _release_in_flight(self):
+        self._in_flight.release()
+        self._local.in_flight.release()
+
+    async def _api_request_all(self, endpoint: str, query: str, use_cache: bool = True) -> list:
+        """
+        Page through every result of a query, MAX_LIMIT results per request
+        """
+        results = []
+        offset = 0
+        while True:
+            byte_array = await self._api_request(endpoint, self._page_query(query, offset), use_cache)
+            page = json.loads(byte_array)
+            results += page
+            if len(page) < self.MAX_LIMIT:
+                break
+            offset += self.MAX_LIMIT
+
+        return results
+
+    async def _api_request_each(self, endpoint: str, query, ids: list, id_of) -> list:
+        """
+        Every result of query(ids), cached per id (see IGDBClient._api_request_each),
+        uncached chunks requested concurrently
+        """
+        results, missing = self._cached_each(endpoint, query, ids)
+        missing = sorted(set(missing))
+        chunks = [missing[i:i+self.MAX_LIMIT] for i in range(0, len(missing), self.MAX_LIMIT)]
+        pages = await asyncio.gather(*[self._api_request_all(endpoint, query(chunk), use_cache=False) for chunk in chunks])
+        for chunk, page in zip(chunks, pages):
+            results.update(self._cache_each(endpoint, query, chunk, page, id_of))
+
+        return [result for id_ in dict.fromkeys(ids) for result in results.get(id_, [])]
+
+    async def get_game(self, igdb_id: int) -> dict:
+        """
+        Get game metadata from IGDB ID
+        """
+        return (await self.get_games([igdb_id]))[0]
+
+    async def get_games(self, igdb_ids: list) -> list:
+        """
+        Get game metadata for many IGDB IDs, every MAX_LIMIT id chunk requested concurrently
+        """
+        igdb_ids = [int(igdb_id) for igdb_id in igdb_ids]
+
+        byte_arrays = await asyncio.gather(*[
+            self._api_request('games', self._games_query(igdb_ids[i:i+self.MAX_LIMIT]))
+            for i in range(0, len(igdb_ids), self.MAX_LIMIT)
+        ])
+        games_by_id = {}
+        for byte_array in byte_arrays:
+            for game in json.loads(byte_array):
+                game = self._process_game(game)
+                games_by_id[game['igdb_id']] = game
+
+        return [games_by_id[igdb_id] for igdb_id in igdb_ids if igdb_id in games_by_id]
+
+    async def get_igdb_id_by_steam_appid(self, steam_appid: int) -> int:
+        """
+        Get IGDB ID using Steam ID (via external_games, see get_igdb_ids_by_steam_appids)
+        """
+        return (await self.get_igdb_ids_by_steam_appids([steam_appid])).get(int(steam_appid))
+
+    async def get_igdb_ids_by_steam_appids(self, steam_appids: list) -> dict:
+        """
+        Get IGDB IDs for many Steam IDs using IGDB's Steam external_games, every uncached chunk requested concurrently
+        """
+        steam_appids = [int(steam_appid) for steam_appid in steam_appids]
+
+        external_games_response = await self._api_request_each('external_games', self._steam_external_games_query, steam_appids, self._external_game_uid)
+        candidates = self._steam_candidates(external_games_response)
+
+        duplicate_game_ids = sorted({game_id for game_ids in candidates.values() if len(game_ids) > 1 for game_id in game_ids})
+        games_response = await self._api_request_each('games', self._rank_query, duplicate_game_ids, self._game_id)
+
+        return self._pick_steam_candidates(candidates, games_response)
+
+    async def get_igdb_id_by_title(self, title: str) -> int:
+        """
+        Get IGDB ID using title, from title_index when it has a confident match
+        """
+        if self.title_index is not None:
+            igdb_id = self.title_index.match(title)
+            if igdb_id is not None:
+                return igdb_id
+
+        byte_array = await self._api_request('games', self._title_search_query(title))
+        games_response = json.loads(byte_array)
+
+        return self._best_title_match(title, games_response)
+
+    async def get_title_dump(self, platforms: list = None) -> list:
+        """
+        Names of every game (on platforms), for building a title_index.TitleIndex
+        """
+        games = []
+        last_id = 0
+        while True:
+            page = json.loads(await self._api_request('games', self._title_dump_query(last_id, platforms)))
+            games += page
+            if len(page) < self.MAX_LIMIT:
+                break
+            last_id = page[-1]['id']
+
+        return games
@@ -0,0 +1,303 @@
+#! /usr/bin/env python3
+"""
+Local stand-in for the Steam, Playstation, Twitch and IGDB endpoints the clients use
+
+Serves a fixtures.synthetic_account with configurable latency, per-host 429 rate
+limiting and injected server errors, so client concurrency, retries and rate limiting
+can be exercised without the network. Point a client at it with its base_url, e.g.
+SteamClient(..., base_url=server.url). Use no response cache (or a throwaway one),
+since responses are cached under the real urls.
+
+Usage: python mock_server.py [--games N] [--port P] [--latency uniform:0.01,0.1]
+                             [--rate api.igdb.com=4 ...] [--error-rate 0.01] [--seed S]
+"""
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import re
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+from fixtures import WISHLIST_PAGE_SIZE, synthetic_account, trophy_titles_response, wishlist_page
+from ratelimit import TokenBucket
+
+# Never throttled or failed, the clients don't retry them
+AUTH_PATHS = {
+    ('ca.account.sony.com', '/api/authz/v3/oauth/authorize'),
+    ('ca.account.sony.com', '/api/authz/v3/oauth/token'),
+    ('id.twitch.tv', '/oauth2/token'),
+}
+
+
+def parse_latency(spec):
+    """
+    Latency distribution from a spec string
+
+    Parameters
+    ----------
+    spec : str
+        none, fixed:SECONDS, uniform:LOW,HIGH or lognormal:MU,SIGMA (of the log of
+        seconds, e.g. lognormal:-3,0.5 has a median of 50ms)
+
+    Returns
+    -------
+    callable
+        random.Random => seconds
+    """
+    name, _, params = (spec or 'none').partition(':')
+    params = [float(p) for p in params.split(',')] if params else []
+    if name == 'none':
+        return lambda rng: 0.0
+    if name == 'fixed':
+        return lambda rng: params[0]
+    if name == 'uniform':
+        return lambda rng: rng.uniform(params[0], params[1])
+    if name == 'lognormal':
+        return lambda rng: rng.lognormvariate(params[0], params[1])
+    raise ValueError(f'Unknown latency distribution {spec}')
+
+
+class MockServer():
+    """
+    Threaded HTTP server answering requests rewritten by fetcher.rewrite_url
+    (/<original host>/<original path>) from a synthetic account
+
+    Every request gets its own random.Random seeded by seed, the request and how many
+    times it was seen, so latency and injected errors don't depend on thread timing.
+
+    Attributes
+    ----------
+    account : dict
+        fixtures.synthetic_account being served
+    latency : callable
+        random.Random => seconds to wait before answering (see parse_latency)
+    rates : dict
+        host => max requests/sec. Requests over it get a 429 with Retry-After.
+    error_rate : float
+        Probability of answering a request with a 503
+    seed : int
+    stats : dict
+        host => requests, throttled (429s) and errors (injected 503s)
+    """
+
+    def __init__(self, account, host='127.0.0.1', port=0, latency=None, rates=None, error_rate=0.0, seed=0):
+        self.account = account
+        self.latency = latency or parse_latency('none')
+        self.rates = rates or {}
+        self.error_rate = error_rate
+        self.seed = seed
+        self.stats = {}
+
+        self._limiters = {host: TokenBucket(rate) for host, rate in self.rates.items()}
+        self._seen = {}
+        self._lock = threading.Lock()
+        self._igdb_games = {game['id']: game for game in account['igdb_games']}
+        self._igdb_by_uid = {e['uid']: e for e in account['external_games']}
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server._respond(self, 'GET', b'')
+
+            def do_POST(self):
+                server._respond(self, 'POST', self.rfile.read(int(self.headers.get('Content-Length') or 0)))
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer((host, port), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        """Serve on a background thread"""
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def print_stats(self):
+        for host, stats in sorted(self.stats.items()):
+            print(f'{host}: {stats["requests"]} requests, {stats["throttled"]} throttled, {stats["errors"]} errors')
+
+    def _respond(self, handler, method, body):
+        """
+        Latency, then rate limiting, then error injection, then the endpoint's answer
+        """
+        parsed = urlparse(handler.path)
+        _, host, path = parsed.path.split('/', 2) if parsed.path.count('/') >= 2 else ('', parsed.path.strip('/'), '')
+        path = '/' + path
+        query = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+
+        with self._lock:
+            request = f'{method} {handler.path} {body.decode("utf-8", "replace")}'
+            n = self._seen[request] = self._seen.get(request, 0) + 1
+            stats = self.stats.setdefault(host, {'requests': 0, 'throttled': 0, 'errors': 0})
+            stats['requests'] += 1
+        rng = random.Random(f'{self.seed} {request} {n}')
+
+        time.sleep(self.latency(rng))
+
+        if (host, path) not in AUTH_PATHS:
+            limiter = self._limiters.get(host)
+            wait = limiter.try_acquire() if limiter is not None else 0
+            if wait:
+                with self._lock:
+                    stats['throttled'] += 1
+                return self._send(handler, 429, {'error': 'Too Many Requests'}, {'Retry-After': str(max(int(wait + 0.999), 1))})
+            if rng.random() < self.error_rate:
+                with self._lock:
+                    stats['errors'] += 1
+                return self._send(handler, 503, {'error': 'Service Unavailable'})
+
+        try:
+            status, content, headers = self._route(method, host, path, query, body.decode('utf-8'))
+        except Exception as e:
+            status, content, headers = 500, {'error': repr(e)}, {}
+        self._send(handler, status, content, headers)
+
+    @staticmethod
+    def _send(handler, status, content, headers=None):
+        if isinstance(content, str):
+            data, content_type = content.encode('utf-8'), 'text/html; charset=utf-8'
+        else:
+            data, content_type = json.dumps(content).encode('utf-8'), 'application/json'
+        handler.send_response(status)
+        handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(len(data)))
+        for k, v in (headers or {}).items():
+            handler.send_header(k, v)
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def _route(self, method, host, path, query, body):
+        """
+        Returns
+        -------
+        int
+            Status code
+        str or JSON serializable
+            Body (str is sent as html)
+        dict
+            Extra headers
+        """
+        account = self.account
+
+        # Auth
+        if host == 'ca.account.sony.com' and path == '/api/authz/v3/oauth/authorize':
+            return 302, '', {'Location': 'com.scee.psxandroid.scecompcall://redirect?code=mock'}
+        if host == 'ca.account.sony.com' and path == '/api/authz/v3/oauth/token':
+            return 200, {'access_token': 'mock', 'expires_in': 3600}, {}
+        if host == 'id.twitch.tv' and path == '/oauth2/token':
+            return 200, {'access_token': 'mock', 'expires_in': 5000000, 'token_type': 'bearer'}, {}
+
+        # Steam
+        if host == 'api.steampowered.com' and path == '/IPlayerService/GetOwnedGames/v1/':
+            return 200, {'response': {'game_count': len(account['library']), 'games': account['library']}}, {}
+        if host == 'api.steampowered.com' and path == '/ISteamUserStats/GetPlayerAchievements/v0001/':
+            achievements = account['achievements'].get(int(query.get('appid', 0)))
+            if achievements is None:
+                return 400, {'playerstats': {'error': 'Requested app has no stats', 'success': False}}, {}
+            return 200, {'playerstats': {'success': True, 'achievements': achievements}}, {}
+        if host == 'store.steampowered.com' and path.startswith('/app/'):
+            page = account['store_pages'].get(int(path.split('/')[2]))
+            return (200, page, {}) if page is not None else (404, 'Not Found', {})
+        if host == 'store.steampowered.com' and path.endswith('/wishlistdata/'):
+            page = int(query.get('p', 0))
+            games = account['wishlist'][page*WISHLIST_PAGE_SIZE:(page+1)*WISHLIST_PAGE_SIZE]
+            return 200, wishlist_page(games) if games else [], {}
+
+        # Playstation
+        if host == 'm.np.playstation.com' and path == '/api/gamelist/v2/users/me/titles':
+            offset, limit = int(query.get('offset', 0)), int(query.get('limit', 100))
+            return 200, {'titles': account['ps_titles'][offset:offset+limit], 'totalItemCount': len(account['ps_titles'])}, {}
+        if host == 'm.np.playstation.com' and path == '/api/trophy/v1/users/me/titles/trophyTitles':
+            return 200, trophy_titles_response(account, query.get('npTitleIds', '').split(',')), {}
+
+        # IGDB
+        if host == 'api.igdb.com' and method == 'POST' and path.startswith('/v4/'):
+            results = self._igdb_query(path[len('/v4/'):], body)
+            if results is None:
+                return 404, {'message': 'Not Found'}, {}
+            limits = re.findall(r'limit (\d+);', body)
+            offsets = re.findall(r'offset (\d+);', body)
+            offset = int(offsets[-1]) if offsets else 0
+            return 200, results[offset:offset + (int(limits[-1]) if limits else 10)], {}
+
+        return 404, {'error': f'No mock for {method} {host}{path}'}, {}
+
+    def _igdb_query(self, endpoint, body):
+        """
+        Every result of an Apicalypse query the clients send, before limit/offset
+        """
+        ids = re.search(r'where id = \(?([\d,\s]+)\)?', body)
+        if endpoint == 'games' and ids:
+            return [self._igdb_games[int(i)] for i in ids.group(1).split(',') if i.strip() and int(i) in self._igdb_games]
+        last_id = re.search(r'where id > (\d+)', body)
+        if endpoint == 'games' and last_id:
+            return [game for game in self.account['igdb_games'] if game['id'] > int(last_id.group(1))]
+        search = re.search(r'search "(.*)";', body)
+        if endpoint == 'games' and search:
+            term = search.group(1).lower()
+            return [{'id': game['id'], 'name': game['name']} for game in self.account['igdb_games'] if term in game['name'].lower()]
+
+        if endpoint == 'external_games':
+            uids = re.search(r'uid = \(([^)]*)\)', body)
+            uids = [uid.strip().strip('"') for uid in uids.group(1).split(',')] if uids else []
+            return [self._igdb_by_uid[uid] for uid in uids if uid in self._igdb_by_uid]
+        if endpoint == 'websites':
+            appid = re.search(r'url = \*"/(\d+)"\*', body)
+            external_game = self._igdb_by_uid.get(appid.group(1)) if appid else None
+            if external_game is None:
+                return []
+            return [{'id': external_game['id'], 'game': external_game['game'], 'category': 13, 'url': f'https://store.steampowered.com/app/{external_game["uid"]}'}]
+
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mock Steam/PSN/IGDB server')
+    parser.add_argument('--games', type=int, default=1000, help='Steam library size of the synthetic account')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', default='none', help='none, fixed:S, uniform:LOW,HIGH or lognormal:MU,SIGMA')
+    parser.add_argument('--rate', action='append', default=[], help='HOST=REQUESTS_PER_SEC, repeatable')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Probability of a 503')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rates = {host: float(rate) for host, rate in (r.split('=') for r in args.rate)}
+    server = MockServer(
+        synthetic_account(args.games, args.seed),
+        host=args.host,
+        port=args.port,
+        latency=parse_latency(args.latency),
+        rates=rates,
+        error_rate=args.error_rate,
+        seed=args.seed
+    )
+    print(f'Serving {args.games} games on {server.url}')
+    try:
+        server._httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.print_stats()
@@ -0,0 +1,187 @@
+#! /usr/bin/env python3
+"""
+Versioned vgr model artifacts and incremental scoring into the predictions table
+
+Usage: python model.py [--version VERSION] [--top N]
+"""
+import argparse
+import json
+import pathlib
+import time
+
+import pandas as pd
+from sqlalchemy import text
+import xgboost as xgb
+
+from db import KEY_CHUNK_SIZE, create_predictions_table, get_games_data_label_codes, get_prediction_hashes, upsert_records
+from features import FEATURES_VERSION, LABEL_FEATURES, NUMERIC_FEATURES, TEXT_FEATURES, TEXT_N_FEATURES, build_features, row_hashes
+
+MODEL_PATH = pathlib.Path.home() / ".vgdb" / "models"
+
+
+def save_model(model, vocabularies, path=MODEL_PATH, **info):
+    """
+    Save a trained model as a new artifact version and make it the latest
+
+    Parameters
+    ----------
+    model : xgb.XGBRegressor
+        Trained on build_features' matrix
+    vocabularies : dict
+        The vocabularies the training matrix was encoded with
+    path : pathlib.Path
+        Artifact directory (default ~/.vgdb/models), one subdirectory per version
+    info
+        Extra JSON serializable metadata, e.g. validation MAE
+
+    Returns
+    -------
+    str
+        Version
+    """
+    path = pathlib.Path(path)
+    version = time.strftime('%Y%m%d-%H%M%S')
+    suffix = 1
+    while (path / version).exists():
+        version = f'{time.strftime("%Y%m%d-%H%M%S")}-{suffix}'
+        suffix += 1
+    (path / version).mkdir(parents=True)
+
+    model.get_booster().save_model(path / version / 'model.ubj')
+    with open(path / version / 'meta.json', 'w') as f:
+        json.dump(
+            {
+                'version': version,
+                'trained': time.time(),
+                'features_version': FEATURES_VERSION,
+                'numeric_features': NUMERIC_FEATURES,
+                'label_features': LABEL_FEATURES,
+                'text_features': TEXT_FEATURES,
+                'text_n_features': TEXT_N_FEATURES,
+                'vocabularies': vocabularies,
+                'params': {k: v for k, v in model.get_params().items() if v is not None and k != 'missing'},
+                **info
+            },
+            f
+        )
+    (path / 'LATEST').write_text(version)
+
+    return version
+
+
+class Scorer():
+    """
+    Scores games_data rows with a saved model artifact
+
+    The artifact is loaded once. Rows are encoded with the vocabularies the model was
+    trained with, so scoring never needs the training data or a retrain.
+
+    Attributes
+    ----------
+    version : str
+    meta : dict
+        The artifact's meta.json
+    booster : xgb.Booster
+    """
+
+    def __init__(self, version=None, path=MODEL_PATH):
+        path = pathlib.Path(path)
+        self.version = version or (path / 'LATEST').read_text().strip()
+        with open(path / self.version / 'meta.json') as f:
+            self.meta = json.load(f)
+        if self.meta['features_version'] != FEATURES_VERSION:
+            raise StaleModelError(f'Model {self.version} was trained on features version {self.meta["features_version"]}, not {FEATURES_VERSION}')
+
+        self.booster = xgb.Booster()
+        self.booster.load_model(path / self.version / 'model.ubj')
+
+    def predict(self, df, label_codes=None):
+        """
+        Predicted personal_rating of every row of df (games_data indexed by igdb_id)
+
+        label_codes are df's integer coded labels (see build_features), its list
+        strings are parsed when None.
+        """
+        X, _ = build_features(df, vocabularies=self.meta['vocabularies'], label_codes=label_codes)
+        return self.booster.inplace_predict(X)
+
+    def score(self, conn, igdb_ids=None, stats=None):
+        """
+        Write predictions for unrated games_data rows that are new, changed, or were
+        scored by a different model version
+
+        Parameters
+        ----------
+        conn : sqlalchemy.engine.Connection
+        igdb_ids : iterable, optional
+            Only consider these rows, e.g. the ones an incremental update_db refreshed,
+            plus rows last scored by a different model version. Every unrated row is
+            considered when None.
+        stats : db.LoadStats, optional
+
+        Returns
+        -------
+        int
+            Rows scored
+        """
+        start = time.time()
+        create_predictions_table(conn)
+        # Rated or removed games don't need a prediction anymore
+        conn.execute(text("""DELETE FROM predictions WHERE igdb_id NOT IN (SELECT igdb_id FROM games_data WHERE personal_rating IS NULL);"""))
+
+        if igdb_ids is None:
+            df = pd.read_sql_query(text("""SELECT * FROM games_data WHERE personal_rating IS NULL ORDER BY igdb_id;"""), conn)
+        else:
+            # Unchanged rows still need scoring again after a retrain
+            stale = conn.execute(text("""SELECT igdb_id FROM predictions WHERE model_version != :version;"""), {'version': self.version})
+            igdb_ids = [int(igdb_id) for igdb_id in set(igdb_ids) | {row[0] for row in stale}]
+            frames = [
+                pd.read_sql_query(
+                    text(f"""SELECT * FROM games_data WHERE personal_rating IS NULL AND igdb_id IN ({', '.join(str(igdb_id) for igdb_id in chunk)});"""),
+                    conn
+                )
+                for chunk in [igdb_ids[i:i+KEY_CHUNK_SIZE] for i in range(0, len(igdb_ids), KEY_CHUNK_SIZE)]
+            ]
+            df = pd.concat(frames) if frames else pd.read_sql_query(text("""SELECT * FROM games_data WHERE 0;"""), conn)
+        df = df.set_index('igdb_id')
+
+        hashes = [str(h) for h in row_hashes(df)]
+        scored_hashes = get_prediction_hashes(conn, self.version)
+        changed = [scored_hashes.get(igdb_id) != h for igdb_id, h in zip(df.index, hashes)]
+        df = df[changed]
+        hashes = [h for h, c in zip(hashes, changed) if c]
+        if df.empty:
+            print(f'Predictions: nothing to score [{time.time()-start:.3f} seconds]')
+            return 0
+
+        now = time.time()
+        records = [
+            {'igdb_id': int(igdb_id), 'pred': float(pred), 'model_version': self.version, 'row_hash': h, 'scored': now}
+            for igdb_id, pred, h in zip(df.index, self.predict(df, get_games_data_label_codes(conn, df)), hashes)
+        ]
+        upsert_records(conn, 'predictions', 'igdb_id', records, stats=stats)
+        print(f'Predictions: {len(records)} rows scored with model {self.version} [{time.time()-start:.3f} seconds]')
+
+        return len(records)
+
+
+class StaleModelError(ValueError):
+    """A model artifact trained on an older FEATURES_VERSION, it needs a retrain"""
+
+
+if __name__ == '__main__':
+    from vgdb import engine
+
+    parser = argparse.ArgumentParser(description='Score new/changed unrated games into the predictions table')
+    parser.add_argument('--version', help='Model artifact version (default: latest)')
+    parser.add_argument('--top', type=int, default=25, help='Print the N best predictions')
+    args = parser.parse_args()
+
+    with engine.begin() as conn:
+        Scorer(args.version).score(conn)
+        top = conn.execute(
+            text("""SELECT p.igdb_id, g.title, p.pred FROM predictions p JOIN games_data g ON g.igdb_id = p.igdb_id ORDER BY p.pred DESC LIMIT :top;"""),
+            {'top': args.top}
+        )
+        for igdb_id, title, pred in top:
+            print(f'[{igdb_id}] {title}: {pred}')
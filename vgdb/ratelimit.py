@@ -0,0 +1,67 @@
+import asyncio
+import threading
+import time
+
+
+class TokenBucket():
+    """
+    Token bucket rate limiter usable from threads and asyncio tasks
+
+    Unlike a lock held around each request it doesn't serialize callers, so several requests
+    can be in flight at once while the request rate stays capped.
+
+    Attributes
+    ----------
+    rate : float
+        Tokens added per second (sustained requests/sec)
+    capacity : float
+        Max tokens banked (burst size)
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        """
+        Take a token if one is available, without waiting
+
+        Returns
+        -------
+        float
+            0 if a token was taken, otherwise seconds until one will be available
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        """Block until a token is available"""
+        wait = self.try_acquire()
+        while wait:
+            time.sleep(wait)
+            wait = self.try_acquire()
+
+    async def acquire_async(self):
+        """Wait (without blocking the event loop) until a token is available"""
+        wait = self.try_acquire()
+        while wait:
+            await asyncio.sleep(wait)
+            wait = self.try_acquire()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        return False
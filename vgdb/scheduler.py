@@ -0,0 +1,129 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import time
+
+
+class StageScheduler():
+    """
+    Runs stages as a DAG on a thread pool
+
+    A stage starts as soon as every stage it depends on has finished, so independent
+    stages overlap and the total run time approaches the longest dependency path
+    instead of the sum of all stages.
+
+    Attributes
+    ----------
+    max_workers : int
+        Max stages running at once
+    stages : dict
+        name => (fn, names of the stages it depends on), in the order they were added
+    timings : dict
+        name => (start, end) seconds since the start of run, for every finished stage
+    """
+
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self.stages = {}
+        self.timings = {}
+        self._start = None
+
+    def add(self, name, fn, depends_on=()):
+        """
+        Add a stage
+
+        Parameters
+        ----------
+        name : str
+        fn : callable
+            Called without arguments
+        depends_on : list of str
+            Stages that must finish first. They have to be added before this one,
+            which keeps the graph acyclic.
+        """
+        if name in self.stages:
+            raise ValueError(f'Stage {name} already added')
+        for dependency in depends_on:
+            if dependency not in self.stages:
+                raise ValueError(f'Stage {name} depends on unknown stage {dependency}')
+        self.stages[name] = (fn, tuple(depends_on))
+
+    def run(self):
+        """
+        Run every stage. If a stage raises, no new stages are started, running stages
+        are allowed to finish and the first error is re-raised.
+        """
+        self.timings = {}
+        self._start = time.time()
+        pending = dict(self.stages)
+        running = {}
+        error = None
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                if error is None:
+                    ready = [name for name, (_, depends_on) in pending.items() if all(d in self.timings for d in depends_on)]
+                    for name in ready:
+                        fn, _ = pending.pop(name)
+                        running[executor.submit(self._run_stage, name, fn)] = name
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    running.pop(future)
+                    if future.exception() is not None and error is None:
+                        error = future.exception()
+
+        if error is not None:
+            raise error
+
+    def _run_stage(self, name, fn):
+        start = time.time() - self._start
+        print(f'[{name}] started')
+        fn()
+        end = time.time() - self._start
+        self.timings[name] = (start, end)
+        print(f'[{name}] done [{end-start:.2f} seconds]')
+
+    def critical_path(self):
+        """
+        Longest chain of dependent stages by wall time
+
+        Returns
+        -------
+        list of str
+            Stage names, first to last
+        float
+            Summed seconds of the stages on the path
+        """
+        longest = {}  # name => (seconds, path) of the longest path ending at name
+        for name, (_, depends_on) in self.stages.items():
+            start, end = self.timings[name]
+            seconds, path = max((longest[d] for d in depends_on), default=(0.0, []), key=lambda p: p[0])
+            longest[name] = (seconds + end - start, path + [name])
+
+        seconds, path = max(longest.values(), key=lambda p: p[0])
+        return path, seconds
+
+    def report(self):
+        """
+        Returns
+        -------
+        list of dicts
+            stage, start, end and seconds for every finished stage, in start order
+        """
+        return sorted(
+            [{'stage': name, 'start': start, 'end': end, 'seconds': end - start} for name, (start, end) in self.timings.items()],
+            key=lambda row: row['start']
+        )
+
+    def print_report(self):
+        rows = self.report()
+        for row in rows:
+            print(f'{row["stage"]}: {row["start"]:.2f}-{row["end"]:.2f} [{row["seconds"]:.2f} seconds]')
+
+        total = sum(row['seconds'] for row in rows)
+        wall = max((row['end'] for row in rows), default=0.0)
+        print(f'Stages: {total:.2f} seconds summed, {wall:.2f} seconds wall')
+        if len(self.timings) == len(self.stages):
+            path, seconds = self.critical_path()
+            print(f'Critical path: {" -> ".join(path)} [{seconds:.2f} seconds]')
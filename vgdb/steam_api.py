@@ -1,12 +1,18 @@
-from concurrent.futures import as_completed
+from concurrent.futures import FIRST_COMPLETED, as_completed, wait
 import json
+import threading
 import time
+from urllib.parse import quote
 import xml.etree.ElementTree as ET
 
 from lxml import html
 import numpy as np
 import requests
-from requests_futures.sessions import FuturesSession
+
+from cache import TTL_PLAYTIME, TTL_STORE_PAGE, TTL_WISHLIST
+from fetcher import Fetcher, rewrite_url
+
+ACHIEVEMENT_FIELDS = ['achievement_progress', 'completed_achievements', 'total_achievements']
 
 
 class SteamClient():
@@ -21,21 +27,102 @@ class SteamClient():
         Steam User ID  (https://store.steampowered.com/account/ => Steam ID: <Some Number>)
     web_api_key : str
         Steam API key
+    cache : cache.ResponseCache, optional
+        Response cache shared between runs
+    max_workers : int
+        Max concurrent requests while enriching records
+    rates : dict, optional
+        host => max requests/sec while enriching records (default DEFAULT_RATES)
+    max_retries : int
+        Retries on throttling (429) and server errors (5xx) before recording a failure
+    failures : list of dicts
+        Records that couldn't be enriched (steam_appid, title, stage, status_code, error)
+    store_source : str
+        'html' scrapes store pages, 'json' uses Steam's JSON endpoints (appdetails,
+        appreviews, IStoreBrowseService) and falls back to the store page on failure.
+        json makes 3 store.steampowered.com requests per app instead of 1 (see
+        STORE_REQUESTS), so it's about 3x slower under that host's rate limit.
+    wishlist_window : int
+        Wishlist pages requested concurrently, speculatively past the last one seen.
+        1 walks the pages one at a time.
+    base_url : str, optional
+        Send every request here instead, e.g. to a mock_server.MockServer (see
+        fetcher.rewrite_url). Responses are cached under the original urls.
     """
 
-    def __init__(self, url_name, user_id, web_api_key):
+    DEFAULT_RATES = {
+        'api.steampowered.com': 10,
+        'store.steampowered.com': 4
+    }
+    # Requests per app for store data by store_source, then host. json also looks up
+    # the tag names once per client.
+    STORE_REQUESTS = {
+        'html': {'store.steampowered.com': 1},
+        'json': {'store.steampowered.com': 3, 'api.steampowered.com': 1}
+    }
+
+    def __init__(self, url_name, user_id, web_api_key, cache=None, max_workers=8, rates=None, max_retries=5, store_source='html', wishlist_window=4, base_url=None):
         self.url_name = url_name
         self.user_id = user_id
         self.web_api_key = web_api_key
-
-        self.session = FuturesSession()
+        self.cache = cache
+        self.store_source = store_source
+        self.wishlist_window = wishlist_window
+        self.base_url = base_url
+
+        self.fetcher = Fetcher(
+            max_workers=max_workers,
+            rates=rates if rates is not None else self.DEFAULT_RATES,
+            max_retries=max_retries,
+            cache=cache,
+            base_url=base_url
+        )
+        self.failures = []
+        self._tag_names = None
+        self._tag_names_lock = threading.Lock()
+        self._store_data = {}  # appid => Future of its store data, shared by every caller
+        self._store_data_lock = threading.Lock()
 
         self.WAIT_TIME = 0.3
 
-    def get_library(self):
+    def _get(self, url, ttl, **kwargs):
+        """
+        GET url, served from the response cache when possible
+        """
+        def fetch():
+            r = requests.get(rewrite_url(url, self.base_url), **kwargs)
+            time.sleep(self.WAIT_TIME)
+            return r
+
+        if self.cache is None:
+            return fetch()
+        return self.cache.get_or_fetch(self.cache.key('GET', url), ttl, fetch)
+
+    def _record_failure(self, game, stage, error, resp=None):
+        """
+        Keep track of a record that couldn't be enriched instead of stopping the run
+        """
+        status_code = resp.status_code if resp is not None else None
+        print(f'[{status_code}] {stage} failed on [{game["steam_appid"]}] {game["title"]}: {error!r}')
+        self.failures.append({
+            'steam_appid': game['steam_appid'],
+            'title': game['title'],
+            'stage': stage,
+            'status_code': status_code,
+            'error': repr(error)
+        })
+
+    def get_library(self, previous=None):
         """
         Gets Steam library games using Steam url name
 
+        Parameters
+        ----------
+        previous : dict, optional
+            steam_appid => previously stored steam_library row (last_played and
+            ACHIEVEMENT_FIELDS). Achievements are only requested for games played
+            since, see _reuse_achievements.
+
         Returns
         -------
         list of dicts
@@ -44,25 +131,13 @@ class SteamClient():
         # Get library appids, title, and play time
         start = time.time()
         print('Steam Library...')
-        r = requests.get(f'https://api.steampowered.com/IPlayerService/GetOwnedGames/v1/?key={self.web_api_key}&steamid={self.user_id}&include_appinfo=1&include_played_free_games=1')
-        time.sleep(self.WAIT_TIME)
-        library_list = json.loads(r.text)['response']['games']
-
-        games_records = []
-        for item in library_list:
-            game = {}
-            game['steam_appid'] = item['appid']
-            game['title'] = item['name']
-            game['owned'] = 'Yes'
-            game['playtime'] = item['playtime_forever']
-            game['last_played'] = item['rtime_last_played']
-            games_records.append(game)
+        games_records = self._get_library_games()
         print(f'Steam Library [{time.time()-start:.2f} seconds]')
     
         # Achievements
         start = time.time()
         print('Steam Library Achievements...')
-        games_records = self._enrich_with_achievements(games_records)
+        games_records = self._enrich_with_achievements(games_records, previous)
         print(f'Steam Library Achievements [{time.time()-start:.2f} seconds]')
 
         # Store data
@@ -73,6 +148,60 @@ class SteamClient():
 
         return games_records
 
+    def iter_library(self, previous=None):
+        """
+        Streaming get_library (see get_library for previous)
+
+        A game's store data request starts as soon as its achievements are in, and
+        games are yielded as soon as they're fully enriched, in completion order.
+
+        Yields
+        ------
+        dict
+            Record of a game in Steam library
+        """
+        games = self._get_library_games()
+        achievement_futures = {}
+        store_futures = {}
+        for game in games:
+            if self._reuse_achievements(game, previous):
+                store_futures[self._store_data_future(game['steam_appid'])] = game
+            else:
+                achievement_futures[self._submit_achievements(game)] = game
+        while achievement_futures or store_futures:
+            done, _ = wait(list(achievement_futures) + list(store_futures), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in achievement_futures:
+                    game = achievement_futures.pop(future)
+                    if self._add_achievements(game, future):
+                        store_futures[self._store_data_future(game['steam_appid'])] = game
+                else:
+                    game = store_futures.pop(future)
+                    self._add_store_data(game, future)
+                    yield game
+
+    def _get_library_games(self):
+        """
+        Library appids, title, and play time
+        """
+        r = self._get(self._library_url(), TTL_PLAYTIME)
+        library_list = json.loads(r.text)['response']['games']
+
+        games_records = []
+        for item in library_list:
+            game = {}
+            game['steam_appid'] = item['appid']
+            game['title'] = item['name']
+            game['owned'] = 'Yes'
+            game['playtime'] = item['playtime_forever']
+            game['last_played'] = item['rtime_last_played']
+            games_records.append(game)
+
+        return games_records
+
+    def _library_url(self):
+        return f'https://api.steampowered.com/IPlayerService/GetOwnedGames/v1/?key={self.web_api_key}&steamid={self.user_id}&include_appinfo=1&include_played_free_games=1'
+
     def get_wishlist(self):
         """
         Gets Steam wishlist games using Steam user id
@@ -82,23 +211,82 @@ class SteamClient():
         list of dicts
             Records of games in Steam wishlist
         """
-        games_records = []
-
         # Iterate through wishlist pages
         start = time.time()
         print('Steam Wishlist...')
+        games_records = [game for page in self._iter_wishlist_pages() for game in page]
+        print(f'Steam Wishlist [{time.time()-start:.2f} seconds]')
+
+        # Store data
+        start = time.time()
+        print('Steam Wishlist Store Page Data...')
+        games_records = self._enrich_with_store_data(games_records)
+        print(f'Steam Wishlist Store Page Data [{time.time()-start:.2f} seconds]')
+
+        return games_records
+
+    def iter_wishlist(self):
+        """
+        Streaming get_wishlist
+
+        Store data requests start while later wishlist pages are still being fetched,
+        and games are yielded as soon as their store data is in, in completion order.
+
+        Yields
+        ------
+        dict
+            Record of a game in Steam wishlist
+        """
+        futures = {}
+        for page in self._iter_wishlist_pages():
+            for game in page:
+                futures[self._store_data_future(game['steam_appid'])] = game
+
+        for future in as_completed(futures):
+            game = futures[future]
+            self._add_store_data(game, future)
+            yield game
+
+    def _iter_wishlist_pages(self):
+        """
+        Wishlist games, one list per wishlist page, in page order
+
+        Pages are requested wishlist_window at a time and the walk stops at the first
+        empty page. A game that moved between pages while paging is only kept once.
+        """
+        seen_steam_ids = set()
         page_counter = 0
         while page_counter >= 0:
-            r = requests.get(f'https://store.steampowered.com/wishlist/profiles/{self.user_id}/wishlistdata/?p={page_counter}', timeout=60)
-            time.sleep(self.WAIT_TIME)
-            wishlist = json.loads(r.text)
-
-            if wishlist:
-                steam_ids = list(wishlist.keys())
-                games_records += [{'steam_appid': int(steam_id), 'title': wishlist[steam_id]['name']} for steam_id in steam_ids]
-                page_counter += 1
+            window = range(page_counter, page_counter + max(self.wishlist_window, 1))
+            if self.wishlist_window > 1:
+                futures = [self.fetcher.submit(self._wishlist_url(page), TTL_WISHLIST, timeout=60) for page in window]
+                responses = (future.result() for future in futures)
             else:
-                page_counter = -1
+                responses = (self._get(self._wishlist_url(page), TTL_WISHLIST, timeout=60) for page in window)
+
+            for r in responses:
+                games_records = self._parse_wishlist_page(r, seen_steam_ids)
+                if games_records is None:
+                    page_counter = -1
+                    break
+                yield games_records
+                page_counter += 1
+
+    def _wishlist_url(self, page):
+        return f'https://store.steampowered.com/wishlist/profiles/{self.user_id}/wishlistdata/?p={page}'
+
+    @staticmethod
+    def _parse_wishlist_page(r, seen_steam_ids):
+        """
+        Records of the games on a wishlist page not in seen_steam_ids, None for an empty page (the end)
+        """
+        wishlist = json.loads(r.text)
+        if not wishlist:
+            return None
+
+        steam_ids = [steam_id for steam_id in wishlist.keys() if steam_id not in seen_steam_ids]
+        seen_steam_ids.update(steam_ids)
+        games_records = [{'steam_appid': int(steam_id), 'title': wishlist[steam_id]['name']} for steam_id in steam_ids]
 
         # Add "None"s to fit steam_library's schema
         for game in games_records:
@@ -108,125 +296,212 @@ class SteamClient():
             game['achievement_progress'] = None
             game['completed_achievements'] = None
             game['total_achievements'] = None
-        print(f'Steam Wishlist [{time.time()-start:.2f} seconds]')
-
-        # Store data
-        start = time.time()
-        print('Steam Wishlist Store Page Data...')
-        games_records = self._enrich_with_store_data(games_records)
-        print(f'Steam Wishlist Store Page Data [{time.time()-start:.2f} seconds]')
 
         return games_records
 
-    def _enrich_with_achievements(self, games):
+    def _enrich_with_achievements(self, games, previous=None):
         """
         Async enriches records list with achievements data
         """
-        futures=[]
+        games_with_achieves = []
+        futures = {}
         for game in games:
-            future = self.session.get(f'http://api.steampowered.com/ISteamUserStats/GetPlayerAchievements/v0001/?appid={game["steam_appid"]}&key={self.web_api_key}&steamid={self.user_id}')
-            future.game = game
-            futures.append(future)
+            if self._reuse_achievements(game, previous):
+                games_with_achieves.append(game)
+            else:
+                futures[self._submit_achievements(game)] = game
+        print(f'Requesting achievements for {len(futures)} games, {len(games_with_achieves)} unchanged or never played')
 
-        games_with_achieves = []
         for future in as_completed(futures):
-            try:
-                # Get response
-                resp = future.result()
-                game = future.game
-                achievements_json = resp.json()
-
-                # Handle status
-                if resp.status_code == 400:
-                    print(f'No achievements for [{game["steam_appid"]}] {game["title"]}')
-                    continue
-                elif resp.status_code > 299:
-                    raise Exception
-
-                # Process achievements
-                completed, total, progress = None, None, None
-                if achievements_json['playerstats']['success'] and 'achievements' in achievements_json['playerstats']:
-                    achievements_list = achievements_json['playerstats']['achievements']
-                    total = 0
-                    completed = 0
-                    for a in achievements_list:
-                        total += 1
-                        completed += a['achieved']  # 1 or 0 based on whether completed
-                    progress = np.round(completed/total*100, 1)                
-                else:
-                    print(f'No achievements for [{game["steam_appid"]}] {game["title"]}')
-
-                game['achievement_progress'] = progress
-                game['completed_achievements'] = completed
-                game['total_achievements'] = total
+            game = futures[future]
+            if self._add_achievements(game, future):
                 games_with_achieves.append(game)
-            except:
-                print(f'[{resp.status_code}] on {future.game["title"]}')
-                import sys; sys.exit(1)
 
         return games_with_achieves
 
+    @staticmethod
+    def _reuse_achievements(game, previous=None):
+        """
+        Fill in game's achievements without a request when they can't have changed:
+        copied from the previous row when last_played is the same, empty when the game
+        was never played
+
+        Returns
+        -------
+        bool
+            True if game was filled in
+        """
+        stored = previous.get(game['steam_appid']) if previous else None
+        if stored is not None and stored['last_played'] == game['last_played']:
+            for k in ACHIEVEMENT_FIELDS:
+                game[k] = stored[k]
+            return True
+        if not game['playtime']:
+            for k in ACHIEVEMENT_FIELDS:
+                game[k] = None
+            return True
+
+        return False
+
+    def _submit_achievements(self, game):
+        return self.fetcher.submit(self._achievements_url(game['steam_appid']), TTL_PLAYTIME)
+
+    def _achievements_url(self, appid):
+        return f'http://api.steampowered.com/ISteamUserStats/GetPlayerAchievements/v0001/?appid={appid}&key={self.web_api_key}&steamid={self.user_id}'
+
+    def _add_achievements(self, game, future):
+        """
+        Add achievements data from a finished _submit_achievements future to game
+
+        Returns
+        -------
+        bool
+            False if the game should be dropped (400, no stats for the game)
+        """
+        resp = None
+        completed, total, progress = None, None, None
+        try:
+            # Get response
+            resp = future.result()
+
+            # Handle status
+            if resp.status_code == 400:
+                print(f'No achievements for [{game["steam_appid"]}] {game["title"]}')
+                return False
+            elif resp.status_code > 299:
+                raise Exception(f'HTTP {resp.status_code}')
+
+            # Process achievements
+            achievements_json = resp.json()
+            if achievements_json['playerstats']['success'] and 'achievements' in achievements_json['playerstats']:
+                achievements_list = achievements_json['playerstats']['achievements']
+                total = 0
+                completed = 0
+                for a in achievements_list:
+                    total += 1
+                    completed += a['achieved']  # 1 or 0 based on whether completed
+                progress = np.round(completed/total*100, 1)                
+            else:
+                print(f'No achievements for [{game["steam_appid"]}] {game["title"]}')
+        except Exception as e:
+            self._record_failure(game, 'achievements', e, resp)
+
+        game['achievement_progress'] = progress
+        game['completed_achievements'] = completed
+        game['total_achievements'] = total
+
+        return True
+
+    def store_data_seconds(self, n_apps, store_source=None):
+        """
+        Lower bound on the wall time of fetching store data for n_apps uncached apps:
+        the most loaded host's requests over its rate limit
+        """
+        requests_per_app = self.STORE_REQUESTS[store_source or self.store_source]
+        rates = self.fetcher.rates
+        return max((n_apps * count / rates[host] for host, count in requests_per_app.items() if host in rates), default=0.0)
+
     def _enrich_with_store_data(self, games):
         """
         Async enriches records list with store data
         """
-        futures=[]
-        for game in games:
-            future = self.session.get(f'https://store.steampowered.com/app/{game["steam_appid"]}')
-            future.game = game
-            futures.append(future)
+        futures = {self._store_data_future(game['steam_appid']): game for game in games}
 
         games_with_store_data = []
         for future in as_completed(futures):
+            game = futures[future]
+            self._add_store_data(game, future)
+            games_with_store_data.append(game)
+
+        return games_with_store_data
+
+    def _add_store_data(self, game, future):
+        """
+        Add store data from a finished _store_data_future to game
+        """
+        try:
+            game.update(future.result())
+        except Exception as e:
+            self._record_failure(game, 'store_data', e, getattr(e, 'resp', None))
+            for k in ['recent_reviews_percent', 'recent_reviews_count', 'all_reviews_percent', 'all_reviews_count']:
+                game[k] = None
+            game['short_description'] = ""
+            game['tags'] = list()
+
+    def _store_data_future(self, appid):
+        """
+        Future of appid's store data, fetched at most once per client
+
+        Callers asking for an appid that's already in flight or done (e.g. a game on
+        both the library and the wishlist) share the same future and parsed result.
+        """
+        with self._store_data_lock:
+            if appid not in self._store_data:
+                self._store_data[appid] = self.fetcher.call(self._fetch_store_data, appid)
+            return self._store_data[appid]
+
+    def _fetch_store_data(self, appid):
+        """
+        Store data for appid from the JSON endpoints (store_source='json') or the store page
+
+        Falls back to the store page if the JSON endpoints fail.
+        """
+        if self.store_source == 'json':
             try:
-                # Get response
-                resp = future.result()
-                game = future.game
-                steam_store_tree = html.fromstring(resp.text)
-
-                # Handle status
-                if resp.status_code > 299:
-                    raise Exception
-
-                # TODO: Check to see if HTML is malformed
-
-                #== Reviews
-                reviews = [review.strip() for review in steam_store_tree.xpath('//span[@class="nonresponsive_hidden responsive_reviewdesc"]/text()') if '%' in review]
-                reviews = [r.replace(',', '').replace('%', '') for r in reviews]
-                
-                # Grab only numbers from reviews
-                if len(reviews) == 1:
-                    #if no recent reviews, make recent the same as all
-                    recent_r = [int(s) for s in reviews[0].split() if s.isdigit()]
-                    all_r = [int(s) for s in reviews[0].split() if s.isdigit()]
-                elif len(reviews) == 0:
-                    #if no reviews, set to 0
-                    recent_r = [0, 0]
-                    all_r = [0, 0]
-                else: 
-                    recent_r = [int(s) for s in reviews[0].split() if s.isdigit()][:2]
-                    all_r = [int(s) for s in reviews[1].split() if s.isdigit()]
-
-                game['recent_reviews_percent'] = recent_r[0]
-                game['recent_reviews_count'] = recent_r[1]
-                game['all_reviews_percent'] = all_r[0]
-                game['all_reviews_count'] = all_r[1]
-
-                #== Short Description
-                desc_element = steam_store_tree.xpath('//div[@class="game_description_snippet"]/text()')
-                game['short_description'] = str(desc_element[0]).strip().replace("\r", "").replace("\n", "") if desc_element else ""
-
-                #== Tags
-                tags_raw = steam_store_tree.xpath('//a[@class="app_tag"]/text()')
-                game['tags'] = [tag.strip() for tag in tags_raw] if tags_raw else list()
-
-                games_with_store_data.append(game)
-            
-            except:
-                print(f'[{resp.status_code}] on {future.game["title"]}')
-                import sys; sys.exit(1)
-
-        return games_with_store_data 
+                return parse_store_json(appid, self._fetch_store_json_responses(appid), self._get_tag_names())
+            except Exception as e:
+                print(f'JSON store data failed for [{appid}], falling back to store page: {e!r}')
+
+        resp = self.fetcher.get(self._store_page_url(appid), TTL_STORE_PAGE, timeout=60)
+        if resp.status_code > 299:
+            raise StoreDataError(f'HTTP {resp.status_code}', resp)
+
+        return parse_store_page(resp.text)
+
+    @staticmethod
+    def _store_page_url(appid):
+        return f'https://store.steampowered.com/app/{appid}'
+
+    def _fetch_store_json_responses(self, appid):
+        """
+        Responses from every JSON endpoint parse_store_json needs
+
+        Returns
+        -------
+        dict
+            'appdetails', 'reviews', 'recent_reviews' and 'items' responses
+        """
+        items_request = {
+            'ids': [{'appid': int(appid)}],
+            'context': {'language': 'english', 'country_code': 'US'},
+            'data_request': {'include_tag_count': 20}
+        }
+        urls = {
+            'appdetails': f'https://store.steampowered.com/api/appdetails?appids={appid}&filters=basic',
+            'reviews': f'https://store.steampowered.com/appreviews/{appid}?json=1&language=all&purchase_type=all&num_per_page=0',
+            'recent_reviews': f'https://store.steampowered.com/appreviews/{appid}?json=1&language=all&purchase_type=all&num_per_page=0&filter=all&day_range=30',
+            'items': f'https://api.steampowered.com/IStoreBrowseService/GetItems/v1/?input_json={quote(json.dumps(items_request))}'
+        }
+
+        responses = {}
+        for name, url in urls.items():
+            resp = self.fetcher.get(url, TTL_STORE_PAGE, timeout=60)
+            if resp.status_code > 299:
+                raise StoreDataError(f'HTTP {resp.status_code} from {name}', resp)
+            responses[name] = resp
+
+        return responses
+
+    def _get_tag_names(self):
+        """
+        Steam tagid => tag name, fetched once per client
+        """
+        with self._tag_names_lock:
+            if self._tag_names is None:
+                resp = self.fetcher.get('https://api.steampowered.com/IStoreService/GetTagList/v1/?language=english', TTL_STORE_PAGE)
+                self._tag_names = {tag['tagid']: tag['name'] for tag in resp.json()['response']['tags']}
+
+        return self._tag_names
 
     def get_achievements_data(self, appid):
         """
@@ -239,8 +514,7 @@ class SteamClient():
         """
         achieve_data = {}
 
-        r = requests.get(f'http://api.steampowered.com/ISteamUserStats/GetPlayerAchievements/v0001/?appid={appid}&key={self.web_api_key}&steamid={self.user_id}')
-        time.sleep(self.WAIT_TIME)
+        r = self._get(self._achievements_url(appid), TTL_PLAYTIME)
         achievements_json = json.loads(r.text)
         
         completed, total, progress = None, None, None
@@ -268,40 +542,111 @@ class SteamClient():
         dict
             Various store metadata for appid
         """
-        store_data = {}
+        return dict(self._store_data_future(appid).result())
 
-        r = requests.get(f'https://store.steampowered.com/app/{appid}', timeout=60)
-        time.sleep(self.WAIT_TIME)
-        steam_store_tree = html.fromstring(r.text)
 
-        #== Reviews
-        reviews = [review.strip() for review in steam_store_tree.xpath('//span[@class="nonresponsive_hidden responsive_reviewdesc"]/text()') if '%' in review]
-        reviews = [r.replace(',', '').replace('%', '') for r in reviews]
-        
-        # Grab only numbers from reviews
-        if len(reviews) == 1:
-            #if no recent reviews, make recent the same as all
-            recent_r = [int(s) for s in reviews[0].split() if s.isdigit()]
-            all_r = [int(s) for s in reviews[0].split() if s.isdigit()]
-        elif len(reviews) == 0:
-            #if no reviews, set to 0
-            recent_r = [0, 0]
-            all_r = [0, 0]
-        else: 
-            recent_r = [int(s) for s in reviews[0].split() if s.isdigit()][:2]
-            all_r = [int(s) for s in reviews[1].split() if s.isdigit()]
-
-        store_data['recent_reviews_percent'] = recent_r[0]
-        store_data['recent_reviews_count'] = recent_r[1]
-        store_data['all_reviews_percent'] = all_r[0]
-        store_data['all_reviews_count'] = all_r[1]
-
-        #== Short Description
-        desc_element = steam_store_tree.xpath('//div[@class="game_description_snippet"]/text()')
-        store_data['short_description'] = str(desc_element[0]).strip().replace("\r", "").replace("\n", "") if desc_element else ""
-
-        #== Tags
-        tags_raw = steam_store_tree.xpath('//a[@class="app_tag"]/text()')
-        store_data['tags'] = [tag.strip() for tag in tags_raw] if tags_raw else list()
-
-        return store_data
\ No newline at end of file
+class StoreDataError(Exception):
+    """Store data request failed. resp is the failed response."""
+
+    def __init__(self, message, resp=None):
+        super().__init__(message)
+        self.resp = resp
+
+
+def parse_store_page(page_text):
+    """
+    Parse review, description and tag data from a Steam store page
+
+    Returns
+    -------
+    dict
+        Various store metadata
+    """
+    store_data = {}
+
+    steam_store_tree = html.fromstring(page_text)
+
+    # TODO: Check to see if HTML is malformed
+
+    #== Reviews
+    reviews = [review.strip() for review in steam_store_tree.xpath('//span[@class="nonresponsive_hidden responsive_reviewdesc"]/text()') if '%' in review]
+    reviews = [r.replace(',', '').replace('%', '') for r in reviews]
+
+    # Grab only numbers from reviews
+    if len(reviews) == 1:
+        #if no recent reviews, make recent the same as all
+        recent_r = [int(s) for s in reviews[0].split() if s.isdigit()]
+        all_r = [int(s) for s in reviews[0].split() if s.isdigit()]
+    elif len(reviews) == 0:
+        #if no reviews, set to 0
+        recent_r = [0, 0]
+        all_r = [0, 0]
+    else:
+        recent_r = [int(s) for s in reviews[0].split() if s.isdigit()][:2]
+        all_r = [int(s) for s in reviews[1].split() if s.isdigit()]
+
+    store_data['recent_reviews_percent'] = recent_r[0]
+    store_data['recent_reviews_count'] = recent_r[1]
+    store_data['all_reviews_percent'] = all_r[0]
+    store_data['all_reviews_count'] = all_r[1]
+
+    #== Short Description
+    desc_element = steam_store_tree.xpath('//div[@class="game_description_snippet"]/text()')
+    store_data['short_description'] = str(desc_element[0]).strip().replace("\r", "").replace("\n", "") if desc_element else ""
+
+    #== Tags
+    tags_raw = steam_store_tree.xpath('//a[@class="app_tag"]/text()')
+    store_data['tags'] = [tag.strip() for tag in tags_raw] if tags_raw else list()
+
+    return store_data
+
+
+def parse_store_json(appid, responses, tag_names):
+    """
+    Same fields as parse_store_page, from Steam's JSON endpoints
+
+    Parameters
+    ----------
+    appid : int
+    responses : dict
+        From SteamClient._fetch_store_json_responses
+    tag_names : dict
+        Steam tagid => tag name
+
+    Returns
+    -------
+    dict
+        Various store metadata
+    """
+    store_data = {}
+
+    details = responses['appdetails'].json()[str(appid)]
+    if not details['success']:
+        raise StoreDataError(f'appdetails has no data for {appid}')
+
+    #== Reviews
+    def percent_and_count(summary):
+        if not summary.get('total_reviews'):
+            return [0, 0]
+        return [int(round(summary['total_positive'] / summary['total_reviews'] * 100)), summary['total_reviews']]
+
+    all_r = percent_and_count(responses['reviews'].json()['query_summary'])
+    recent_r = percent_and_count(responses['recent_reviews'].json()['query_summary'])
+    if recent_r[1] == 0:
+        #if no recent reviews, make recent the same as all
+        recent_r = all_r
+
+    store_data['recent_reviews_percent'] = recent_r[0]
+    store_data['recent_reviews_count'] = recent_r[1]
+    store_data['all_reviews_percent'] = all_r[0]
+    store_data['all_reviews_count'] = all_r[1]
+
+    #== Short Description
+    store_data['short_description'] = details['data'].get('short_description', '').strip().replace("\r", "").replace("\n", "")
+
+    #== Tags (highest voted first, like the store page)
+    store_items = responses['items'].json()['response'].get('store_items', [])
+    tags = sorted(store_items[0].get('tags', []), key=lambda tag: tag.get('weight', 0), reverse=True) if store_items else []
+    store_data['tags'] = [tag_names[tag['tagid']] for tag in tags if tag['tagid'] in tag_names]
+
+    return store_data
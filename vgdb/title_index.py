@@ -0,0 +1,203 @@
+#! /usr/bin/env python3
+"""
+Local IGDB title index for matching titles to igdb_ids without a live search
+
+Usage: python title_index.py [--platforms 48 167]
+"""
+import argparse
+import pathlib
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+import numpy as np
+
+from cache import ResponseCache
+from igdb_api import IGDBClient
+
+TITLE_INDEX_PATH = pathlib.Path.home() / ".vgdb" / "igdb_titles.sqlite"
+PS_PLATFORMS = (48, 167)  # IGDB platform ids of PS4 and PS5, what PlaystationClient fetches
+
+
+def normalize_title(title):
+    """
+    Lowercase, accents/trademark signs removed, punctuation collapsed to single spaces
+    """
+    title = unicodedata.normalize('NFKD', title.replace('®', '').replace('™', '').replace('©', ''))
+    title = ''.join(c for c in title if not unicodedata.combining(c)).lower()
+    title = title.replace('&', ' and ')
+    return re.sub(r'[^a-z0-9]+', ' ', title).strip()
+
+
+def title_ngrams(normalized, n=3):
+    """
+    Distinct character n-grams of a normalized title, padded so short words and word
+    boundaries count
+    """
+    padded = f' {normalized} '
+    return sorted({padded[i:i+n] for i in range(max(len(padded) - n + 1, 1))})
+
+
+class TitleIndex():
+    """
+    SQLite character n-gram inverted index over IGDB game names and alternative names
+
+    A title is matched by looking up its n-grams, scoring every name sharing one with
+    the Dice coefficient of the two n-gram sets, and taking the best scoring name
+    (ties go to the game with the most ratings, then to primary names).
+
+    Attributes
+    ----------
+    path : pathlib.Path
+        Location of the index (default ~/.vgdb/igdb_titles.sqlite)
+    threshold : float
+        Minimum Dice coefficient for match to return a game
+    """
+
+    MAX_CANDIDATES = 20  # Candidates returned by candidates()
+
+    def __init__(self, path=TITLE_INDEX_PATH, threshold=0.8):
+        self.path = pathlib.Path(path)
+        self.threshold = threshold
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS names (
+                name_id INTEGER PRIMARY KEY,
+                igdb_id INT NOT NULL,
+                name TEXT NOT NULL,
+                normalized TEXT NOT NULL,
+                is_alternative INT NOT NULL,
+                rating_count INT NOT NULL,
+                n_grams INT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS grams (
+                gram TEXT NOT NULL,
+                name_id INT NOT NULL,
+                PRIMARY KEY (gram, name_id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+            """
+        )
+        self._conn.commit()
+
+    @property
+    def built_at(self):
+        """Unix time the index was last built, None if it never was"""
+        with self._lock:
+            row = self._conn.execute("""SELECT value FROM meta WHERE key = 'built_at';""").fetchone()
+        return float(row[0]) if row else None
+
+    def build(self, games):
+        """
+        Replace the index with games
+
+        Parameters
+        ----------
+        games : list of dicts
+            id, name, and optionally alternative_names ([{'name': ...}]) and
+            total_rating_count, e.g. from IGDBClient.get_title_dump
+        """
+        start = time.time()
+        names = []
+        for game in games:
+            rating_count = game.get('total_rating_count', 0)
+            seen = set()
+            for name, is_alternative in [(game.get('name'), 0)] + [(alt.get('name'), 1) for alt in game.get('alternative_names', [])]:
+                normalized = normalize_title(name) if name else ''
+                if normalized and normalized not in seen:
+                    seen.add(normalized)
+                    names.append((game['id'], name, normalized, is_alternative, rating_count))
+
+        name_rows = []
+        gram_rows = []
+        for name_id, (igdb_id, name, normalized, is_alternative, rating_count) in enumerate(names):
+            grams = title_ngrams(normalized)
+            name_rows.append((name_id, igdb_id, name, normalized, is_alternative, rating_count, len(grams)))
+            gram_rows += [(gram, name_id) for gram in grams]
+
+        with self._lock:
+            self._conn.execute("""DELETE FROM names;""")
+            self._conn.execute("""DELETE FROM grams;""")
+            self._conn.executemany("""INSERT INTO names VALUES (?, ?, ?, ?, ?, ?, ?);""", name_rows)
+            self._conn.executemany("""INSERT INTO grams VALUES (?, ?);""", gram_rows)
+            self._conn.execute("""INSERT OR REPLACE INTO meta VALUES ('built_at', ?);""", (str(time.time()),))
+            self._conn.commit()
+        print(f'Title index: {len(games)} games, {len(name_rows)} names [{time.time()-start:.2f} seconds]')
+
+    def candidates(self, title, limit=None):
+        """
+        Best scoring indexed names for title
+
+        Returns
+        -------
+        list of dicts
+            igdb_id, name, score, rating_count and is_alternative, best first
+        """
+        query_grams = title_ngrams(normalize_title(title))
+        with self._lock:
+            rows = self._conn.execute(
+                f"""
+                SELECT g.name_id, COUNT(*), n.n_grams, n.rating_count, n.is_alternative
+                FROM grams g JOIN names n ON n.name_id = g.name_id
+                WHERE g.gram IN ({', '.join('?' for _ in query_grams)})
+                GROUP BY g.name_id;
+                """,
+                query_grams
+            ).fetchall()
+        if not rows:
+            return []
+
+        # Score every candidate at once
+        name_ids, overlaps, n_grams, rating_counts, is_alternative = np.array(rows, dtype=np.int64).T
+        scores = 2 * overlaps / (len(query_grams) + n_grams)
+        order = np.lexsort((is_alternative, -rating_counts, -scores))[:limit or self.MAX_CANDIDATES]
+
+        best_ids = [int(name_id) for name_id in name_ids[order]]
+        with self._lock:
+            details = {
+                name_id: (igdb_id, name)
+                for name_id, igdb_id, name in self._conn.execute(
+                    f"""SELECT name_id, igdb_id, name FROM names WHERE name_id IN ({', '.join('?' for _ in best_ids)});""",
+                    best_ids
+                )
+            }
+
+        return [
+            {
+                'igdb_id': details[name_id][0],
+                'name': details[name_id][1],
+                'score': float(score),
+                'rating_count': int(rating_count),
+                'is_alternative': bool(alternative)
+            }
+            for name_id, score, rating_count, alternative in zip(best_ids, scores[order], rating_counts[order], is_alternative[order])
+        ]
+
+    def match(self, title):
+        """
+        igdb_id of the best indexed name for title, None if it scores under threshold
+        """
+        candidates = self.candidates(title, limit=1)
+        if candidates and candidates[0]['score'] >= self.threshold:
+            return candidates[0]['igdb_id']
+        return None
+
+
+if __name__ == '__main__':
+    from config import config  # TODO: Find a better way to manage secrets
+
+    parser = argparse.ArgumentParser(description='Build the local IGDB title index')
+    parser.add_argument('--platforms', type=int, nargs='*', default=list(PS_PLATFORMS), help='IGDB platform ids to index (none = every game)')
+    args = parser.parse_args()
+
+    client = IGDBClient(config['igdb_client_id'], config['igdb_client_secret'], cache=ResponseCache())
+    TitleIndex().build(client.get_title_dump(args.platforms))
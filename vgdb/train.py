@@ -0,0 +1,225 @@
+#! /usr/bin/env python3
+"""
+Cross-validated hyperparameter search for the vgr model
+
+Every (candidate, fold) fit is a separate task on a process pool, so a search uses
+jobs x threads cores: jobs fits at once, each XGBoost model on threads threads.
+
+Usage: python train.py [--search random|halving] [--candidates N] [--folds K] [--jobs J] [--threads T]
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import os
+import random
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn import metrics
+from sklearn.model_selection import KFold
+import xgboost as xgb
+
+from features import cached_features
+
+# Sampled uniformly: lists are choices, tuples are (low, high) ranges (log scale for
+# LOG_PARAMS)
+PARAM_SPACE = {
+    'learning_rate': (0.01, 0.3),
+    'max_depth': [2, 3, 4, 5, 6, 8],
+    'min_child_weight': (1, 20),
+    'subsample': (0.5, 1.0),
+    'colsample_bytree': (0.3, 1.0),
+    'reg_alpha': (1e-3, 10.0),
+    'reg_lambda': (1e-3, 10.0),
+}
+LOG_PARAMS = {'learning_rate', 'reg_alpha', 'reg_lambda'}
+
+MAX_ESTIMATORS = 2000  # Upper bound on boosting rounds, early stopping picks the actual number
+EARLY_STOPPING_ROUNDS = 50
+
+# Per process copies of the training data, set once by _init_worker instead of being
+# pickled with every task
+_X = None
+_y = None
+
+
+def sample_params(rng, n):
+    """
+    n random candidates from PARAM_SPACE
+    """
+    candidates = []
+    for _ in range(n):
+        params = {}
+        for name, space in PARAM_SPACE.items():
+            if isinstance(space, list):
+                params[name] = rng.choice(space)
+            elif name in LOG_PARAMS:
+                params[name] = float(np.exp(rng.uniform(np.log(space[0]), np.log(space[1]))))
+            elif isinstance(space[0], int) and isinstance(space[1], int):
+                params[name] = rng.randint(*space)
+            else:
+                params[name] = rng.uniform(*space)
+        candidates.append(params)
+
+    return candidates
+
+
+def _init_worker(X, y):
+    global _X, _y
+    _X, _y = X, y
+
+
+def _fit_fold(params, train_idx, val_idx, n_estimators, threads, seed):
+    """
+    Fit one candidate on one fold, early stopping on the validation fold
+    """
+    start = time.time()
+    model = xgb.XGBRegressor(
+        n_estimators=n_estimators,
+        early_stopping_rounds=EARLY_STOPPING_ROUNDS,
+        eval_metric='mae',
+        n_jobs=threads,
+        random_state=seed,
+        **params
+    )
+    model.fit(_X[train_idx], _y[train_idx], eval_set=[(_X[val_idx], _y[val_idx])], verbose=False)
+    y_pred = model.predict(_X[val_idx], iteration_range=(0, model.best_iteration + 1))
+
+    return metrics.mean_absolute_error(_y[val_idx], y_pred), model.best_iteration + 1, time.time() - start
+
+
+class CVSearch():
+    """
+    k-fold cross-validated hyperparameter search over a process pool
+
+    Attributes
+    ----------
+    folds : int
+        k of k-fold cross-validation
+    jobs : int
+        Fits running at once (worker processes)
+    threads : int
+        XGBoost threads per fit. jobs x threads should be at most the core count.
+    seed : int
+    results : pd.DataFrame
+        One row per evaluated (candidate, n_estimators), see evaluate
+    """
+
+    def __init__(self, folds=5, jobs=None, threads=1, seed=0):
+        self.folds = folds
+        self.threads = threads
+        self.jobs = jobs or max((os.cpu_count() or 1) // threads, 1)
+        self.seed = seed
+        self.results = pd.DataFrame()
+        self._executor = None
+        self._splits = None
+
+    def fit(self, X, y, search='random', candidates=20, eta=3, min_estimators=50):
+        """
+        Run a search
+
+        Parameters
+        ----------
+        X : scipy.sparse.csr_matrix
+        y : np.array
+        search : str
+            random evaluates every candidate with MAX_ESTIMATORS rounds. halving
+            (successive halving) starts every candidate on min_estimators rounds and
+            keeps the best 1/eta for eta times the rounds, until one is left or the
+            rounds reach MAX_ESTIMATORS.
+        candidates : int
+            Candidates sampled from PARAM_SPACE
+
+        Returns
+        -------
+        pd.DataFrame
+            results, best first
+        """
+        rng = random.Random(self.seed)
+        params = sample_params(rng, candidates)
+        self._splits = list(KFold(n_splits=self.folds, shuffle=True, random_state=self.seed).split(np.arange(X.shape[0])))
+        self.results = pd.DataFrame()
+
+        start = time.time()
+        with ProcessPoolExecutor(max_workers=self.jobs, initializer=_init_worker, initargs=(X, y)) as self._executor:
+            if search == 'random':
+                self.evaluate(params, MAX_ESTIMATORS)
+            elif search == 'halving':
+                survivors = list(range(len(params)))
+                n_estimators = min_estimators
+                while True:
+                    scores = self.evaluate([params[i] for i in survivors], n_estimators, survivors)
+                    if len(survivors) <= 1 or n_estimators >= MAX_ESTIMATORS:
+                        break
+                    keep = max(len(survivors) // eta, 1)
+                    survivors = scores.sort_values('mae_mean')['candidate'].tolist()[:keep]
+                    n_estimators = min(n_estimators * eta, MAX_ESTIMATORS)
+            else:
+                raise ValueError(f'Unknown search {search}')
+        self._executor = None
+
+        print(f'Search: {len(self.results)} evaluations, {len(self.results) * self.folds} fits [{time.time()-start:.2f} seconds]')
+        return self.results.sort_values(['n_estimators', 'mae_mean'], ascending=[False, True]).reset_index(drop=True)
+
+    def evaluate(self, params, n_estimators, candidate_ids=None):
+        """
+        Cross-validate every candidate in params with up to n_estimators rounds, all
+        folds of all candidates in parallel. Appends to results.
+
+        Returns
+        -------
+        pd.DataFrame
+            candidate, n_estimators, mae_mean, mae_std, best_iteration (mean over
+            folds), fit_seconds (summed over folds) and the candidate's params
+        """
+        candidate_ids = candidate_ids if candidate_ids is not None else list(range(len(params)))
+        futures = {
+            (candidate, fold): self._executor.submit(_fit_fold, p, train_idx, val_idx, n_estimators, self.threads, self.seed)
+            for candidate, p in zip(candidate_ids, params)
+            for fold, (train_idx, val_idx) in enumerate(self._splits)
+        }
+
+        rows = []
+        for candidate, p in zip(candidate_ids, params):
+            fold_results = [futures[(candidate, fold)].result() for fold in range(self.folds)]
+            maes, best_iterations, seconds = zip(*fold_results)
+            rows.append({
+                'candidate': candidate,
+                'n_estimators': n_estimators,
+                'mae_mean': np.mean(maes),
+                'mae_std': np.std(maes),
+                'best_iteration': np.mean(best_iterations),
+                'fit_seconds': np.sum(seconds),
+                **p
+            })
+            print(f'[{candidate}] {n_estimators} rounds: MAE {rows[-1]["mae_mean"]:.3f} +- {rows[-1]["mae_std"]:.3f}')
+
+        scores = pd.DataFrame(rows)
+        self.results = pd.concat([self.results, scores], ignore_index=True)
+        return scores
+
+
+if __name__ == '__main__':
+    from vgdb import get_game_data, get_game_label_codes
+
+    parser = argparse.ArgumentParser(description='Cross-validated hyperparameter search for the vgr model')
+    parser.add_argument('--search', choices=['random', 'halving'], default='random')
+    parser.add_argument('--candidates', type=int, default=20, help='Candidates sampled from PARAM_SPACE')
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--jobs', type=int, default=None, help='Fits running at once (default: cores / threads)')
+    parser.add_argument('--threads', type=int, default=1, help='XGBoost threads per fit')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write the results table to this csv')
+    args = parser.parse_args()
+
+    df = get_game_data().set_index('igdb_id')
+    X, _ = cached_features(df, label_codes=get_game_label_codes(df))
+    rated = df['personal_rating'].notnull().values
+    X, y = X[rated], df['personal_rating'].values[rated]
+    print(f'X: {X.shape}')
+
+    search = CVSearch(folds=args.folds, jobs=args.jobs, threads=args.threads, seed=args.seed)
+    results = search.fit(X, y, search=args.search, candidates=args.candidates)
+    print(results.head(25).to_string())
+    if args.output:
+        results.to_csv(args.output, index=False)
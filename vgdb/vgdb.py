@@ -1,13 +1,45 @@
 #! /usr/bin/env python3
 
+import argparse
+from contextlib import contextmanager
+from itertools import islice
+import queue
+import threading
+import time
+
 import pandas as pd
 from sqlalchemy import create_engine, text
-from ratelimiter import RateLimiter
-from tqdm import tqdm
 
+from cache import ResponseCache, TTL_IGDB
+from db import (
+    BULK_CHUNK_SIZE,
+    LoadStats,
+    changed_records,
+    clear_checkpoints,
+    create_bulk_load_engine,
+    create_checkpoint_table,
+    create_games_data_tables,
+    create_label_tables,
+    delete_missing,
+    ensure_unique_index,
+    games_data_outdated,
+    get_games_data_label_codes,
+    insert_records,
+    load_checkpoints,
+    prune_labels,
+    refresh_games_data,
+    save_checkpoints,
+    table_exists,
+    upsert_records,
+    write_labels
+)
 from igdb_api import IGDBClient
+from igdb_async import AsyncIGDBClient
+from model import MODEL_PATH, Scorer, StaleModelError
 from ps_api import PlaystationClient
+from scheduler import StageScheduler
 from steam_api import SteamClient
+from title_index import PS_PLATFORMS, TitleIndex
 
 from config import config  # TODO: Find a better way to manage secrets
 
@@ -22,115 +54,261 @@ ps_npsso = config['ps_npsso']
 # Database engine
 engine = create_engine(database_url, echo=True)
 
+# Normalized list columns: (vocabulary table, junction table, key, key type)
+LABEL_TABLES = [
+    ('tag', 'steam_app_tag', 'steam_appid', 'INT'),
+    ('genre', 'ps_title_genre', 'ps_np_title_id', 'TEXT'),
+    ('genre', 'igdb_game_genre', 'igdb_id', 'INT'),
+    ('platform', 'igdb_game_platform', 'igdb_id', 'INT'),
+    ('theme', 'igdb_game_theme', 'igdb_id', 'INT'),
+    ('keyword', 'igdb_game_keyword', 'igdb_id', 'INT'),
+]
+
+
+def _batches(records, batch_size):
+    """
+    Lists of up to batch_size records from an iterator
+    """
+    records = iter(records)
+    batch = list(islice(records, batch_size))
+    while batch:
+        yield batch
+        batch = list(islice(records, batch_size))
+
 
 def get_game_data():
     with engine.connect() as conn:
-        df = pd.read_sql_query(text("""SELECT * FROM games_data;"""), conn)
+        df = pd.read_sql_query(text("""SELECT * FROM games_data ORDER BY igdb_id;"""), conn)
 
     return df
 
 
-def update_db():
+def get_game_label_codes(df):
     """
-    Creates/Recreates vgdb from scratch
+    Integer coded platforms/tags of get_game_data() rows (indexed by igdb_id), see
+    db.get_games_data_label_codes
     """
     with engine.connect() as conn:
+        label_codes = get_games_data_label_codes(conn, df)
+
+    return label_codes
+
+
+class DBUpdater():
+    """
+    Stages of update_db. Every stage writes in its own transaction.
+
+    Stages run concurrently on a StageScheduler wherever they don't depend on each
+    other (Steam and Playstation, and each one's IGDB mapping). SQLite allows a single
+    writer, so write transactions take turns on a lock.
+
+    Steam and Playstation records are streamed from the clients and written batch_size
+    records per transaction as they're enriched. Every written batch is queued for the
+    matching IGDB mapping stage, which resolves ids while the rest are still loading.
+
+    Progress is checkpointed to update_checkpoint as it's made: finished stages, ids
+    resolved by the mapping stages, fetched IGDB records and items that failed. In
+    resume mode finished work is skipped and failed items are retried. Checkpoints are
+    cleared once a run finishes, except failed items, so --resume can still retry them.
+
+    Attributes
+    ----------
+    incremental : bool
+        See update_db
+    resume : bool
+        See update_db
+    bulk_load : bool
+        See update_db
+    max_workers : int
+        Max stages running at once (1 runs them serially)
+    batch_size : int
+        Streamed records written per transaction
+    load_stats : db.LoadStats
+        Rows written and write time per table
+    scheduler : scheduler.StageScheduler
+        Stage graph and per-stage wall time
+    """
+
+    def __init__(self, incremental=False, offline=False, bulk_load=False, max_workers=4, batch_size=100, resume=False, score=False, store_source='html'):
+        self.incremental = incremental or resume  # Resuming keeps what the failed run wrote
+        self.resume = resume
+        self.bulk_load = bulk_load
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.engine = create_bulk_load_engine(database_url) if bulk_load else engine
+        self.chunk_size = BULK_CHUNK_SIZE if bulk_load else None
+        self.load_stats = LoadStats()
+
         # Init clients
-        steam_client = SteamClient(
+        cache = ResponseCache(offline=offline)
+        self.steam_client = SteamClient(
             steam_url_name,
             steam_user_id,
-            steam_web_api_key
+            steam_web_api_key,
+            cache=cache,
+            store_source=store_source
         )
-        igdb_client = IGDBClient(
+        self.igdb_client = AsyncIGDBClient(
             igdb_client_id,
-            igdb_client_secret
+            igdb_client_secret,
+            cache=cache,
+            title_index=TitleIndex()
         )
-        igdb_ratelimiter = RateLimiter(max_calls=3, period=1)
-        ps_client = PlaystationClient(
-            ps_npsso
+        self.ps_client = PlaystationClient(
+            ps_npsso,
+            cache=cache
         )
 
-        # =====================================================================
-        # Get Steam
-        # =====================================================================
-        steam_library_records = steam_client.get_library()
-        steam_wishlist_records = steam_client.get_wishlist()
+        # Passed between stages
+        self.known_steam_appids = {}
+        self.known_ps_np_title_ids = {}
+        self.changed_steam_appids = set()
+        self.changed_ps_np_title_ids = set()
+        self.changed_igdb_ids = set()
+        self.retry_steam_appids = set()
+        self.df_steam_appid_mapping = None
+        self.df_ps_np_title_id_mapping = None
+        self.steam_batches = queue.Queue()  # Lists of written steam_appids, None when done
+        self.ps_batches = queue.Queue()  # Lists of written (ps_np_title_id, title), None when done
+        self._write_lock = threading.Lock()
+        self._state_lock = threading.Lock()
 
-        # Convert tags to string to store in tables
-        for record in steam_library_records:
-            record['tags'] = str(record['tags'])
-        for record in steam_wishlist_records:
-            record['tags'] = str(record['tags']) 
+        self.scheduler = StageScheduler(max_workers=max_workers)
+        self.scheduler.add('prepare', self.prepare)
+        self.scheduler.add('steam', self.load_steam, depends_on=['prepare'])
+        self.scheduler.add('ps', self.load_ps, depends_on=['prepare'])
+        # Mapping stages consume the batch queues while loading runs. They're added after
+        # the loading stages so that with fewer workers the producers are started first.
+        self.scheduler.add('map_steam_appids', self.map_steam_appids, depends_on=['prepare'])
+        self.scheduler.add('map_ps_np_title_ids', self.map_ps_np_title_ids, depends_on=['prepare'])
+        self.scheduler.add('id_mapping', self.load_id_mapping, depends_on=['steam', 'ps', 'map_steam_appids', 'map_ps_np_title_ids'])
+        self.scheduler.add('igdb', self.load_igdb, depends_on=['id_mapping'])
+        self.scheduler.add('games_data', self.build_games_data, depends_on=['igdb'])
+        if score:
+            self.scheduler.add('predictions', self.score_games, depends_on=['games_data'])
 
-        # Create steam_library table
-        conn.execute(text("""DROP TABLE IF EXISTS steam_library;"""))
-        conn.execute(
-            text(
-                """
-                CREATE TABLE IF NOT EXISTS steam_library (
-                    steam_appid INT NOT NULL UNIQUE,
-                    title TEXT NOT NULL,
-                    owned BOOL,
-                    playtime FLOAT,
-                    last_played INT,
-                    achievement_progress FLOAT,
-                    completed_achievements INT,
-                    total_achievements INT,
-                    recent_reviews_percent FLOAT,
-                    recent_reviews_count INT,
-                    all_reviews_percent FLOAT,
-                    all_reviews_count INT,
-                    short_description TEXT,
-                    tags TEXT
-                );
-                """
-            )
-        )
-        conn.execute(
-            text(
-                """
-                INSERT INTO steam_library (
-                    steam_appid,
-                    title,
-                    owned,
-                    playtime,
-                    last_played,
-                    achievement_progress,
-                    completed_achievements,
-                    total_achievements,
-                    recent_reviews_percent,
-                    recent_reviews_count,
-                    all_reviews_percent,
-                    all_reviews_count,
-                    short_description,
-                    tags
-                ) VALUES (
-                    :steam_appid,
-                    :title,
-                    :owned,
-                    :playtime,
-                    :last_played,
-                    :achievement_progress,
-                    :completed_achievements,
-                    :total_achievements,
-                    :recent_reviews_percent,
-                    :recent_reviews_count,
-                    :all_reviews_percent,
-                    :all_reviews_count,
-                    :short_description,
-                    :tags
-                );
-                """
-            ),
-            steam_library_records
-        )
+    def run(self):
+        try:
+            self.scheduler.run()
+            with self._transaction() as conn:
+                clear_checkpoints(conn, keep_failed=True)
+        finally:
+            self.scheduler.print_report()
+            self.load_stats.print_report()
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Write transaction, one at a time across concurrently running stages
+        """
+        with self._write_lock, self.engine.begin() as conn:
+            yield conn
+
+    def _save_checkpoints(self, stage, items, status='done'):
+        with self._transaction() as conn:
+            save_checkpoints(conn, stage, items, status)
+
+    def _load_checkpoints(self, stage, status='done'):
+        """
+        Finished (or failed) items of stage from the run being resumed
+        """
+        if not self.resume:
+            return {}
+        with self.engine.connect() as conn:
+            return load_checkpoints(conn, stage, status)
+
+    def prepare(self):
+        """
+        Create vocabulary/junction tables and read previously resolved ids
+        """
+        with self._transaction() as conn:
+            create_checkpoint_table(conn)
+            # Steam records a previous run couldn't enrich are requested again by every run,
+            # otherwise their NULL achievements would be reused as long as last_played stays.
+            # Failed items are only replaced once their stage has streamed every record.
+            self.retry_steam_appids = {int(steam_appid) for steam_appid in load_checkpoints(conn, 'steam', 'failed')}
+            if not self.resume:
+                clear_checkpoints(conn, keep_failed=True)
+
+            # Vocabulary/junction tables for list columns
+            for vocab_table, junction_table, key, key_type in LABEL_TABLES:
+                if not self.incremental:
+                    conn.execute(text(f"""DROP TABLE IF EXISTS {junction_table};"""))
+                    conn.execute(text(f"""DROP TABLE IF EXISTS {vocab_table};"""))
+            for vocab_table, junction_table, key, key_type in LABEL_TABLES:
+                create_label_tables(conn, vocab_table, junction_table, key, key_type)
 
-        # Create steam_wishlist table
-        conn.execute(text("""DROP TABLE IF EXISTS steam_wishlist;"""))
+            # Previously resolved ids are reused in incremental mode
+            if self.incremental and table_exists(conn, 'id_mapping'):
+                df_existing_mapping = pd.read_sql_query(
+                    text(
+                        """
+                        SELECT igdb_id, steam_appid, ps_np_title_id from id_mapping WHERE igdb_id IS NOT NULL;
+                        """
+                    ),
+                    conn
+                )
+                self.known_steam_appids = df_existing_mapping.dropna(subset=['steam_appid']).set_index('steam_appid')['igdb_id'].to_dict()
+                self.known_ps_np_title_ids = df_existing_mapping.dropna(subset=['ps_np_title_id']).set_index('ps_np_title_id')['igdb_id'].to_dict()
+
+    def load_steam(self):
+        """
+        Stream Steam library and wishlist into steam_library, steam_wishlist and steam_app_tag
+        """
+        try:
+            # Records that couldn't be fully enriched are requested again instead of reused
+            retry_steam_appids = self.retry_steam_appids
+            if self._load_checkpoints('update_db').get('steam') and not retry_steam_appids:
+                print('Steam already loaded, skipping')
+                with self.engine.connect() as conn:
+                    steam_appids = [row[0] for row in conn.execute(text("""SELECT steam_appid FROM steam_library UNION ALL SELECT steam_appid FROM steam_wishlist;"""))]
+                self.steam_batches.put(steam_appids)
+                return
+
+            with self._transaction() as conn:
+                # Achievements are only requested again for games played since they were stored
+                previous_library = {}
+                if table_exists(conn, 'steam_library'):
+                    rows = conn.execute(text("""SELECT steam_appid, last_played, achievement_progress, completed_achievements, total_achievements FROM steam_library;""")).mappings()
+                    previous_library = {row['steam_appid']: dict(row) for row in rows if row['steam_appid'] not in retry_steam_appids}
+                if retry_steam_appids:
+                    print(f'Retrying {len(retry_steam_appids)} Steam records that failed to enrich')
+
+                for table in ['steam_library', 'steam_wishlist']:
+                    self._create_steam_table(conn, table)
+
+            steam_appids = {}
+            for table, records in [('steam_library', self.steam_client.iter_library(previous_library)), ('steam_wishlist', self.steam_client.iter_wishlist())]:
+                steam_appids[table] = []
+                for batch in _batches(records, self.batch_size):
+                    self.changed_steam_appids |= self._write_batch(table, 'steam_appid', batch, 'tags', 'tag', 'steam_app_tag')
+                    steam_appids[table] += [record['steam_appid'] for record in batch]
+                    self.steam_batches.put([record['steam_appid'] for record in batch])
+            with self._transaction() as conn:
+                clear_checkpoints(conn, 'steam')
+                if self.steam_client.failures:
+                    print(f'{len(self.steam_client.failures)} Steam records could not be fully enriched, rerun with --resume to retry them: {[f["steam_appid"] for f in self.steam_client.failures]}')
+                    save_checkpoints(conn, 'steam', {f['steam_appid']: f for f in self.steam_client.failures}, 'failed')
+
+            if self.incremental:
+                with self._transaction() as conn:
+                    for table, keys in steam_appids.items():
+                        delete_missing(conn, table, 'steam_appid', keys)
+                    prune_labels(conn, 'steam_app_tag', 'steam_appid', 'SELECT steam_appid FROM steam_library UNION SELECT steam_appid FROM steam_wishlist')
+            self._save_checkpoints('update_db', {'steam': True})
+        finally:
+            self.steam_batches.put(None)
+
+    def _create_steam_table(self, conn, table):
+        """
+        Create/Recreate steam_library or steam_wishlist
+        """
+        if not self.incremental:
+            conn.execute(text(f"""DROP TABLE IF EXISTS {table};"""))
         conn.execute(
             text(
-                """
-                CREATE TABLE IF NOT EXISTS steam_wishlist (
+                f"""
+                CREATE TABLE IF NOT EXISTS {table} (
                     steam_appid INT NOT NULL UNIQUE,
                     title TEXT NOT NULL,
                     owned BOOL,
@@ -149,275 +327,426 @@ def update_db():
                 """
             )
         )
-        conn.execute(
-            text(
-                """
-                INSERT INTO steam_wishlist (
-                    steam_appid,
-                    title,
-                    owned,
-                    playtime,
-                    last_played,
-                    achievement_progress,
-                    completed_achievements,
-                    total_achievements,
-                    recent_reviews_percent,
-                    recent_reviews_count,
-                    all_reviews_percent,
-                    all_reviews_count,
-                    short_description,
-                    tags
-                ) VALUES (
-                    :steam_appid,
-                    :title,
-                    :owned,
-                    :playtime,
-                    :last_played,
-                    :achievement_progress,
-                    :completed_achievements,
-                    :total_achievements,
-                    :recent_reviews_percent,
-                    :recent_reviews_count,
-                    :all_reviews_percent,
-                    :all_reviews_count,
-                    :short_description,
-                    :tags
-                );
-                """
-            ),
-            steam_wishlist_records
-        )
+        ensure_unique_index(conn, table, 'steam_appid')
 
-        # =====================================================================
-        # Get PS
-        # =====================================================================
-        ps_played_records = ps_client.get_played_titles()
-        
-        # Convert tags to string to store in tables
-        for record in ps_played_records:
-            record['genres'] = str(record['genres'])
-
-        # Create ps_played_titles table
-        conn.execute(text("""DROP TABLE IF EXISTS ps_played_titles;"""))
-        conn.execute(
-            text(
-                """
-                CREATE TABLE IF NOT EXISTS ps_played_titles (
-                    ps_np_title_id TEXT NOT NULL,
-                    ps_np_comm_id TEXT,
-                    title TEXT,
-                    console TEXT,
-                    playtime FLOAT,
-                    trophy_weighted_progress FLOAT,
-                    completed_trophies INT,
-                    total_trophies INT,
-                    first_played TEXT,
-                    last_played TEXT,
-                    genres TEXT
-                );
-                """
-            )
-        )
-        conn.execute(
-            text(
-                """
-                INSERT INTO ps_played_titles (
-                    ps_np_title_id,
-                    ps_np_comm_id,
-                    title,
-                    console,
-                    playtime,
-                    trophy_weighted_progress,
-                    completed_trophies,
-                    total_trophies,
-                    first_played,
-                    last_played,
-                    genres
-                ) VALUES (
-                    :ps_np_title_id,
-                    :ps_np_comm_id,
-                    :title,
-                    :console,
-                    :playtime,
-                    :trophy_weighted_progress,
-                    :completed_trophies,
-                    :total_trophies,
-                    :first_played,
-                    :last_played,
-                    :genres
-                );
-                """
-            ),
-            ps_played_records
-        )
+    def _write_batch(self, table, key, records, label_column, vocab_table, junction_table):
+        """
+        Write a batch of streamed records and their normalized labels in one transaction
 
-        # =====================================================================
-        # Create ID mapping
-        # =====================================================================
-        # steam_appid
-        df_steam_appid_mapping  = pd.read_sql_query(
-            text(
-                """
-                SELECT steam_appid, title from steam_library
-                UNION ALL
-                SELECT steam_appid, title from steam_wishlist;
-                """
-            ),
-            conn
-        )
-        df_steam_appid_mapping['igdb_id'] = None
+        Returns
+        -------
+        set
+            Keys of the records that were new or changed
+        """
+        labels = {record[key]: record[label_column] for record in records}
+
+        # Convert labels to string to store in tables
+        records = [{**record, label_column: str(record[label_column])} for record in records]
+
+        with self._transaction() as conn:
+            if self.incremental:
+                records = changed_records(conn, table, key, records)
+            upsert_records(conn, table, key, records, self.chunk_size, self.load_stats)
+            write_labels(conn, vocab_table, junction_table, key, {record[key]: labels[record[key]] for record in records}, self.chunk_size, self.load_stats)
+
+        return {record[key] for record in records}
+
+    def load_ps(self):
+        """
+        Stream Playstation played titles into ps_played_titles and ps_title_genre
+        """
+        try:
+            # Titles whose trophies failed are fetched again
+            retry_ps_np_title_ids = self._load_checkpoints('ps', 'failed')
+            if self._load_checkpoints('update_db').get('ps') and not retry_ps_np_title_ids:
+                print('Playstation already loaded, skipping')
+                with self.engine.connect() as conn:
+                    titles = [tuple(row) for row in conn.execute(text("""SELECT ps_np_title_id, title FROM ps_played_titles;"""))]
+                self.ps_batches.put(titles)
+                return
+
+            with self._transaction() as conn:
+                if retry_ps_np_title_ids:
+                    print(f'Retrying {len(retry_ps_np_title_ids)} Playstation titles that failed to enrich')
+
+                # Create ps_played_titles table
+                if not self.incremental:
+                    conn.execute(text("""DROP TABLE IF EXISTS ps_played_titles;"""))
+                conn.execute(
+                    text(
+                        """
+                        CREATE TABLE IF NOT EXISTS ps_played_titles (
+                            ps_np_title_id TEXT NOT NULL UNIQUE,
+                            ps_np_comm_id TEXT,
+                            title TEXT,
+                            console TEXT,
+                            playtime FLOAT,
+                            trophy_weighted_progress FLOAT,
+                            completed_trophies INT,
+                            total_trophies INT,
+                            first_played TEXT,
+                            last_played TEXT,
+                            genres TEXT
+                        );
+                        """
+                    )
+                )
+                ensure_unique_index(conn, 'ps_played_titles', 'ps_np_title_id')
+
+            ps_np_title_ids = []
+            for batch in _batches(self.ps_client.iter_played_titles(), self.batch_size):
+                self.changed_ps_np_title_ids |= self._write_batch('ps_played_titles', 'ps_np_title_id', batch, 'genres', 'genre', 'ps_title_genre')
+                ps_np_title_ids += [record['ps_np_title_id'] for record in batch]
+                self.ps_batches.put([(record['ps_np_title_id'], record['title']) for record in batch])
+            with self._transaction() as conn:
+                clear_checkpoints(conn, 'ps')
+                if self.ps_client.failures:
+                    print(f'{len(self.ps_client.failures)} Playstation titles could not be fully enriched, rerun with --resume to retry them: {[f["ps_np_title_id"] for f in self.ps_client.failures]}')
+                    save_checkpoints(conn, 'ps', {f['ps_np_title_id']: f for f in self.ps_client.failures}, 'failed')
+
+            if self.incremental:
+                with self._transaction() as conn:
+                    delete_missing(conn, 'ps_played_titles', 'ps_np_title_id', ps_np_title_ids)
+                    prune_labels(conn, 'ps_title_genre', 'ps_np_title_id', 'SELECT ps_np_title_id FROM ps_played_titles')
+            self._save_checkpoints('update_db', {'ps': True})
+        finally:
+            self.ps_batches.put(None)
+
+    def map_steam_appids(self):
+        """
+        Map steam_appid to igdb_id, resolving each batch load_steam writes as it arrives
+        """
+        def checkpoint(steam_appids, result):
+            if isinstance(result, Exception):
+                self._save_checkpoints('map_steam_appids', {steam_appid: repr(result) for steam_appid in steam_appids}, 'failed')
+            else:
+                self._save_checkpoints('map_steam_appids', {steam_appid: result.get(steam_appid) for steam_appid in steam_appids})
+
+        # steam_appid => igdb_id, None when IGDB has no match
+        steam_appid_igdb_ids = {int(steam_appid): igdb_id for steam_appid, igdb_id in self._load_checkpoints('map_steam_appids').items()}
+        requested = set(steam_appid_igdb_ids)
+        failed = []
+        for steam_appids in iter(self.steam_batches.get, None):
+            unmapped_steam_appids = [int(steam_appid) for steam_appid in steam_appids if steam_appid not in self.known_steam_appids and steam_appid not in requested]
+            requested.update(unmapped_steam_appids)
+            steam_appid_chunks = [unmapped_steam_appids[i:i+IGDBClient.MAX_LIMIT] for i in range(0, len(unmapped_steam_appids), IGDBClient.MAX_LIMIT)]
+            results = self.igdb_client.run_all('get_igdb_ids_by_steam_appids', steam_appid_chunks, desc='Map steam_appid to igdb_id', on_result=checkpoint, return_exceptions=True)
+            for chunk, chunk_igdb_ids in zip(steam_appid_chunks, results):
+                if isinstance(chunk_igdb_ids, Exception):
+                    failed += chunk
+                else:
+                    steam_appid_igdb_ids.update(chunk_igdb_ids)
+        if failed:
+            print(f'{len(failed)} steam_appids failed to map, rerun with --resume to retry them')
 
-        for idx, row in tqdm(df_steam_appid_mapping.iterrows(), total=df_steam_appid_mapping.shape[0], desc='Map steam_appid to igdb_id'):
-            with igdb_ratelimiter:
-                igdb_id = igdb_client.get_igdb_id_by_steam_appid(int(row['steam_appid']))
+        # Every batch is written by now
+        with self.engine.connect() as conn:
+            df_steam_appid_mapping  = pd.read_sql_query(
+                text(
+                    """
+                    SELECT steam_appid, title from steam_library
+                    UNION ALL
+                    SELECT steam_appid, title from steam_wishlist;
+                    """
+                ),
+                conn
+            )
+        df_steam_appid_mapping['igdb_id'] = df_steam_appid_mapping['steam_appid'].map(self.known_steam_appids)
+
+        df_unmapped = df_steam_appid_mapping[df_steam_appid_mapping['igdb_id'].isnull()]
+        for idx, row in df_unmapped.iterrows():
+            igdb_id = steam_appid_igdb_ids.get(int(row['steam_appid']))
             if igdb_id:
                 df_steam_appid_mapping.at[idx, 'igdb_id'] = igdb_id
             else:
                 print(f'No IGDB ID found for ({row["steam_appid"]}) {row["title"]}')
 
-        df_steam_appid_mapping = df_steam_appid_mapping[['igdb_id', 'steam_appid']]
+        self.df_steam_appid_mapping = df_steam_appid_mapping[['igdb_id', 'steam_appid']]
 
-        #ps_np_title_id
-        df_ps_np_title_id_mapping  = pd.read_sql_query(
-            text(
-                """
-                SELECT ps_np_title_id, title from ps_played_titles;
-                """
-            ),
-            conn
-        )
-        df_ps_np_title_id_mapping['igdb_id'] = None
+        # igdb_ids whose games_data row needs refreshing: newly mapped, linked to a changed
+        # record, or linked to a record that no longer exists
+        current_steam_appids = set(df_steam_appid_mapping['steam_appid'])
+        with self._state_lock:
+            self.changed_igdb_ids |= set(steam_appid_igdb_ids.values())
+            self.changed_igdb_ids |= set(df_steam_appid_mapping[df_steam_appid_mapping['steam_appid'].isin(self.changed_steam_appids)]['igdb_id'])
+            self.changed_igdb_ids |= {igdb_id for steam_appid, igdb_id in self.known_steam_appids.items() if steam_appid not in current_steam_appids}
+
+    def map_ps_np_title_ids(self):
+        """
+        Map ps_np_title_id to igdb_id, resolving each batch load_ps writes as it arrives
+        """
+        self._refresh_title_index()
+
+        # ps_np_title_id => igdb_id, None when IGDB has no match
+        title_igdb_ids = self._load_checkpoints('map_ps_np_title_ids')
+        failed = []
+        for titles in iter(self.ps_batches.get, None):
+            unmapped_titles = {}  # title => ps_np_title_ids
+            for ps_np_title_id, title in titles:
+                if ps_np_title_id not in self.known_ps_np_title_ids and ps_np_title_id not in title_igdb_ids:
+                    unmapped_titles.setdefault(title, []).append(ps_np_title_id)
 
-        for idx, row in tqdm(df_ps_np_title_id_mapping.iterrows(), total=df_ps_np_title_id_mapping.shape[0], desc='Map ps_np_title_id to igdb_id'):
-            with igdb_ratelimiter:
-                igdb_id = igdb_client.get_igdb_id_by_title(row['title'])
+            def checkpoint(title, result):
+                if isinstance(result, Exception):
+                    self._save_checkpoints('map_ps_np_title_ids', {ps_np_title_id: repr(result) for ps_np_title_id in unmapped_titles[title]}, 'failed')
+                else:
+                    self._save_checkpoints('map_ps_np_title_ids', {ps_np_title_id: result for ps_np_title_id in unmapped_titles[title]})
+
+            igdb_ids = self.igdb_client.run_all('get_igdb_id_by_title', list(unmapped_titles), desc='Map ps_np_title_id to igdb_id', on_result=checkpoint, return_exceptions=True)
+            for ps_np_title_ids, igdb_id in zip(unmapped_titles.values(), igdb_ids):
+                if isinstance(igdb_id, Exception):
+                    failed += ps_np_title_ids
+                else:
+                    title_igdb_ids.update({ps_np_title_id: igdb_id for ps_np_title_id in ps_np_title_ids})
+        if failed:
+            print(f'{len(failed)} ps_np_title_ids failed to map, rerun with --resume to retry them')
+
+        # Every batch is written by now
+        with self.engine.connect() as conn:
+            df_ps_np_title_id_mapping  = pd.read_sql_query(
+                text(
+                    """
+                    SELECT ps_np_title_id, title from ps_played_titles;
+                    """
+                ),
+                conn
+            )
+        df_ps_np_title_id_mapping['igdb_id'] = df_ps_np_title_id_mapping['ps_np_title_id'].map(self.known_ps_np_title_ids)
+
+        df_unmapped = df_ps_np_title_id_mapping[df_ps_np_title_id_mapping['igdb_id'].isnull()]
+        for idx, row in df_unmapped.iterrows():
+            igdb_id = title_igdb_ids.get(row['ps_np_title_id'])
             if igdb_id:
                 df_ps_np_title_id_mapping.at[idx, 'igdb_id'] = igdb_id
             else:
                 print(f'No IGDB ID found for ({row["ps_np_title_id"]}) {row["title"]}')
-        
-        df_ps_np_title_id_mapping = df_ps_np_title_id_mapping[['igdb_id', 'ps_np_title_id']]
 
-        # Join
-        df_steam_appid_mapping = df_steam_appid_mapping.set_index('igdb_id')
-        df_ps_np_title_id_mapping = df_ps_np_title_id_mapping.set_index('igdb_id')
+        self.df_ps_np_title_id_mapping = df_ps_np_title_id_mapping[['igdb_id', 'ps_np_title_id']]
+
+        current_ps_np_title_ids = set(df_ps_np_title_id_mapping['ps_np_title_id'])
+        with self._state_lock:
+            self.changed_igdb_ids |= set(title_igdb_ids.values())
+            self.changed_igdb_ids |= set(df_ps_np_title_id_mapping[df_ps_np_title_id_mapping['ps_np_title_id'].isin(self.changed_ps_np_title_ids)]['igdb_id'])
+            self.changed_igdb_ids |= {igdb_id for ps_np_title_id, igdb_id in self.known_ps_np_title_ids.items() if ps_np_title_id not in current_ps_np_title_ids}
+
+    def _refresh_title_index(self):
+        """
+        (Re)build the local title index from an IGDB dump of PS4/PS5 games once it's
+        missing or older than the IGDB response cache TTL
+        """
+        title_index = self.igdb_client.title_index
+        built_at = title_index.built_at
+        offline = self.igdb_client.cache is not None and self.igdb_client.cache.offline
+        if built_at is not None and (time.time() - built_at < TTL_IGDB or offline):
+            return
+        if offline:
+            print('No title index to replay, titles will be matched with (cached) live searches')
+            return
+
+        start = time.time()
+        print('IGDB Title Index...')
+        title_index.build(self.igdb_client.run('get_title_dump', PS_PLATFORMS))
+        print(f'IGDB Title Index [{time.time()-start:.2f} seconds]')
+
+    def load_id_mapping(self):
+        """
+        Join steam_appid and ps_np_title_id mappings into id_mapping
+        """
+        df_steam_appid_mapping = self.df_steam_appid_mapping.set_index('igdb_id')
+        df_ps_np_title_id_mapping = self.df_ps_np_title_id_mapping.set_index('igdb_id')
         df_id_mapping = df_steam_appid_mapping.join(df_ps_np_title_id_mapping, how='outer')
-        id_mapping_records = df_id_mapping.reset_index(names='igdb_id').to_dict('records')
+        id_mapping_records = df_id_mapping.reset_index(names='igdb_id')[['igdb_id', 'steam_appid', 'ps_np_title_id']].to_dict('records')
 
-        # Create id_mapping table
-        conn.execute(text("""DROP TABLE IF EXISTS id_mapping;"""))
-        conn.execute(
-            text(
-                """
-                CREATE TABLE IF NOT EXISTS id_mapping (
-                    igdb_id INT,
-                    steam_appid INT,
-                    ps_np_title_id TEXT
-                );
-                """
+        with self._transaction() as conn:
+            # Create id_mapping table
+            if not self.incremental:
+                conn.execute(text("""DROP TABLE IF EXISTS id_mapping;"""))
+            conn.execute(
+                text(
+                    """
+                    CREATE TABLE IF NOT EXISTS id_mapping (
+                        igdb_id INT,
+                        steam_appid INT,
+                        ps_np_title_id TEXT
+                    );
+                    """
+                )
             )
-        )
-        conn.execute(
-            text(
-                """
-                INSERT INTO id_mapping (
-                    igdb_id,
-                    steam_appid,
-                    ps_np_title_id
-                ) VALUES (
-                    :igdb_id,
-                    :steam_appid,
-                    :ps_np_title_id
-                );
-                """
-            ),
-            id_mapping_records
-        )
+            # id_mapping has no natural key, so it's rewritten in place within the transaction
+            conn.execute(text("""DELETE FROM id_mapping;"""))
+            insert_records(conn, 'id_mapping', id_mapping_records, self.chunk_size, self.load_stats)
 
-        # =====================================================================
-        # Get IGDB
-        # =====================================================================
-        igdb_ids  = pd.read_sql_query(
-            text(
-                """
-                SELECT igdb_id from id_mapping;
-                """
-            ),
-            conn
-        ).dropna().drop_duplicates().astype(int)['igdb_id'].values
-
-        igdb_records = []
-        for igdb_id in tqdm(igdb_ids, desc='IGDB Game Data'):
-            with igdb_ratelimiter:
-                record = igdb_client.get_game(igdb_id)
-            igdb_records.append(record)
-
-         # Convert tags to string to store in tables
-        for record in igdb_records:
-            record['platforms'] = str(record['platforms'])
-            record['genres'] = str(record['genres'])
-            record['themes'] = str(record['themes'])
-            record['keywords'] = str(record['keywords'])
-
-        conn.execute(text("""DROP TABLE IF EXISTS igdb_data;"""))
-        conn.execute(
-            text(
-                """
-                CREATE TABLE IF NOT EXISTS igdb_data (
-                    igdb_id INT UNIQUE,
-                    name TEXT,
-                    first_release_date INT,
-                    platforms TEXT,
-                    rating FLOAT,
-                    rating_count INT,
-                    critics_rating FLOAT,
-                    critics_rating_count INT,
-                    summary TEXT,
-                    storyline TEXT,
-                    genres TEXT,
-                    themes TEXT,
-                    keywords TEXT
-                );
-                """
+    def load_igdb(self):
+        """
+        Get IGDB metadata for every mapped igdb_id into igdb_data and its junction tables
+        """
+        with self.engine.connect() as conn:
+            igdb_ids  = pd.read_sql_query(
+                text(
+                    """
+                    SELECT igdb_id from id_mapping;
+                    """
+                ),
+                conn
+            ).dropna().drop_duplicates().astype(int)['igdb_id'].values
+
+            if self.incremental and table_exists(conn, 'igdb_data'):
+                fetched_igdb_ids = set(pd.read_sql_query(text("""SELECT igdb_id from igdb_data;"""), conn)['igdb_id'].values)
+                new_igdb_ids = [igdb_id for igdb_id in igdb_ids if igdb_id not in fetched_igdb_ids]
+            else:
+                new_igdb_ids = igdb_ids
+
+        def checkpoint(igdb_ids, result):
+            if isinstance(result, Exception):
+                self._save_checkpoints('igdb', {igdb_id: repr(result) for igdb_id in igdb_ids}, 'failed')
+            else:
+                self._save_checkpoints('igdb', {record['igdb_id']: record for record in result})
+
+        # Records fetched before a failed run are reused when resuming
+        igdb_records = list(self._load_checkpoints('igdb').values())
+        fetched_igdb_ids = {record['igdb_id'] for record in igdb_records}
+        # Sorted so the get_games chunks (and their cache keys) don't depend on the order
+        # id_mapping rows were streamed in
+        new_igdb_ids = sorted(int(igdb_id) for igdb_id in new_igdb_ids if igdb_id not in fetched_igdb_ids)
+
+        igdb_id_chunks = [new_igdb_ids[i:i+IGDBClient.MAX_LIMIT] for i in range(0, len(new_igdb_ids), IGDBClient.MAX_LIMIT)]
+        failed = []
+        for chunk, chunk_records in zip(igdb_id_chunks, self.igdb_client.run_all('get_games', igdb_id_chunks, desc='IGDB Game Data', on_result=checkpoint, return_exceptions=True)):
+            if isinstance(chunk_records, Exception):
+                failed += chunk
+            else:
+                igdb_records += chunk_records
+        if failed:
+            print(f'{len(failed)} igdb_ids failed to fetch, rerun with --resume to retry them')
+        self.changed_igdb_ids |= {record['igdb_id'] for record in igdb_records}
+
+        with self._transaction() as conn:
+            # Normalized genres, platforms, themes and keywords
+            for vocab_table, junction_table, key, _ in LABEL_TABLES:
+                if key == 'igdb_id':
+                    write_labels(conn, vocab_table, junction_table, key, {record['igdb_id']: record[f'{vocab_table}s'] for record in igdb_records}, self.chunk_size, self.load_stats)
+                    if self.incremental:
+                        prune_labels(conn, junction_table, key, 'SELECT igdb_id FROM id_mapping WHERE igdb_id IS NOT NULL')
+
+            # Convert tags to string to store in tables
+            for record in igdb_records:
+                record['platforms'] = str(record['platforms'])
+                record['genres'] = str(record['genres'])
+                record['themes'] = str(record['themes'])
+                record['keywords'] = str(record['keywords'])
+
+            if not self.incremental:
+                conn.execute(text("""DROP TABLE IF EXISTS igdb_data;"""))
+            conn.execute(
+                text(
+                    """
+                    CREATE TABLE IF NOT EXISTS igdb_data (
+                        igdb_id INT UNIQUE,
+                        name TEXT,
+                        first_release_date INT,
+                        platforms TEXT,
+                        rating FLOAT,
+                        rating_count INT,
+                        critics_rating FLOAT,
+                        critics_rating_count INT,
+                        summary TEXT,
+                        storyline TEXT,
+                        genres TEXT,
+                        themes TEXT,
+                        keywords TEXT
+                    );
+                    """
+                )
             )
-        )
-        conn.execute(
-            text(
-                """
-                INSERT INTO igdb_data (
-                    igdb_id,
-                    name,
-                    first_release_date,
-                    platforms,
-                    rating,
-                    rating_count,
-                    critics_rating,
-                    critics_rating_count,
-                    summary,
-                    storyline,
-                    genres,
-                    themes,
-                    keywords
-                ) VALUES (
-                    :igdb_id,
-                    :name,
-                    :first_release_date,
-                    :platforms,
-                    :rating,
-                    :rating_count,
-                    :critics_rating,
-                    :critics_rating_count,
-                    :summary,
-                    :storyline,
-                    :genres,
-                    :themes,
-                    :keywords
-                );
-                """
-            ),
-            igdb_records
-        )
-                
+            ensure_unique_index(conn, 'igdb_data', 'igdb_id')
+            if self.incremental:
+                delete_missing(conn, 'igdb_data', 'igdb_id', igdb_ids)
+            upsert_records(conn, 'igdb_data', 'igdb_id', igdb_records, self.chunk_size, self.load_stats)
+
+    def build_games_data(self):
+        """
+        Materialize games_data
+        """
+        with self._transaction() as conn:
+            # A games_data created before a column was added is rebuilt once. Ratings
+            # entered into a games_data from before personal_ratings are copied over first.
+            rebuild = not self.incremental or games_data_outdated(conn)
+            create_games_data_tables(conn, rebuild=rebuild)
+            # Changes a failed run wrote aren't known when resuming, so everything is refreshed
+            if self.incremental and not self.resume and not rebuild:
+                refresh_games_data(conn, [igdb_id for igdb_id in self.changed_igdb_ids if pd.notnull(igdb_id)], self.load_stats)
+            else:
+                refresh_games_data(conn, stats=self.load_stats)
+
+    def score_games(self):
+        """
+        Score new/changed unrated games_data rows into predictions with the latest model
+        artifact
+        """
+        if not (MODEL_PATH / 'LATEST').exists():
+            print(f'No model artifact in {MODEL_PATH}, skipping predictions')
+            return
+
+        try:
+            scorer = Scorer()
+        except StaleModelError:
+            print(f'Model {(MODEL_PATH / "LATEST").read_text().strip()} is stale, retrain with vgr.py, skipping predictions')
+            return
+
+        with self._transaction() as conn:
+            if self.incremental and not self.resume:
+                scorer.score(conn, [igdb_id for igdb_id in self.changed_igdb_ids if pd.notnull(igdb_id)], self.load_stats)
+            else:
+                scorer.score(conn, stats=self.load_stats)
+
+
+def update_db(incremental=False, offline=False, bulk_load=False, max_workers=4, batch_size=100, resume=False, score=False, store_source='html'):
+    """
+    Creates/Recreates vgdb from scratch
+
+    Parameters
+    ----------
+    incremental : bool
+        Instead of dropping and rebuilding every table, upsert on the natural keys
+        (steam_appid, ps_np_title_id, igdb_id), only write rows whose content changed,
+        and only send ids that aren't mapped/fetched yet to IGDB
+    offline : bool
+        Replay responses from the response cache (~/.vgdb/http_cache.sqlite) without
+        touching the network
+    bulk_load : bool
+        Write with statement echo off, load-time PRAGMAs (WAL, synchronous=NORMAL,
+        larger cache) and chunked executemany
+    max_workers : int
+        Max independent stages (Steam, Playstation, IGDB mappings) running at once.
+        1 runs every stage serially.
+    batch_size : int
+        Steam/Playstation records written per transaction as they stream in
+    resume : bool
+        Pick up after a failed run: keep its tables (implies incremental), skip stages
+        and items it checkpointed and retry the items that failed
+    score : bool
+        Score new/changed unrated games into predictions with the latest model artifact
+        (see model.py), without retraining
+    store_source : str
+        Steam store data from store pages ('html') or the JSON endpoints ('json'). json
+        makes 3x the store.steampowered.com requests, so it's about 3x slower under
+        that host's rate limit (see SteamClient.STORE_REQUESTS).
+    """
+    start = time.time()
+    DBUpdater(incremental=incremental, offline=offline, bulk_load=bulk_load, max_workers=max_workers, batch_size=batch_size, resume=resume, score=score, store_source=store_source).run()
+    print(f'update_db [{time.time()-start:.2f} seconds]')
+
 
 if __name__ == '__main__':
-    update_db()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Populate vgdb')
+    parser.add_argument('--incremental', action='store_true', help='Upsert changed rows instead of rebuilding every table')
+    parser.add_argument('--offline', action='store_true', help='Replay cached API responses only')
+    parser.add_argument('--bulk-load', action='store_true', help='Fast writes: no echo, load PRAGMAs, chunked executemany')
+    parser.add_argument('--max-workers', type=int, default=4, help='Max stages running at once (1 = serial)')
+    parser.add_argument('--batch-size', type=int, default=100, help='Streamed records written per transaction')
+    parser.add_argument('--resume', action='store_true', help='Skip work checkpointed by a failed run and retry what failed')
+    parser.add_argument('--score', action='store_true', help='Score new/changed unrated games with the latest model artifact')
+    parser.add_argument('--store-source', choices=['html', 'json'], default='html', help='Steam store data from store pages or the JSON endpoints (3x the store requests)')
+    args = parser.parse_args()
+
+    update_db(incremental=args.incremental, offline=args.offline, bulk_load=args.bulk_load, max_workers=args.max_workers, batch_size=args.batch_size, resume=args.resume, score=args.score, store_source=args.store_source)
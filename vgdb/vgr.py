@@ -1,59 +1,37 @@
-import ast
-
 import numpy as np
+import pandas as pd
 from sklearn import metrics
 from sklearn.model_selection import train_test_split
 import xgboost as xgb
 
-from vgdb import get_game_data
-
-def explode_binary(df, explode_col):
-    df_tags = df[[explode_col]]
-    UNIQUE_TAGS = sorted(list(set([tag for row in df_tags[explode_col].tolist() if row for tag in row])), reverse=False)
-    df_tags[[f'{explode_col}_{tag}' for tag in UNIQUE_TAGS]] = 0
-
-    # Map tag postion importance to column
-    for row_idx, row in df_tags.iterrows():
-        if row[explode_col]:
-            for tag in row[explode_col]:
-                df_tags.at[row_idx, f'{explode_col}_{tag}'] = 1
-    df_tags = df_tags.drop([explode_col], axis=1)
-    return df_tags
+from features import cached_features, feature_names
+from model import save_model
+from vgdb import get_game_data, get_game_label_codes
 
 
 if __name__ == '__main__':
     df = get_game_data().set_index('igdb_id')
+    label_codes = get_game_label_codes(df)
     df = df.drop(['steam_appid', 'ps_np_title_id'], axis=1)
 
     print(df.columns)
     #==  Data process
 
-    # Fillna
-    for col in ['playtime_hours', 'achievement_progress', 'reviews_percent']:
-        df[col] = df[col].fillna(0)
-    df['description'] = df['description'].fillna("")
-
-    # platforms
-    df['platforms'] = df['platforms'].apply(ast.literal_eval)  # Convert 'object' to list
-    df['platforms'] = df['platforms'].apply(lambda d: d if isinstance(d, list) else [])  # fillna
-    df['platforms'] = df['platforms'].apply(lambda X: list(set([x.lower().replace('/', ' ').replace('(', '').replace(')', '').replace('\'', '').replace(',', '').replace('<', '').replace('>', '').replace(':', '').replace('[', '').replace(']', '') for x in X])))  # process
-    df = df.merge(explode_binary(df, 'platforms'), how='inner', right_index=True, left_index=True, suffixes=(None, None)).drop(['platforms'], axis=1).drop_duplicates()
-
-    # tags
-    df['tags'] = df['tags'].apply(ast.literal_eval)  # Convert 'object' to list
-    df['tags'] = df['tags'].apply(lambda d: d if isinstance(d, list) else [])  # fillna
-    df['tags'] = df['tags'].apply(lambda X: list(set([x.lower().replace('/', ' ').replace('(', '').replace(')', '').replace('\'', '').replace(',', '').replace('<', '').replace('>', '').replace(':', '').replace('[', '').replace(']', '') for x in X])))  # process
-    df = df.merge(explode_binary(df, 'tags'), how='inner', right_index=True, left_index=True, suffixes=(None, None)).drop(['tags'], axis=1).drop_duplicates()
+    # Numeric columns (nulls filled with 0), platforms and tags (integer coded in the
+    # junction tables) multi-hot encoded and description/storyline hashed word n-grams,
+    # straight into a sparse matrix. Loaded from the feature cache when games_data
+    # hasn't changed, only new/changed rows are hashed again when it has.
+    X, vocabularies = cached_features(df, label_codes=label_codes)
 
     #== Train/Test split
-    # TODO Drop these columns for now until we can properly process them
-    titles = df['title']
-    df = df.drop(['title', 'last_played', 'description'], axis=1)
+    # TODO title and last_played aren't used until we can properly process them
+    # XGBoost takes the CSR matrix as is. Entries it doesn't store (zeros) are treated as
+    # missing, which only changes which side of a split they default to.
 
-    train = df[df['personal_rating'].notnull()]  # NOTE: Might weight examples by playtime in the future
-    test = df[df['personal_rating'].isnull()].drop(['personal_rating'], axis=1)
-    y_train = train['personal_rating']
-    X_train = train.drop(['personal_rating'], axis=1)
+    rated = df['personal_rating'].notnull().values  # NOTE: Might weight examples by playtime in the future
+    X_train = X[rated]
+    y_train = df['personal_rating'].values[rated]
+    test = X[~rated]
 
     X_train, X_val, y_train, y_val = train_test_split(X_train, y_train, train_size=0.8)
     print(f'X train: {X_train.shape}')
@@ -66,15 +44,19 @@ if __name__ == '__main__':
     clf = xgb.XGBRegressor()
     clf.fit(X_train, y_train)
     y_val_pred = clf.predict(X_val)
-    print(f'MAE: {metrics.mean_absolute_error(y_val, y_val_pred)}')
+    mae = metrics.mean_absolute_error(y_val, y_val_pred)
+    print(f'MAE: {mae}')
+
+    # Saved so model.py/update_db --score can score new games without retraining
+    version = save_model(clf, vocabularies, mae=float(mae), n_train=int(X_train.shape[0]))
+    print(f'Model: {version}')
 
-    test['pred'] = clf.predict(test)
-    pred = test.join(titles, how='left').sort_values('pred', ascending=False)
+    pred = pd.DataFrame({'pred': clf.predict(test)}, index=df.index[~rated]).join(df['title'], how='left').sort_values('pred', ascending=False)
 
     for i, row in pred.iloc[:25, :].iterrows():
         print(f'[{i}] {row["title"]}: {row["pred"]}')
 
     print()
-    fi = sorted([(feat, imp) for feat, imp in zip(X_train.columns, clf.feature_importances_)], key=lambda x: x[1], reverse=True)
+    fi = sorted([(feat, imp) for feat, imp in zip(feature_names(vocabularies), clf.feature_importances_)], key=lambda x: x[1], reverse=True)
     for f, i in fi[:25]:
         print(f'{f}: {i}')
\ No newline at end of file